@@ -1,40 +1,98 @@
 from jax import numpy as jnp, vmap, jit, tree_map
 from jax._src.lax.control_flow import while_loop
 from jax._src.scipy.special import erf
+from jax._src.scipy.linalg import solve_triangular
+from jax.lax import scan, top_k
 
 import numpy as np
+import logging
+from timeit import default_timer
 
-from bayes_gain_screens.utils import inverse_update, windowed_mean, windowed_nanmean, polyfit
+from bayes_gain_screens.utils import inverse_update, windowed_mean, windowed_nanmean, polyfit, rolling_median
 from jaxns.utils import chunked_pmap
 
+logger = logging.getLogger(__name__)
 
-def leave_one_out_predictive(K, Cinv, Y_obs):
-    """
+
+def leave_one_out_predictive(K, Cinv, Y_obs, uncert):
+    r"""
     Compute the leave-one-out conditional predictive GP,
         P(y* | Y\y*, K, uncert) for all y*
         which are given by N(mu_star, sigma_star**2)
+
+    Uses the closed form in terms of the full inverse,
+        mu_star = Y_obs - [Cinv.Y_obs] / diag(Cinv)
+        sigma_star**2 = 1 / diag(Cinv) - uncert**2
+    which is O(M^2) given Cinv, rather than forming each reduced inverse.
+
     Args:
         K: [M, M] covariance matrix
-        Cinv: [M, M] inv(K + uncert**2 * I)
+        Cinv: [M, M] inv(K + uncert**2 * I), with zero rows/cols for removed observables.
         Y_obs: [M] observables, zero centred
+        uncert: [M] observational uncertainty
 
     Returns:
-        [M] mu_star
-        [M] sigma_star
-        [M, M-1, M-1] reduced Cinv per observable.
-        [M, M] drop matrix
+        [M] mu_star, Y_obs for removed observables
+        [M] sigma_star, inf for removed observables
     """
-
-    def single_log_likelihood(m):
+    diag = jnp.diag(Cinv)
+    removed = diag <= 0.
+    diag = jnp.where(removed, 1., diag)
+    mu_star = Y_obs - (Cinv @ Y_obs) / diag
+    uncert2 = jnp.where(jnp.isinf(uncert), 0., uncert ** 2)
+    sigma2_star = jnp.maximum(1. / diag - uncert2, 0.)
+    mu_star = jnp.where(removed, Y_obs, mu_star)
+    sigma_star = jnp.where(removed, jnp.inf, jnp.sqrt(sigma2_star))
+    return mu_star, sigma_star
+
+
+def test_leave_one_out_predictive():
+    M = 6
+    X = np.random.normal(size=(M, 2))
+    K = np.exp(-0.5 * np.sum((X[:, None, :] - X[None, :, :]) ** 2, axis=-1))
+    uncert = np.random.uniform(0.1, 0.3, size=M)
+    Y_obs = np.random.normal(size=M)
+    Cinv = jnp.linalg.inv(K + jnp.diag(uncert ** 2))
+
+    def reference(m):
         Cinv_reduced, drop = inverse_update(Cinv, m, return_drop=True)
         kstar_reduced = jnp.take(K[m, :], drop, axis=0)
         JT = Cinv_reduced @ kstar_reduced[:, None]
         sigma2_star = K[m, m] - jnp.sum(kstar_reduced * JT[:, 0])
-        Y_obs_reduced = jnp.take(Y_obs, drop, axis=0)
-        mu_star = jnp.sum(JT[:, 0] * Y_obs_reduced)
+        mu_star = jnp.sum(JT[:, 0] * jnp.take(Y_obs, drop, axis=0))
         return mu_star, jnp.sqrt(sigma2_star)
 
-    return vmap(single_log_likelihood)(jnp.arange(K.shape[0]))
+    K = jnp.asarray(K)
+    mu_ref, sigma_ref = vmap(reference)(jnp.arange(M))
+    mu_star, sigma_star = leave_one_out_predictive(K, Cinv, Y_obs, uncert)
+    assert jnp.allclose(mu_star, mu_ref, atol=1e-4)
+    assert jnp.allclose(sigma_star, sigma_ref, atol=1e-4)
+    # removing the last observable gives the same predictive for the rest as never having it
+    Cinv_removed = downdate_inverse(Cinv, M - 1)
+    assert jnp.allclose(Cinv_removed[:-1, :-1], jnp.linalg.inv(K[:-1, :-1] + jnp.diag(uncert[:-1] ** 2)), atol=1e-4)
+    mu_star, sigma_star = leave_one_out_predictive(K, Cinv_removed, Y_obs, uncert)
+    mu_ref, sigma_ref = leave_one_out_predictive(K[:-1, :-1], Cinv_removed[:-1, :-1], Y_obs[:-1], uncert[:-1])
+    assert jnp.allclose(mu_star[:-1], mu_ref, atol=1e-4)
+    assert jnp.isinf(sigma_star[-1])
+
+
+def downdate_inverse(Cinv, m):
+    """
+    Remove the m-th observable from the inverse covariance by a rank-1 downdate, keeping the shape fixed.
+
+        Cinv - Cinv[:, m] Cinv[m, :] / Cinv[m, m]
+
+    which equals inv(C) with the m-th row/col dropped, padded with zeros in the m-th row and col.
+
+    Args:
+        Cinv: [M, M]
+        m: int, index to remove
+
+    Returns:
+        [M, M]
+    """
+    c = Cinv[:, m]
+    return Cinv - jnp.outer(c, c) / Cinv[m, m]
 
 
 def decide_outlier(y_star, mu_star, sigma_star, kappa=5., mode='clip'):
@@ -51,28 +109,298 @@ def decide_outlier(y_star, mu_star, sigma_star, kappa=5., mode='clip'):
         raise ValueError("Mode {} invalid.".format(mode))
 
 
-def leave_one_out_outlier_detection(K, Y_obs, uncert, kappa=6.):
-    C = K + jnp.diag(uncert ** 2)
-    Cinv = jnp.linalg.pinv(C)
+def inverse_covariance(K, uncert):
+    """
+    inv(K + diag(uncert**2)) computed stably via a Cholesky factorisation of the whitened covariance,
+        (K + sigma.sigma)^-1 = sigma^-1.(sigma^-1.K.sigma^-1 + I)^-1.sigma^-1
+    so that inf uncertainty gives zero rows/cols (i.e. the observable is removed). Uncertainties are floored at 1e-6,
+    as in the screen solvers, so that zero uncertainty doesn't divide by zero.
+    """
+    uncert = jnp.maximum(uncert, 1e-6)
+    C = K / (uncert[:, None] * uncert[None, :]) + jnp.eye(K.shape[0])
+    L = jnp.linalg.cholesky(C)
+    Linv = solve_triangular(L, jnp.eye(K.shape[0]), lower=True)
+    return (Linv.T @ Linv) / (uncert[:, None] * uncert[None, :])
+
+
+def leave_one_out_outlier_detection(K, Y_obs, uncert, kappa=6., max_outliers_per_iter=1):
+    """
+    Iteratively detect outliers with the leave-one-out predictive. Each pass removes up to `max_outliers_per_iter`
+    of the most significant outliers from the conditioning set with a batched rank-k downdate of the inverse
+    covariance, until no more outliers are found.
+
+    Args:
+        K: [M, M] covariance matrix
+        Y_obs: [M] observables, zero centred
+        uncert: [M] observational uncertainty, inf encodes a known outlier.
+        kappa: z-score threshold
+        max_outliers_per_iter: int, static, maximum outliers removed per pass.
+
+    Returns:
+        [M] bool outliers, not including the known (inf uncertainty) outliers.
+    """
+    K, Y_obs, uncert = jnp.asarray(K), jnp.asarray(Y_obs), jnp.asarray(uncert)
+    M = Y_obs.shape[0]
+    k = min(max_outliers_per_iter, M)
+    Cinv = inverse_covariance(K, uncert)
 
     def body(state):
-        (done, Y_obs, outliers) = state
-        mu_star, sigma_star = leave_one_out_predictive(K, Cinv, Y_obs)
-        metric, potential_outliers = decide_outlier(Y_obs, mu_star, sigma_star, kappa=kappa, mode='full')
+        (done, Cinv, outliers) = state
+        mu_star, sigma_star = leave_one_out_predictive(K, Cinv, Y_obs, uncert)
+        _, potential_outliers = decide_outlier(Y_obs, mu_star, sigma_star, kappa=kappa, mode='full')
+        potential_outliers = potential_outliers & ~outliers
         done = ~jnp.any(potential_outliers)
-        outlier = jnp.argmax(metric)
-        chosen_outlier = (jnp.arange(outliers.shape[0]) == outlier) & potential_outliers[outlier]
-        outliers = chosen_outlier | outliers
-        Y_obs = jnp.where(chosen_outlier, mu_star, Y_obs)
-        return (done, Y_obs, outliers)
-
-    init_outliers = jnp.zeros(Y_obs.shape[0], dtype=jnp.bool_)
+        # rank by z-score, since the 'full' probability saturates at 1 for all strong outliers
+        z = jnp.abs(Y_obs - mu_star) / sigma_star
+        _, chosen = top_k(jnp.where(potential_outliers, z, -jnp.inf), k)
+
+        def downdate(Cinv, chosen):
+            # re-check each candidate against the already downdated inverse, which is O(M) per candidate, so that
+            # neighbours of a stronger outlier in the same batch aren't removed along with it.
+            (m, is_candidate) = chosen
+            diag = Cinv[m, m]
+            removed = diag <= 0.
+            diag = jnp.where(removed, 1., diag)
+            mu_star = Y_obs[m] - (Cinv[m] @ Y_obs) / diag
+            sigma_star = jnp.sqrt(jnp.maximum(1. / diag - uncert[m] ** 2, 0.))
+            _, still_outlier = decide_outlier(Y_obs[m], mu_star, sigma_star, kappa=kappa, mode='full')
+            is_outlier = is_candidate & still_outlier & ~removed
+            return jnp.where(is_outlier, downdate_inverse(Cinv, m), Cinv), is_outlier
+
+        Cinv, chosen_outliers = scan(downdate, Cinv, (chosen, potential_outliers[chosen]))
+        outliers = outliers.at[chosen].set(outliers[chosen] | chosen_outliers)
+        # if the re-check rejects every candidate (e.g. rounding at the threshold) nothing changes, so stop
+        done = done | ~jnp.any(chosen_outliers)
+        return (done, Cinv, outliers)
+
+    init_outliers = jnp.zeros(M, dtype=jnp.bool_)
     (done, _, outliers) = while_loop(lambda state: ~state[0],
                                      body,
-                                     (jnp.array(False), Y_obs, init_outliers))
+                                     (jnp.array(False), Cinv, init_outliers))
     return outliers
 
 
+def test_leave_one_out_outlier_detection():
+    rng = np.random.RandomState(0)
+    X = np.stack(np.meshgrid(np.linspace(0., 1., 6), np.linspace(0., 1., 6), indexing='ij'), axis=-1).reshape((-1, 2))
+    M = X.shape[0]
+    K = np.exp(-0.5 * np.sum((X[:, None, :] - X[None, :, :]) ** 2, axis=-1) / 0.3 ** 2)
+    L = np.linalg.cholesky(K + 1e-6 * np.eye(M))
+    uncert = 0.05 * np.ones(M)
+    Y_obs = L @ rng.normal(size=M) + uncert * rng.normal(size=M)
+    Y_obs[[3, 17, 30]] += 3.
+    for max_outliers_per_iter in [1, 3]:
+        outliers = leave_one_out_outlier_detection(K, Y_obs, uncert, max_outliers_per_iter=max_outliers_per_iter)
+        assert np.all(np.where(outliers)[0] == [3, 17, 30])
+    uncert[5] = np.inf
+    outliers = leave_one_out_outlier_detection(K, Y_obs, uncert)
+    assert np.all(np.where(outliers)[0] == [3, 17, 30])
+    # zero uncertainty is floored rather than dividing by zero
+    uncert[7] = 0.
+    outliers = leave_one_out_outlier_detection(K, Y_obs, uncert)
+    assert np.all(np.where(outliers)[0] == [3, 17, 30])
+
+
+def _shared_loo_predictive(Q, lam, sigma2, Y_obs, slot_idx, slot_dinv, slot_used):
+    """
+    Leave-one-out predictive of one column, given the eigendecomposition K = Q.diag(lam).Q^T shared by all columns.
+
+    The column's covariance is K + sigma2 * I plus diagonal corrections d_s on a small set of slots S, so by Woodbury
+        Cinv = C0inv - C0inv[:, S].(diag(1/d_S) + C0inv[S, S])^-1.C0inv[S, :],   C0inv = Q.diag(1/(lam + sigma2)).Q^T
+    and only diag(Cinv) and Cinv.Y_obs are needed, at O(M^2 |S|) cost. A slot with 1/d = 0 removes the observable.
+
+    Args:
+        Q: [M, M] eigenvectors of K
+        lam: [M] eigenvalues of K
+        sigma2: base noise variance of the column
+        Y_obs: [M]
+        slot_idx: [R] indices of the corrected observables
+        slot_dinv: [R] 1/d of the corrections
+        slot_used: [R] bool, which slots are in use
+
+    Returns:
+        [M] mu_star
+        [M] sigma_star, inf for removed observables
+    """
+    M = Y_obs.shape[0]
+    Qg = Q / (lam + sigma2)
+    diag = jnp.sum(Q * Qg, axis=1)
+    alpha = Qg @ (Q.T @ Y_obs)
+    # C0inv[:, S]
+    B = jnp.where(slot_used[None, :], Qg @ Q[slot_idx].T, 0.)
+    W = jnp.where(slot_used[:, None] & slot_used[None, :], B[slot_idx], 0.) \
+        + jnp.diag(jnp.where(slot_used, slot_dinv, 1.))
+    WinvBT = jnp.linalg.solve(W, B.T)
+    diag = diag - jnp.sum(B * WinvBT.T, axis=1)
+    alpha = alpha - WinvBT.T @ alpha[slot_idx]
+    removed = jnp.zeros(M, dtype=jnp.bool_).at[slot_idx].max(slot_used & (slot_dinv == 0.))
+    # effective noise of each observable
+    d = jnp.zeros(M).at[slot_idx].add(jnp.where(slot_used & (slot_dinv != 0.), 1. / jnp.where(slot_dinv == 0., 1., slot_dinv), 0.))
+    uncert2 = sigma2 + d
+    diag = jnp.where(removed, 1., diag)
+    mu_star = jnp.where(removed, Y_obs, Y_obs - alpha / diag)
+    sigma_star = jnp.where(removed, jnp.inf, jnp.sqrt(jnp.maximum(1. / diag - uncert2, 0.)))
+    return mu_star, sigma_star
+
+
+def batched_leave_one_out_outlier_detection(K, Y_obs, uncert, kappa=6., rtol=0.25, max_rank=8, max_outliers=8,
+                                            column_chunksize=4096):
+    """
+    Leave-one-out outlier detection for many data columns sharing the same prior covariance, e.g. all antennas and
+    times of the screen stage.
+
+    K is eigendecomposed once. Each column uses its median noise variance as a base level, which is O(M^2) per column
+    in the shared eigenbasis. Heteroscedastic noise (observables whose variance deviates by more than `rtol` from the
+    base), known outliers (inf uncertainty) and detected outliers are handled with a Woodbury correction of rank at
+    most `max_rank + max_outliers`. If more than `max_rank` observables of a column deviate, the largest deviations are
+    corrected and the rest take the base noise level, so `max_rank` should exceed the number of known outliers per
+    column. Outliers are removed one per pass, as in
+    leave_one_out_outlier_detection, up to `max_outliers` per column.
+
+    Args:
+        K: [M, M] covariance matrix
+        Y_obs: [M, T] observables, zero centred, one column per (antenna, time)
+        uncert: [M, T] observational uncertainty, inf encodes a known outlier.
+        kappa: z-score threshold
+        rtol: relative deviation of noise variance from the column's base level above which it is corrected.
+        max_rank: int, maximum number of noise corrections per column.
+        max_outliers: int, maximum number of outliers detected per column.
+        column_chunksize: int, number of columns processed at once, bounding memory.
+
+    Returns:
+        [M, T] bool outliers, not including the known (inf uncertainty) outliers.
+    """
+    K = jnp.asarray(K)
+    M = K.shape[0]
+    lam, Q = jnp.linalg.eigh(K)
+    lam = jnp.maximum(lam, 0.)
+    max_rank = min(max_rank, M)
+    R = max_rank + max_outliers
+
+    def single_column(Y_obs, uncert):
+        known_outliers = jnp.isinf(uncert)
+        uncert2 = uncert ** 2
+        sigma2 = jnp.nanmedian(jnp.where(known_outliers, jnp.nan, uncert2))
+        sigma2 = jnp.where(jnp.isnan(sigma2), 1., sigma2)
+        deviation = jnp.where(known_outliers, jnp.inf, jnp.abs(uncert2 / sigma2 - 1.))
+        score, noise_idx = top_k(deviation, max_rank)
+        noise_used = score > rtol
+        noise_dinv = jnp.where(known_outliers[noise_idx], 0., 1. / jnp.where(noise_used, uncert2[noise_idx] - sigma2, 1.))
+        slot_idx = jnp.concatenate([noise_idx, jnp.zeros(max_outliers, noise_idx.dtype)])
+        slot_dinv = jnp.concatenate([noise_dinv, jnp.zeros(max_outliers)])
+        slot_used = jnp.concatenate([noise_used, jnp.zeros(max_outliers, jnp.bool_)])
+
+        def body(state):
+            (done, num_outliers, slot_idx, slot_used, outliers, slot_dinv) = state
+            mu_star, sigma_star = _shared_loo_predictive(Q, lam, sigma2, Y_obs, slot_idx, slot_dinv, slot_used)
+            _, potential_outliers = decide_outlier(Y_obs, mu_star, sigma_star, kappa=kappa, mode='full')
+            potential_outliers = potential_outliers & ~outliers
+            z = jnp.abs(Y_obs - mu_star) / sigma_star
+            outlier = jnp.argmax(jnp.where(potential_outliers, z, -jnp.inf))
+            found = potential_outliers[outlier]
+            # an outlier with a noise slot is removed in place, otherwise it takes the next free outlier slot
+            in_noise_slot = slot_used & (slot_idx == outlier)
+            slot = jnp.where(jnp.any(in_noise_slot), jnp.argmax(in_noise_slot), max_rank + num_outliers)
+            slot_idx = jnp.where(found, slot_idx.at[slot].set(outlier.astype(slot_idx.dtype)), slot_idx)
+            slot_used = jnp.where(found, slot_used.at[slot].set(True), slot_used)
+            slot_dinv = jnp.where(found, slot_dinv.at[slot].set(0.), slot_dinv)
+            outliers = outliers.at[outlier].set(outliers[outlier] | found)
+            num_outliers = num_outliers + found
+            done = ~found | (num_outliers >= max_outliers)
+            return (done, num_outliers, slot_idx, slot_used, outliers, slot_dinv)
+
+        init_outliers = jnp.zeros(M, dtype=jnp.bool_)
+        (_, _, _, _, outliers, _) = while_loop(lambda state: ~state[0],
+                                               body,
+                                               (jnp.asarray(max_outliers == 0), jnp.asarray(0), slot_idx, slot_used,
+                                                init_outliers, slot_dinv))
+        return outliers
+
+    run = jit(vmap(single_column, in_axes=(1, 1), out_axes=1))
+    Y_obs = np.asarray(Y_obs)
+    uncert = np.asarray(uncert)
+    T = Y_obs.shape[1]
+    outliers = []
+    for start in range(0, T, column_chunksize):
+        stop = min(start + column_chunksize, T)
+        # pad the last chunk so only one shape is compiled
+        pad = column_chunksize - (stop - start) if T > column_chunksize else 0
+        _Y_obs = np.pad(Y_obs[:, start:stop], [(0, 0), (0, pad)], mode='edge')
+        _uncert = np.pad(uncert[:, start:stop], [(0, 0), (0, pad)], mode='edge')
+        outliers.append(np.asarray(run(_Y_obs, _uncert))[:, :stop - start])
+    return np.concatenate(outliers, axis=1)
+
+
+def test_batched_leave_one_out_outlier_detection():
+    rng = np.random.RandomState(0)
+    X = np.stack(np.meshgrid(np.linspace(0., 1., 6), np.linspace(0., 1., 6), indexing='ij'), axis=-1).reshape((-1, 2))
+    M = X.shape[0]
+    T = 10
+    K = np.exp(-0.5 * np.sum((X[:, None, :] - X[None, :, :]) ** 2, axis=-1) / 0.3 ** 2)
+    L = np.linalg.cholesky(K + 1e-6 * np.eye(M))
+    uncert = 0.05 * np.ones((M, T))
+    # heteroscedastic columns
+    uncert[:, 5:] *= rng.uniform(0.5, 2., size=(M, T - 5))
+    uncert[7, 3] = np.inf
+    Y_obs = L @ rng.normal(size=(M, T)) + np.where(np.isinf(uncert), 0., uncert) * rng.normal(size=(M, T))
+    Y_obs[[3, 17, 30], :] += 3.
+    outliers = batched_leave_one_out_outlier_detection(K, Y_obs, uncert, max_rank=M, column_chunksize=4)
+    for t in range(T):
+        assert np.all(outliers[:, t] == leave_one_out_outlier_detection(K, Y_obs[:, t], uncert[:, t]))
+
+
+class GPPredictor(object):
+    def __init__(self, K, uncert):
+        """
+        Predictive GP conditioned on observations with uncertainty `uncert`, factored once so that many observation
+        vectors sharing the same K and uncertainty pattern can be predicted with triangular solves.
+
+        With W = diag(1/uncert), zero for outliers (inf uncertainty), the predictive is
+            mu_star = K.W.(W.K.W + I)^-1.W.Y_obs
+            sigma2_star = diag(K) - sum_j [L^-1.W.K]_ji^2,    L.L^T = W.K.W + I
+        so outliers are masked out rather than relying on inf arithmetic.
+
+        Args:
+            K: [N,N]
+            uncert: [N] outliers encoded with inf
+        """
+        self.K = jnp.asarray(K)
+        uncert = jnp.asarray(uncert)
+        self.mask = jnp.isfinite(uncert)
+        self.w = jnp.where(self.mask, 1. / jnp.where(self.mask, uncert, 1.), 0.)
+        C = self.w[:, None] * self.K * self.w[None, :] + jnp.eye(self.K.shape[0])
+        self.L = jnp.linalg.cholesky(C)
+        # [N, N] L^-1.W.K
+        self._V = solve_triangular(self.L, self.w[:, None] * self.K, lower=True)
+
+    def predict_mean(self, Y_obs):
+        """
+        Args:
+            Y_obs: [..., N] batch of observations, values with infinite uncertainty are ignored (can be nan).
+
+        Returns:
+            mu_star [..., N]
+        """
+        Y_obs = jnp.asarray(Y_obs)
+        batch_shape = Y_obs.shape[:-1]
+        # [N, B]
+        wY = jnp.where(self.mask, Y_obs * self.w, 0.).reshape((-1, Y_obs.shape[-1])).T
+        alpha = solve_triangular(self.L, wY, lower=True)
+        # K.W.L^-T.L^-1.W.Y = V^T.L^-1.W.Y
+        mu_star = self._V.T @ alpha
+        return mu_star.T.reshape(batch_shape + (-1,))
+
+    def predict_variance(self):
+        """
+        Returns:
+            sigma2_star [N] diagonal predictive variance, independent of the observations.
+        """
+        return jnp.diag(self.K) - jnp.sum(self._V ** 2, axis=0)
+
+    def __call__(self, Y_obs):
+        return self.predict_mean(Y_obs), self.predict_variance()
+
+
 def predict_f(Y_obs, K, uncert):
     """
     Predictive mu and sigma with outliers removed.
@@ -86,12 +414,36 @@ def predict_f(Y_obs, K, uncert):
         mu [N]
         sigma [N]
     """
-    # (K + sigma.sigma)^-1 = sigma^-1.(sigma^-1.K.sigma^-1 + I)^-1.sigma^-1
-    C = K / (uncert[:, None] * uncert[None, :]) + jnp.eye(K.shape[0])
-    JT = jnp.linalg.solve(C, K / uncert[:, None])
-    mu_star = JT.T @ (Y_obs / uncert)
-    sigma2_star = jnp.diag(K - JT.T @ (K / uncert[:, None]))
-    return mu_star, sigma2_star
+    return GPPredictor(K, uncert)(Y_obs)
+
+
+def test_gp_predictor():
+    np.random.seed(0)
+    N = 30
+    x = np.random.uniform(size=(N, 2))
+    K = jnp.asarray(np.exp(-0.5 * np.sum((x[:, None, :] - x[None, :, :]) ** 2, axis=-1) / 0.3 ** 2))
+    uncert = jnp.asarray(np.random.uniform(0.05, 0.2, size=N))
+    uncert = uncert.at[jnp.asarray([4, 11])].set(jnp.inf)
+    Y_obs = jnp.asarray(np.random.normal(size=(3, N)))
+
+    def reference(Y_obs, K, uncert):
+        C = K / (uncert[:, None] * uncert[None, :]) + jnp.eye(K.shape[0])
+        JT = jnp.linalg.solve(C, K / uncert[:, None])
+        mu_star = JT.T @ (Y_obs / uncert)
+        sigma2_star = jnp.diag(K - JT.T @ (K / uncert[:, None]))
+        return mu_star, sigma2_star
+
+    predictor = GPPredictor(K, uncert)
+    mu_star = predictor.predict_mean(Y_obs)
+    sigma2_star = predictor.predict_variance()
+    for b in range(3):
+        mu_ref, sigma2_ref = reference(Y_obs[b], K, uncert)
+        assert jnp.allclose(mu_star[b], mu_ref, atol=1e-6)
+        assert jnp.allclose(sigma2_star, sigma2_ref, atol=1e-6)
+    # outlier values don't matter, even if nan
+    assert jnp.allclose(predictor.predict_mean(Y_obs.at[:, 4].set(jnp.nan)), mu_star)
+    mu, sigma2 = predict_f(Y_obs[0], K, uncert)
+    assert jnp.allclose(mu, mu_star[0]) and jnp.allclose(sigma2, sigma2_star)
 
 
 def single_detect_outliers(sequence, window, init_outliers=None):
@@ -143,9 +495,139 @@ def detect_dphase_outliers(dphase):
     return outliers
 
 
+def robust_detect_outliers(sequence, window=15, threshold=5., init_outliers=None, num_iters=2):
+    """
+    Detect outliers with a rolling median/MAD, which unlike the windowed mean isn't dragged by the outliers themselves.
+    The scale is the rolling median of absolute residuals about the rolling median (scaled by 1.4826 to be a standard
+    deviation for Gaussian noise), so the threshold adapts to local noise levels.
+
+    Args:
+        sequence: [..., M] sequences to look for outliers in
+        window: int, window size
+        threshold: float, outliers are more than `threshold` robust standard deviations from the rolling median
+        init_outliers: [..., M] bool, optional points that are already flagged, and ignored in the statistics
+        num_iters: int, number of times to re-estimate with detected outliers removed
+
+    Returns:
+        outliers [..., M]
+    """
+    sequence = np.asarray(sequence)
+    if init_outliers is None:
+        init_outliers = np.zeros(sequence.shape, dtype=np.bool_)
+    init_outliers = np.asarray(init_outliers) | np.isnan(sequence)
+    outliers = init_outliers
+    for _ in range(num_iters):
+        _sequence = np.where(outliers, np.nan, sequence)
+        median = rolling_median(_sequence, window)
+        residual = np.abs(sequence - median)
+        scale = 1.4826 * rolling_median(np.where(outliers, np.nan, residual), window)
+        with np.errstate(invalid='ignore'):
+            outliers = init_outliers | (residual > threshold * scale)
+    return outliers
+
+
+def test_robust_detect_outliers():
+    np.random.seed(0)
+    sequence = np.random.normal(size=(5, 200)) * np.linspace(0.1, 1., 5)[:, None]
+    true_outliers = np.zeros(sequence.shape, dtype=np.bool_)
+    true_outliers[:, 10::23] = True
+    sequence = np.where(true_outliers, 10., sequence)
+    outliers = robust_detect_outliers(sequence, window=15, threshold=5.)
+    assert np.all(outliers[true_outliers])
+    assert outliers[~true_outliers].mean() < 0.01
+
+
+def stream_detect_dphase_outliers(read_dphase, write_outliers, Nd, Na, ant_chunksize=8, window=15, threshold=5.,
+                                  rms=None):
+    """
+    Detect outliers in dphase one (direction, antenna chunk) at a time, so that memory use is independent of Nd*Na.
+    Data is pulled and flags pushed through callbacks, so the source can be an h5parm selection, a memmap, etc.
+
+    Args:
+        read_dphase: callable(dir_idx, ant_slice) -> [n_ant, Nf, Nt] dphase
+        write_outliers: callable(dir_idx, ant_slice, outliers[n_ant, Nf, Nt])
+        Nd: int, number of directions
+        Na: int, number of antennas
+        ant_chunksize: int, number of antennas processed at once
+        window: int, window size in time
+        threshold: float, see robust_detect_outliers
+        rms: float, global rms of dphase for the initial clip, or None to compute it with an extra pass over the data
+
+    Returns:
+        total number of outliers
+    """
+    chunks = [(d, slice(start, min(start + ant_chunksize, Na)))
+              for d in range(Nd) for start in range(0, Na, ant_chunksize)]
+    if rms is None:
+        sum_sq, count = 0., 0
+        for d, ant_slice in chunks:
+            chunk = np.asarray(read_dphase(d, ant_slice))
+            sum_sq += np.nansum(chunk ** 2)
+            count += np.sum(np.isfinite(chunk))
+        rms = np.sqrt(sum_sq / max(count, 1))
+    num_outliers = 0
+    num_samples = 0
+    t0 = default_timer()
+    for i, (d, ant_slice) in enumerate(chunks):
+        chunk = np.asarray(read_dphase(d, ant_slice))
+        init_outliers = (np.abs(chunk) > 1.) | (np.abs(chunk) > 5. * rms)
+        outliers = robust_detect_outliers(chunk, window=window, threshold=threshold, init_outliers=init_outliers)
+        write_outliers(d, ant_slice, outliers)
+        num_outliers += outliers.sum()
+        num_samples += outliers.size
+        dt = default_timer() - t0
+        logger.info("Chunk {}/{} (dir {}, ant {}:{}): {:.2f} Msamples/s".format(
+            i + 1, len(chunks), d, ant_slice.start, ant_slice.stop, num_samples / max(dt, 1e-9) / 1e6))
+    logger.info("Found {} dphase outliers out of {} in {:.1f} seconds.".format(num_outliers, num_samples,
+                                                                               default_timer() - t0))
+    return num_outliers
+
+
+def robust_detect_dphase_outliers(dphase, window=15, threshold=5., ant_chunksize=8, out=None):
+    """
+    Detect outliers in dphase with a rolling median/MAD, streaming over (direction, antenna) chunks so that `dphase`
+    can be a memory-mapped array (e.g. np.load(..., mmap_mode='r')) covering a full observation.
+
+    Args:
+        dphase: [Nd, Na, Nf, Nt] array-like
+        window: int, window size in time
+        threshold: float, see robust_detect_outliers
+        ant_chunksize: int, number of antennas loaded at once
+        out: optional [Nd, Na, Nf, Nt] bool array (e.g. a writable memmap) to store outliers in
+
+    Returns:
+        outliers [Nd, Na, Nf, Nt]
+    """
+    Nd, Na, Nf, Nt = dphase.shape
+    if out is None:
+        out = np.zeros((Nd, Na, Nf, Nt), dtype=np.bool_)
+
+    def write_outliers(d, ant_slice, outliers):
+        out[d, ant_slice] = outliers
+
+    stream_detect_dphase_outliers(lambda d, ant_slice: dphase[d, ant_slice], write_outliers, Nd, Na,
+                                  ant_chunksize=ant_chunksize, window=window, threshold=threshold)
+    return out
+
+
+def test_robust_detect_dphase_outliers(tmp_path):
+    np.random.seed(1)
+    dphase = 0.05 * np.random.normal(size=(3, 4, 2, 300))
+    dphase[..., 17::31] += 0.8
+    np.save(str(tmp_path / 'dphase.npy'), dphase)
+    dphase = np.load(str(tmp_path / 'dphase.npy'), mmap_mode='r')
+    out = np.lib.format.open_memmap(str(tmp_path / 'outliers.npy'), mode='w+', dtype=np.bool_, shape=dphase.shape)
+    outliers = robust_detect_dphase_outliers(dphase, ant_chunksize=3, out=out)
+    assert outliers is out
+    assert np.all(outliers == robust_detect_dphase_outliers(np.asarray(dphase), ant_chunksize=4))
+    assert np.all(outliers[..., 17::31])
+    assert outliers.mean() < 0.05
+
+
 def detect_tec_outliers(times, tec_mean, tec_std):
     """
-    Detect outliers in dphase (in batch)
+    Detect outliers in tec (in batch), with all series filtered at once.
+
     Args:
         tec: [Nd, Na, Nt] tec uncert
         times: [Nt]
@@ -157,9 +639,7 @@ def detect_tec_outliers(times, tec_mean, tec_std):
     Nd, Na, Nt = tec_mean.shape
     tec_mean = tec_mean.reshape((Nd * Na, Nt))
     tec_std = tec_std.reshape((Nd * Na, Nt))
-    res = chunked_pmap(
-        lambda tec_mean, tec_std: single_detect_tec_outliers(times, tec_mean, tec_std), tec_mean, tec_std,
-        chunksize=None)
+    res = jit(single_detect_tec_outliers)(times, tec_mean, tec_std)
     res = tree_map(lambda x:x.reshape((Nd, Na, Nt)), res)
     return res
 
@@ -170,34 +650,122 @@ def predict(t, f, t2):
     # print(t, t2, f, coeffs, deg)
     return sum([p * t2 ** (deg - i) for i, p in enumerate(coeffs)])
 
+
+def extrapolation_weights(times, window):
+    """
+    Weights such that the degree `window-1` polynomial through the previous `window` points, evaluated at times[i], is
+        sum_j weights[i, j] * y[i - window + j]
+    These are the Lagrange basis polynomials, so only depend on the time offsets. Rows i < window are unused.
+    For window=1 this is exactly the previous point; for larger windows the prediction equals the polyfit
+    extrapolation only up to rounding, since the evaluation order differs. Where the previous points have
+    duplicate timestamps the polynomial is undefined, and the previous point is used instead.
+
+    Args:
+        times: [N]
+        window: int
+
+    Returns:
+        [N, window]
+    """
+    N = times.shape[0]
+    i = jnp.arange(N)
+    # [N, window]
+    idx = jnp.clip(i[:, None] - window + jnp.arange(window), 0, N - 1)
+    _times = times[idx] - times[idx[:, :1]]
+    t2 = times[:, None] - times[idx[:, :1]]
+    degenerate = jnp.zeros(N, dtype=jnp.bool_)
+    weights = []
+    for j in range(window):
+        w = jnp.ones(N)
+        for k in range(window):
+            if k == j:
+                continue
+            denom = _times[:, j] - _times[:, k]
+            degenerate = degenerate | (denom == 0.)
+            w = w * (t2[:, 0] - _times[:, k]) / jnp.where(denom == 0., 1., denom)
+        weights.append(w)
+    weights = jnp.stack(weights, axis=1)
+    previous = jnp.zeros(window).at[-1].set(1.)
+    return jnp.where(degenerate[:, None], previous, weights)
+
+
 def filter(times, tec_mean, window=1):
-    def _slice(y, i):
-        res = []
-        for j in range(0, window):
-            # [i-window, ..., i-window +window-1]
-            # [i-window,..., i-1]
-            offset = j - window
-            res.append(y[i + offset])
-        return jnp.stack(res, axis=0)
-
-    def filter_body(state):
-        (i, mod_tec_mean) = state
-        _times = _slice(times, i)
-        _tec_mean = _slice(mod_tec_mean, i)
-        y = predict(_times-_times[0], _tec_mean, times[i]-_times[0])
-        y = jnp.where(jnp.abs(y - tec_mean[i]) > 50., y, tec_mean[i])
-        y = jnp.where(jnp.abs(y) < jnp.abs(tec_mean[i]), y, tec_mean[i])
-        mod_tec_mean = mod_tec_mean.at[i].set(y)# - tec_mean[i]
-        return (i + 1, mod_tec_mean)
-
-    _, tec_mean = while_loop(lambda s: s[0] < times.size,
-                             filter_body,
-                             (jnp.asarray(window), tec_mean))
-    return tec_mean
+    """
+    Forward outlier filter. Each point is predicted from the previous `window` (already filtered) points by polynomial
+    extrapolation, and replaced with the prediction if it's more than 50 away and the prediction is smaller in
+    magnitude. Bit-identical to the polyfit implementation for window=1, equal up to rounding for larger windows
+    (see extrapolation_weights).
+
+    Args:
+        times: [N]
+        tec_mean: [..., N] any number of series
+
+    Returns:
+        [..., N] filtered series
+    """
+    N = times.shape[0]
+    if N <= window:
+        return tec_mean
+    weights = extrapolation_weights(times, window)
+    tec_mean = jnp.moveaxis(tec_mean, -1, 0)
+
+    def filter_body(prev, X):
+        (weights, tec_mean) = X
+        if window == 1:
+            y = prev[0]
+        else:
+            y = sum([weights[j] * prev[j] for j in range(window)])
+        y = jnp.where(jnp.abs(y - tec_mean) > 50., y, tec_mean)
+        y = jnp.where(jnp.abs(y) < jnp.abs(tec_mean), y, tec_mean)
+        prev = jnp.concatenate([prev[1:], y[None]], axis=0)
+        return prev, y
+
+    _, y = scan(filter_body, tec_mean[:window], (weights[window:], tec_mean[window:]))
+    return jnp.moveaxis(jnp.concatenate([tec_mean[:window], y], axis=0), 0, -1)
+
+
+def test_filter():
+    times = jnp.cumsum(jnp.asarray(np.random.uniform(25., 35., size=40)))
+    tec_mean = jnp.asarray(np.cumsum(np.random.normal(scale=10., size=(3, 40)), axis=-1))
+    tec_mean = tec_mean.at[:, [5, 20, 21]].add(300.)
+
+    def reference(times, tec_mean, window):
+        tec_mean = np.asarray(tec_mean)
+        mod_tec_mean = tec_mean.copy()
+        for i in range(window, times.size):
+            _times = times[i - window:i]
+            y = predict(_times - _times[0], jnp.asarray(mod_tec_mean[i - window:i]), times[i] - _times[0])
+            y = jnp.where(jnp.abs(y - tec_mean[i]) > 50., y, tec_mean[i])
+            y = jnp.where(jnp.abs(y) < jnp.abs(tec_mean[i]), y, tec_mean[i])
+            mod_tec_mean[i] = y
+        return mod_tec_mean
+
+    y = filter(times, tec_mean, window=1)
+    for b in range(3):
+        assert jnp.all(y[b] == reference(times, tec_mean[b], 1))
+    y = filter(times, tec_mean, window=2)
+    for b in range(3):
+        assert jnp.allclose(y[b], reference(times, tec_mean[b], 2))
+    # duplicate timestamps fall back to the previous point rather than dividing by zero
+    times = times.at[10].set(times[9])
+    weights = extrapolation_weights(times, 2)
+    assert jnp.all(jnp.isfinite(weights))
+    assert jnp.all(weights[11] == jnp.asarray([0., 1.]))
+    assert jnp.all(jnp.isfinite(filter(times, tec_mean, window=2)))
 
 
 def single_detect_tec_outliers(times, tec_mean, tec_std, window=1):
+    """
+    Args:
+        times: [Nt]
+        tec_mean: [..., Nt]
+        tec_std: [..., Nt]
+
+    Returns:
+        filtered tec_mean [..., Nt]
+        outliers [..., Nt]
+    """
     y = filter(times, tec_mean, window=window)
-    y = filter(times[::-1], y[::-1], window=window)[::-1]
+    y = filter(times[::-1], y[..., ::-1], window=window)[..., ::-1]
     outliers = (jnp.abs(tec_mean - y) > 1e-5) | (tec_std > 30.)
     return y, outliers
@@ -1,18 +1,26 @@
+from collections import namedtuple
 from astropy import coordinates as ac, units as au
-from jax import numpy as jnp, jit, random, vmap
-from jax._src.scipy.linalg import solve_triangular
+from jax import numpy as jnp, jit, random, vmap, value_and_grad, hessian
+from jax.lax import map as lax_map, scan, cond
+from jax.scipy.special import logsumexp
+from jax.scipy.sparse.linalg import cg
+from jax._src.scipy.linalg import solve_triangular, cho_solve
+import numpy as np
 from timeit import default_timer
 from bayes_gain_screens.frames import ENU
 from bayes_gain_screens.tomographic_kernel import TomographicKernel
-from bayes_gain_screens.utils import make_coord_array, axes_move, build_lookup_index
+from bayes_gain_screens.utils import make_coord_array, axes_move, build_lookup_index, ArrayCache
 from bayes_gain_screens.plotting import plot_vornoi_map
 from h5parm import DataPack
 from jaxns import NestedSampler, plot_diagnostics, plot_cornerplot
 from jaxns.gaussian_process import RBF, M32, M12, M52
-from jaxns.prior_transforms import UniformPrior, PriorChain, DeltaPrior
-from jaxns.utils import chunked_pmap, marginalise_static, summary
+from jaxns.prior_transforms import UniformPrior, PriorChain
+from jaxns.utils import chunked_pmap, summary
 from jax.scipy.ndimage import map_coordinates
 import pylab as plt
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def log_normal_with_outliers(x, mean, cov, sigma):
@@ -40,6 +48,111 @@ def log_normal_with_outliers(x, mean, cov, sigma):
     return log_likelihood
 
 
+def _homoscedastic_columns(dtec_uncert):
+    """
+    Columns whose observational uncertainties are all finite and equal, so that the noise is a multiple of the
+    identity and the eigenbasis of K can be shared. Evaluated on concrete values.
+
+    Args:
+        dtec_uncert: [M, N]
+
+    Returns:
+        [M] bool
+    """
+    dtec_uncert = np.asarray(dtec_uncert)
+    return np.all(np.isfinite(dtec_uncert), axis=1) & np.all(dtec_uncert == dtec_uncert[:, :1], axis=1)
+
+
+def batched_log_normal_with_outliers(K, sigma_array, dtec, dtec_uncert, homoscedastic=None, column_chunksize=1024):
+    """
+    log_normal_with_outliers(dtec[m], 0., sigma**2 * K, dtec_uncert[m]) for every sigma in `sigma_array` and every data
+    column m, without a factorisation per (sigma, m).
+
+    With W = diag(1/dtec_uncert) (zero for outliers) and W.K.W = V.diag(mu).V^T, the whitened covariance is
+    sigma^2 W.K.W + I = V.diag(sigma^2 mu + 1).V^T, so one eigendecomposition per column serves the whole sigma grid.
+    For homoscedastic columns (equal, finite uncertainties) mu = lambda / uncert^2 where K = Q.diag(lambda).Q^T,
+    and a single eigendecomposition of K serves all of them.
+
+    Args:
+        K: [N, N] covariance with unit variance
+        sigma_array: [Ns]
+        dtec: [M, N]
+        dtec_uncert: [M, N] inf encodes an outlier
+        homoscedastic: optional [M] bool, see _homoscedastic_columns. Computed from `dtec_uncert` if None.
+        column_chunksize: int, number of heteroscedastic columns decomposed at once, bounds memory.
+
+    Returns:
+        [Ns, M] log-likelihoods
+    """
+    if homoscedastic is None:
+        homoscedastic = _homoscedastic_columns(dtec_uncert)
+    homoscedastic = np.asarray(homoscedastic)
+    M, N = dtec.shape
+    finite = jnp.isfinite(dtec_uncert)
+    w = jnp.where(finite, 1. / jnp.where(finite, dtec_uncert, 1.), 0.)
+    # [M]
+    n_obs = jnp.sum(finite, axis=1)
+    log_det_uncert = -jnp.sum(jnp.where(finite, jnp.log(w), 0.), axis=1)
+
+    # [M, N] eigenvalues of W.K.W, and whitened data projected on the eigenbasis
+    mu = jnp.zeros((M, N))
+    proj = jnp.zeros((M, N))
+    shared = np.where(homoscedastic)[0]
+    general = np.where(~homoscedastic)[0]
+    if shared.size > 0:
+        lam, Q = jnp.linalg.eigh(K)
+        w_shared = w[shared, :1]
+        mu = mu.at[shared].set(lam[None, :] * w_shared ** 2)
+        proj = proj.at[shared].set((dtec[shared] * w_shared) @ Q)
+    if general.size > 0:
+        def _eigh(w, wY):
+            lam, V = jnp.linalg.eigh(w[:, None] * K * w[None, :])
+            return lam, wY @ V
+
+        chunksize = min(column_chunksize, general.size)
+        num_chunks = -(-general.size // chunksize)
+        # pad with repeats of the last column, dropped below
+        padded = np.concatenate([general, np.full(num_chunks * chunksize - general.size, general[-1])])
+        wY = jnp.where(finite[padded], dtec[padded] * w[padded], 0.)
+        lam, _proj = lax_map(lambda args: vmap(_eigh)(*args),
+                             (w[padded].reshape((num_chunks, chunksize, N)), wY.reshape((num_chunks, chunksize, N))))
+        mu = mu.at[general].set(lam.reshape((-1, N))[:general.size])
+        proj = proj.at[general].set(_proj.reshape((-1, N))[:general.size])
+    mu = jnp.maximum(mu, 0.)
+
+    def _compute_with_sigma(sigma):
+        # [M, N]
+        scale = sigma ** 2 * mu + 1.
+        log_det = log_det_uncert + 0.5 * jnp.sum(jnp.log(scale), axis=1)
+        maha = jnp.sum(proj ** 2 / scale, axis=1)
+        return -0.5 * n_obs * jnp.log(2. * jnp.pi) - log_det - 0.5 * maha
+
+    # sequential over sigma so only one [M, N] intermediate is live
+    return lax_map(_compute_with_sigma, sigma_array)
+
+
+def test_batched_log_normal_with_outliers():
+    np.random.seed(0)
+    N, M = 12, 6
+    x = np.random.uniform(size=(N, 2))
+    K = jnp.asarray(np.exp(-0.5 * np.sum((x[:, None, :] - x[None, :, :]) ** 2, axis=-1) / 0.5 ** 2))
+    sigma_array = jnp.linspace(0.1, 3., 7)
+    dtec = jnp.asarray(np.random.normal(size=(M, N)))
+    dtec_uncert = np.random.uniform(0.1, 0.5, size=(M, N))
+    dtec_uncert[:3] = 0.2
+    dtec_uncert[1, 4] = np.inf
+    dtec_uncert[4, [2, 7]] = np.inf
+    dtec_uncert = jnp.asarray(dtec_uncert)
+    assert np.all(_homoscedastic_columns(dtec_uncert) == np.array([True, False, True, False, False, False]))
+    log_prob = batched_log_normal_with_outliers(K, sigma_array, dtec, dtec_uncert)
+    assert jnp.allclose(log_prob, batched_log_normal_with_outliers(K, sigma_array, dtec, dtec_uncert,
+                                                                   column_chunksize=2))
+    for i, sigma in enumerate(sigma_array):
+        for m in range(M):
+            expect = log_normal_with_outliers(dtec[m], 0., sigma ** 2 * K, dtec_uncert[m])
+            assert jnp.isclose(log_prob[i, m], expect)
+
+
 def precompute_log_prob_components_with_wind(kernel, X, dtec, dtec_uncert,
                                    bottom_array, width_array, lengthscale_array, sigma_array, east_wind_speed_array,
                                    north_wind_speed_array,
@@ -62,21 +175,15 @@ def precompute_log_prob_components_with_wind(kernel, X, dtec, dtec_uncert,
                           east_wind_speed_array, north_wind_speed_array, indexing='ij')
     arrays = [a.ravel() for a in arrays]
 
+    homoscedastic = _homoscedastic_columns(dtec_uncert)
+
     def compute_log_prob_components(bottom, width, lengthscale,
                                     east_wind_speed, north_wind_speed):
         wind_velocity = jnp.asarray([east_wind_speed, north_wind_speed, 0.])
         # N, N
         K = kernel(X, X, bottom, width, lengthscale, 1., wind_velocity=wind_velocity)
-
-        def _compute_with_sigma(sigma):
-            def _compute(dtec, dtec_uncert):
-                return log_normal_with_outliers(dtec, 0., sigma**2 * K, dtec_uncert)
-
-            # M
-            return chunked_pmap(_compute, dtec, dtec_uncert, chunksize=1)
-
         # Ns,M
-        return chunked_pmap(_compute_with_sigma, sigma_array, chunksize=1)
+        return batched_log_normal_with_outliers(K, sigma_array, dtec, dtec_uncert, homoscedastic)
 
     Nb = bottom_array.shape[0]
     Nw = width_array.shape[0]
@@ -112,19 +219,13 @@ def precompute_log_prob_components_without_wind(kernel, X, dtec, dtec_uncert,
     arrays = jnp.meshgrid(bottom_array, width_array, lengthscale_array, indexing='ij')
     arrays = [a.ravel() for a in arrays]
 
+    homoscedastic = _homoscedastic_columns(dtec_uncert)
+
     def compute_log_prob_components(bottom, width, lengthscale):
         # N, N
         K = kernel(X, X, bottom, width, lengthscale, 1., wind_velocity=None)
-
-        def _compute_with_sigma(sigma):
-            def _compute(dtec, dtec_uncert):
-                return log_normal_with_outliers(dtec, 0., sigma**2 * K, dtec_uncert)
-
-            # M
-            return chunked_pmap(_compute, dtec, dtec_uncert, chunksize=1)
-
         # Ns,M
-        return chunked_pmap(_compute_with_sigma, sigma_array, chunksize=1)
+        return batched_log_normal_with_outliers(K, sigma_array, dtec, dtec_uncert, homoscedastic)
 
     Nb = bottom_array.shape[0]
     Nw = width_array.shape[0]
@@ -138,96 +239,1292 @@ def precompute_log_prob_components_without_wind(kernel, X, dtec, dtec_uncert,
         (dtec.shape[0], Nb, Nw, Nl, Ns))
     return log_prob
 
-def solve_with_tomographic_kernel(dtec, dtec_uncert, X, x0, fed_kernel, time_block_size):
+def solve_with_tomographic_kernel(key, dtec, dtec_uncert, antennas, directions, screen_directions, ref_antenna,
+                                  earth_centre, fed_kernel, time_block_size, chunksize, num_samples=500,
+                                  bottom_array=None, lengthscale_array=None, width=50., S_marg=25, tile_size=4):
     """
-    Precompute look-up tables for all blocks.
+    Screens under the tomographic (thick layer) kernel, with the same outputs as solve_with_vanilla_kernel.
     Assumes that each antenna is independent and doesn't take into account time.
 
+    For each antenna the DTEC covariances between the calibrator rays, and between them and the screen rays, are
+    tabulated over a (bottom, lengthscale) grid in tiles of rays (see TomographicKernel.quadrature_covariance). The
+    reference antenna's rays are the same for every antenna, so their quadrature points are computed once. Antennas
+    are processed one at a time, so memory is bounded by a single antenna's tables. Per time block the
+    (bottom, lengthscale, sigma) posterior is integrated by grid quadrature over the log_prob table, and the screen is
+    marginalised over samples snapped to the (bottom, lengthscale) grid, reusing the tabulated kernels, with sigma
+    treated exactly (see marginalise_screen_over_bins).
+
     Args:
-        dtec: [Nd, Na, Nt]
-        dtec_uncert: [Nd, Na, Nt]
-        X: [Nd,6]
-        x0: [3]
-        fed_kernel: StationaryKernel
+        key: PRNG key
+        dtec: [Nd, Na, Nt] mTECU
+        dtec_uncert: [Nd, Na, Nt] mTECU
+        antennas: [Na, 3] antenna positions in km
+        directions: [Nd, 3] unit vectors towards the calibrators
+        screen_directions: [Nd_screen, 3] unit vectors towards the screen directions
+        ref_antenna: [3] reference antenna position in km
+        earth_centre: [3] centre of the Earth in km, same frame as antennas
+        fed_kernel: StationaryKernel of the free electron density
         time_block_size: int
+        chunksize: int number of parallel devices to use.
+        num_samples: int, number of hyper-parameter samples the screen is marginalised over.
+        bottom_array: layer bottom heights in km to tabulate
+        lengthscale_array: FED lengthscales in km to tabulate
+        width: layer width in km
+        S_marg: int, quadrature resolution along each ray
+        tile_size: int, number of rays whose covariance is computed at once
+
+    Returns:
+        mean [Nd_screen, Na, Nt], uncert [Nd_screen, Na, Nt], mean_lengthscale [Na, Nt], mean_sigma [Na, Nt],
+        ESS [Na, Nt], logZ [Na, Nt], likelihood_evals [Na, Nt]
     """
-    scale = jnp.std(dtec) / 35.
-    dtec /= scale
-    dtec_uncert /= scale
-    bottom_array = jnp.linspace(200., 400., 5)
-    width_array = jnp.linspace(50., 50., 1)
-    lengthscale_array = jnp.linspace(0.1, 7.5, 7)
-    sigma_array = jnp.linspace(0.1, 2., 11)
-    kernel = TomographicKernel(x0, x0, fed_kernel, S_marg=25, compute_tec=False)
+    if bottom_array is None:
+        bottom_array = jnp.linspace(200., 400., 5)
+    if lengthscale_array is None:
+        lengthscale_array = jnp.linspace(0.5, 7.5, 8)
+    kernel = TomographicKernel(ref_antenna, earth_centre, fed_kernel, S_marg=S_marg, compute_tec=False)
+    dtec_uncert = jnp.maximum(dtec_uncert, 1e-6)
 
-    lookup_func = build_lookup_index(bottom_array, width_array, lengthscale_array, sigma_array)
-    Nd,Na,Nt = dtec.shape
-    remainder = Nt % time_block_size
-    dtec = jnp.concatenate([dtec,dtec[:, :,-remainder:]], axis=-1)
-    dtec_uncert = jnp.concatenate([dtec_uncert,dtec_uncert[:, :,-remainder:]], axis=-1)
-    Nt = dtec.shape[-1]
-    dtec = dtec.transpose((2,1, 0)).reshape((Nt*Na, Nd))
-    dtec_uncert = dtec_uncert.transpose((2,1,0)).reshape((Nt*Na, Nd))
-    # Nt*Na, ...
-    log_prob = precompute_log_prob_components_without_wind(kernel, X, dtec, dtec_uncert,
-                                              bottom_array, width_array, lengthscale_array, sigma_array,
-                                              chunksize=4)
-
-    log_prob = jnp.reshape(log_prob, (Nt//remainder, remainder, Na) + log_prob.shape[1:])
-
-    def run_block(block_idx):
-
-        def log_likelihood(bottom, width, lengthscale, sigma, **kwargs):
-            return jnp.sum(vmap(lambda log_prob: lookup_func(log_prob, bottom, width, lengthscale, sigma)
-                     )(log_prob[block_idx]))
-
-        bottom = UniformPrior('bottom', bottom_array.min(), bottom_array.max())
-        width = DeltaPrior('width', 50., tracked=False)
-        lengthscale = UniformPrior('lengthscale', jnp.min(lengthscale_array), jnp.max(lengthscale_array))
-        sigma = UniformPrior('sigma', sigma_array.min(), sigma_array.max())
-        prior_chain = PriorChain(lengthscale, sigma, bottom, width)
-
-        ns = NestedSampler(loglikelihood=log_likelihood,
-                           prior_chain=prior_chain,
-                           sampler_name='slice',
-                           sampler_kwargs=dict(num_slices=prior_chain.U_ndims * 5),
-                           num_live_points=prior_chain.U_ndims * 50)
-        ns = jit(ns)
-        results = ns(random.PRNGKey(42), termination_frac=0.001)
-
-        return results
-        # results.efficiency.block_until_ready()
-        # t0 = default_timer()
-        # results = ns(random.PRNGKey(42), termination_frac=0.001)
-        # summary(results)
-        # print(default_timer() - t0)
-
-        # def screen(bottom, lengthscale, east_wind_speed, north_wind_speed, sigma, **kw):
-        #     wind_velocity = jnp.asarray([east_wind_speed, north_wind_speed, 0.])
-        #     K = kernel(X, X, bottom, 50., lengthscale, sigma, wind_velocity=wind_velocity)
-        #     Kstar = kernel(X, Xstar, bottom, 50., lengthscale, sigma)
-        #     L = jnp.linalg.cholesky(K + jnp.diag(jnp.maximum(1e-6, dtec_uncert) ** 2))
-        #     dx = solve_triangular(L, dtec, lower=True)
-        #     return solve_triangular(L, Kstar, lower=True).T @ dx
-
-        # summary(results)
-        # plot_diagnostics(results)
-        # plot_cornerplot(results)
-
-        # screen_mean = marginalise_static(random.PRNGKey(4325325), results.samples, results.log_p, int(results.ESS), screen)
-
-        # print(screen_mean)
-        # plot_vornoi_map(Xstar[:, 3:5], screen_mean)
-        # plt.show()
-        # plot_vornoi_map(X[:, 3:5], dtec)
-        # plt.show()
-
-        # return screen_mean
-
-    results = chunked_pmap(run_block, jnp.arange(Nt//time_block_size))
-
-
-def solve_with_vanilla_kernel(key, dtec, dtec_uncert, X, Xstar, fed_kernel, time_block_size, chunksize):
+    Nd, Na, Nt = dtec.shape
+    extra = (-Nt) % time_block_size
+    # repeat the last timestep up to a whole number of blocks, which may be more than Nt
+    dtec = jnp.pad(dtec, ((0, 0), (0, 0), (0, extra)), mode='edge')
+    dtec_uncert = jnp.pad(dtec_uncert, ((0, 0), (0, 0), (0, extra)), mode='edge')
+    size_dict = dict(a=Na, d=Nd, b=time_block_size)
+    # [Na, T*time_block_size, Nd]
+    dtec = axes_move(dtec, ['d', 'a', 'tb'], ['a', 'tb', 'd'], size_dict=size_dict)
+    dtec_uncert = axes_move(dtec_uncert, ['d', 'a', 'tb'], ['a', 'tb', 'd'], size_dict=size_dict)
+    T = (Nt + extra) // time_block_size
+    Nb, Nl = bottom_array.size, lengthscale_array.size
+    Ns = 32
+    bottom_idx, lengthscales = [a.ravel() for a in jnp.meshgrid(jnp.arange(Nb), lengthscale_array, indexing='ij')]
+
+    # [Nb, N, S_marg + 1, 3], [Nb, N, S_marg + 1] reference antenna rays, shared by all antennas
+    ref_points, ref_weights = vmap(lambda bottom: kernel.ray_quadrature(ref_antenna, directions, bottom, width))(
+        bottom_array)
+    ref_screen_points, ref_screen_weights = vmap(
+        lambda bottom: kernel.ray_quadrature(ref_antenna, screen_directions, bottom, width))(bottom_array)
+
+    def unit_kernels(bottom_idx, lengthscale, x):
+        bottom = bottom_array[bottom_idx]
+        points, weights = kernel.ray_quadrature(x, directions, bottom, width)
+        points = jnp.concatenate([points, ref_points[bottom_idx]], axis=1)
+        weights = jnp.concatenate([weights, -ref_weights[bottom_idx]], axis=1)
+        screen_points, screen_weights = kernel.ray_quadrature(x, screen_directions, bottom, width)
+        screen_points = jnp.concatenate([screen_points, ref_screen_points[bottom_idx]], axis=1)
+        screen_weights = jnp.concatenate([screen_weights, -ref_screen_weights[bottom_idx]], axis=1)
+        fed_kernel_params = dict(l=lengthscale, sigma=1.)
+        K = kernel.quadrature_covariance(points, weights, points, weights, 1., fed_kernel_params,
+                                         tile_size=tile_size)
+        Kstar = kernel.quadrature_covariance(points, weights, screen_points, screen_weights, 1., fed_kernel_params,
+                                             tile_size=tile_size)
+        return K, Kstar
+
+    def run_block(key, dtec, dtec_uncert, log_prob, K_table, Kstar_table, sigma_array):
+        results = grid_quadrature(log_prob, bottom_array, lengthscale_array, sigma_array)
+        bottom, lengthscale, sigma = sample_grid_posterior(key, results, num_samples)
+        bins = nearest_bin(bottom_array, bottom) * Nl + nearest_bin(lengthscale_array, lengthscale)
+        # [time_block_size, Nd_screen], [time_block_size, Nd_screen]
+        mean, var = marginalise_screen_over_bins(lambda bin: (K_table[bin], Kstar_table[bin]), bins, sigma,
+                                                 dtec, dtec_uncert)
+        mean_lengthscale = grid_posterior_mean(results, lambda bottom, lengthscale, sigma: lengthscale)
+        mean_logsigma = grid_posterior_mean(results, lambda bottom, lengthscale, sigma: jnp.log(sigma))
+        ones = jnp.ones(time_block_size)
+        return (mean, jnp.sqrt(var), mean_lengthscale * ones, jnp.exp(mean_logsigma) * ones, results.ESS * ones,
+                results.logZ * ones, results.num_likelihood_evaluations * ones)
+
+    @jit
+    def run_blocks(keys, dtec, dtec_uncert, log_prob, K_table, Kstar_table, sigma_array):
+        return lax_map(lambda args: run_block(*args, K_table, Kstar_table, sigma_array),
+                       (keys, dtec, dtec_uncert, log_prob))
+
+    outputs = []
+    for antenna, (x, key) in enumerate(zip(antennas, random.split(key, Na))):
+        t0 = default_timer()
+        # [Nb*Nl, Nd, Nd], [Nb*Nl, Nd, Nd_screen]
+        K_table, Kstar_table = chunked_pmap(unit_kernels, bottom_idx, lengthscales,
+                                            jnp.broadcast_to(x, (Nb * Nl, 3)), chunksize=chunksize)
+        # log-spaced sigma grid covering the data's second moment under every tabulated kernel
+        finite = jnp.isfinite(dtec_uncert[antenna])
+        # floored for the reference antenna, where both vanish
+        data_var = jnp.maximum(jnp.sum(jnp.where(finite, dtec[antenna] ** 2, 0.)) / jnp.maximum(jnp.sum(finite), 1.),
+                               1e-12)
+        prior_var = jnp.maximum(jnp.mean(jnp.diagonal(K_table, axis1=1, axis2=2), axis=1), 1e-12)
+        sigma_array = jnp.exp(jnp.linspace(jnp.log(0.1 * jnp.sqrt(data_var / jnp.max(prior_var))),
+                                           jnp.log(3. * jnp.sqrt(data_var / jnp.min(prior_var))), Ns))
+        homoscedastic = _homoscedastic_columns(dtec_uncert[antenna])
+
+        def compute_log_prob_components(K):
+            return batched_log_normal_with_outliers(K, sigma_array, dtec[antenna], dtec_uncert[antenna],
+                                                    homoscedastic)
+
+        # [Nb*Nl, Ns, T*time_block_size] -> [T, Nb, Nl, Ns]
+        log_prob = chunked_pmap(compute_log_prob_components, K_table, chunksize=chunksize)
+        log_prob = jnp.sum(axes_move(log_prob, ['ml', 's', 'tb'], ['t', 'm', 'l', 's', 'b'],
+                                     size_dict=dict(m=Nb, l=Nl, b=time_block_size)), axis=-1)
+        outputs.append(run_blocks(random.split(key, T),
+                                  dtec[antenna].reshape((T, time_block_size, Nd)),
+                                  dtec_uncert[antenna].reshape((T, time_block_size, Nd)),
+                                  log_prob, K_table, Kstar_table, sigma_array))
+        logger.info(f"Tomographic screen for antenna {antenna + 1}/{Na} took {default_timer() - t0:.1f} seconds.")
+    # each [Na, T, time_block_size, ...]
+    mean, uncert, mean_lengthscale, mean_sigma, ESS, logZ, likelihood_evals = [jnp.stack(output)
+                                                                               for output in zip(*outputs)]
+    mean = axes_move(mean, ['a', 't', 'b', 'n'], ['n', 'a', 'tb'], size_dict=size_dict)
+    uncert = axes_move(uncert, ['a', 't', 'b', 'n'], ['n', 'a', 'tb'], size_dict=size_dict)
+    mean_lengthscale, mean_sigma, ESS, logZ, likelihood_evals = [
+        array.reshape((Na, Nt + extra))[:, :Nt]
+        for array in (mean_lengthscale, mean_sigma, ESS, logZ, likelihood_evals)]
+    return mean[..., :Nt], uncert[..., :Nt], mean_lengthscale, mean_sigma, ESS, logZ, likelihood_evals
+
+
+def test_solve_with_tomographic_kernel():
+    np.random.seed(0)
+    Nd, Nt = 10, 6
+    earth_centre = jnp.asarray([0., 0., -6371.])
+    ref_antenna = jnp.zeros(3)
+    antennas = jnp.asarray([[0., 0., 0.], [6., -4., 0.]])
+    directions = np.random.uniform(-0.03, 0.03, size=(Nd, 3))
+    directions[:, 2] = 1.
+    directions = jnp.asarray(directions / np.linalg.norm(directions, axis=1, keepdims=True))
+    kernel = TomographicKernel(ref_antenna, earth_centre, M32(), S_marg=6)
+    points, weights = kernel.ray_quadrature(antennas[1], directions, 300., 50.)
+    ref_points, ref_weights = kernel.ray_quadrature(ref_antenna, directions, 300., 50.)
+    points = jnp.concatenate([points, ref_points], axis=1)
+    weights = jnp.concatenate([weights, -ref_weights], axis=1)
+    K = kernel.quadrature_covariance(points, weights, points, weights, 20., dict(l=5., sigma=1.))
+    truth = jnp.linalg.cholesky(K + 1e-6 * jnp.eye(Nd)) @ jnp.asarray(np.random.normal(size=(Nd, Nt)))
+    truth = jnp.stack([jnp.zeros((Nd, Nt)), truth], axis=1)
+    dtec_uncert = jnp.ones((Nd, 2, Nt)).at[3, 1, 2].set(jnp.inf)
+    dtec = truth + jnp.asarray(np.random.normal(size=(Nd, 2, Nt)))
+    mean, uncert, lengthscale, sigma, ESS, logZ, likelihood_evals = \
+        solve_with_tomographic_kernel(random.PRNGKey(0), dtec, dtec_uncert, antennas, directions, directions,
+                                      ref_antenna, earth_centre, M32(), time_block_size=4, chunksize=1,
+                                      num_samples=50, bottom_array=jnp.linspace(250., 350., 3),
+                                      lengthscale_array=jnp.linspace(2., 8., 4), S_marg=6)
+    assert mean.shape == (Nd, 2, Nt) and uncert.shape == (Nd, 2, Nt)
+    assert lengthscale.shape == (2, Nt) and logZ.shape == (2, Nt)
+    assert jnp.all(jnp.isfinite(mean)) and jnp.all(jnp.isfinite(uncert))
+    # the reference antenna has no DTEC
+    assert jnp.allclose(mean[:, 0], 0.)
+    # the screen at the calibrators follows the data
+    finite = jnp.isfinite(dtec_uncert[:, 1])
+    assert jnp.sqrt(jnp.mean(jnp.where(finite, mean[:, 1] - truth[:, 1], 0.) ** 2)) < 1.5
+    # and fills in the outlier like the GP with the true hyper-parameters, within its posterior uncertainty
+    keep = jnp.arange(Nd) != 3
+    A = K[keep][:, keep] + jnp.eye(Nd - 1)
+    expect = K[3, keep] @ jnp.linalg.solve(A, dtec[keep, 1, 2])
+    expect_std = jnp.sqrt(K[3, 3] - K[3, keep] @ jnp.linalg.solve(A, K[keep, 3]))
+    assert jnp.abs(mean[3, 1, 2] - expect) < expect_std
+    # a short last epoch, fewer timesteps than half a block
+    mean, uncert, lengthscale, sigma, ESS, logZ, likelihood_evals = \
+        solve_with_tomographic_kernel(random.PRNGKey(0), dtec[..., :1], dtec_uncert[..., :1], antennas, directions,
+                                      directions, ref_antenna, earth_centre, M32(), time_block_size=4, chunksize=1,
+                                      num_samples=50, bottom_array=jnp.linspace(250., 350., 3),
+                                      lengthscale_array=jnp.linspace(2., 8., 4), S_marg=6)
+    assert mean.shape == (Nd, 2, 1) and lengthscale.shape == (2, 1)
+    assert jnp.all(jnp.isfinite(mean))
+
+
+GridQuadratureResults = namedtuple('GridQuadratureResults', ['logZ', 'log_cell_weights', 'cell_centres', 'cell_widths',
+                                                             'ESS', 'num_likelihood_evaluations'])
+
+
+def grid_quadrature(log_prob, *arrays):
+    """
+    Trapezoid quadrature of a log-likelihood tabulated on a grid, under a uniform prior over the grid's bounding box.
+    Each grid cell gets the mean of the likelihood at its corners times its volume, which gives the evidence and
+    posterior cell weights directly from the table, i.e. without running a sampler.
+
+    Args:
+        log_prob: [N1, ..., Nk] log-likelihood on the grid
+        *arrays: k increasing 1D arrays, the grid coordinates. Size-1 dimensions are treated as fixed.
+
+    Returns:
+        GridQuadratureResults with
+            logZ: log evidence
+            log_cell_weights: [M1, ..., Mk] normalised log posterior mass of each cell, Mi = max(Ni - 1, 1)
+            cell_centres: list of [Mi] cell centres
+            cell_widths: list of [Mi] cell widths
+            ESS: Kish effective sample size of the cell weights
+            num_likelihood_evaluations: size of the table
+    """
+    log_cell = log_prob
+    log_volume = 0.
+    log_prior_volume = 0.
+    cell_centres = []
+    cell_widths = []
+    for axis, array in enumerate(arrays):
+        if array.size == 1:
+            cell_centres.append(array)
+            cell_widths.append(jnp.zeros(1))
+            continue
+        # average neighbouring corners along this axis
+        log_cell = jnp.logaddexp(jnp.take(log_cell, jnp.arange(array.size - 1), axis=axis),
+                                 jnp.take(log_cell, jnp.arange(1, array.size), axis=axis)) - jnp.log(2.)
+        widths = jnp.diff(array)
+        shape = [1] * len(arrays)
+        shape[axis] = -1
+        log_volume = log_volume + jnp.log(widths).reshape(shape)
+        log_prior_volume = log_prior_volume + jnp.log(array[-1] - array[0])
+        cell_centres.append(0.5 * (array[:-1] + array[1:]))
+        cell_widths.append(widths)
+    log_cell = log_cell + log_volume
+    log_evidence = logsumexp(log_cell)
+    log_cell_weights = log_cell - log_evidence
+    ESS = 1. / jnp.sum(jnp.exp(2. * log_cell_weights))
+    return GridQuadratureResults(logZ=log_evidence - log_prior_volume,
+                                 log_cell_weights=log_cell_weights,
+                                 cell_centres=cell_centres,
+                                 cell_widths=cell_widths,
+                                 ESS=ESS,
+                                 num_likelihood_evaluations=log_prob.size)
+
+
+def grid_posterior_mean(results, f):
+    """
+    Posterior mean of f(*params) using the cell weights of grid quadrature, evaluated at the cell centres.
+    """
+    centres = jnp.meshgrid(*results.cell_centres, indexing='ij')
+    weights = jnp.exp(results.log_cell_weights)
+    return jnp.sum(weights * f(*centres))
+
+
+def sample_grid_posterior(key, results, num_samples):
+    """
+    Draw hyper-parameter samples from the grid quadrature posterior, by choosing a cell with probability equal to its
+    posterior mass and then a uniform point within the cell.
+
+    Returns:
+        list of [num_samples] samples, one per grid dimension.
+    """
+    cell_key, jitter_key = random.split(key, 2)
+    shape = results.log_cell_weights.shape
+    # inverse CDF over the cells, which unlike random.categorical doesn't need a [num_samples, num_cells] array
+    cdf = jnp.cumsum(jnp.exp(results.log_cell_weights.ravel()))
+    u = random.uniform(cell_key, (num_samples,), maxval=cdf[-1])
+    cells = jnp.minimum(jnp.searchsorted(cdf, u, side='right'), cdf.size - 1)
+    cells = jnp.unravel_index(cells, shape)
+    jitter = random.uniform(jitter_key, (len(shape), num_samples), minval=-0.5, maxval=0.5)
+    return [centres[cell] + u * widths[cell]
+            for centres, widths, cell, u in zip(results.cell_centres, results.cell_widths, cells, jitter)]
+
+
+def test_grid_quadrature():
+    from jax.scipy.stats import norm
+    x_array = jnp.linspace(-5., 5., 201)
+    y_array = jnp.linspace(0., 4., 161)
+    X, Y = jnp.meshgrid(x_array, y_array, indexing='ij')
+    log_prob = norm.logpdf(X, 0.5, 0.7) + norm.logpdf(Y, 2., 0.3)
+    results = grid_quadrature(log_prob, x_array, y_array)
+    # Gaussian fully inside the box, so Z = 1/prior volume
+    assert jnp.isclose(results.logZ, -jnp.log(10. * 4.), atol=1e-3)
+    assert jnp.isclose(grid_posterior_mean(results, lambda x, y: x), 0.5, atol=1e-3)
+    assert jnp.isclose(grid_posterior_mean(results, lambda x, y: (y - 2.) ** 2), 0.3 ** 2, atol=1e-3)
+    x, y = sample_grid_posterior(random.PRNGKey(0), results, 20000)
+    assert jnp.isclose(jnp.mean(x), 0.5, atol=0.02)
+    assert jnp.isclose(jnp.std(y), 0.3, atol=0.02)
+    # fixed dimensions are passed through
+    results = grid_quadrature(log_prob[:, 80:81], x_array, y_array[80:81])
+    assert results.log_cell_weights.shape == (200, 1)
+    x, y = sample_grid_posterior(random.PRNGKey(0), results, 10)
+    assert jnp.all(y == y_array[80])
+
+
+def posterior_mass_bounds(log_prob, arrays, tol):
+    """
+    Per-dimension bounds of the region holding all but `tol` of the posterior mass of each batch element's grid
+    posterior, combined over the batch into a single box. Batch elements whose region spans a whole dimension (e.g.
+    the flat posterior of the all-zero reference antenna) carry no information there and are left out of that
+    dimension's bounds, so they don't prevent refinement for the rest.
+
+    Args:
+        log_prob: [..., N1, ..., Nk] batch of tabulated log-likelihoods
+        arrays: k grid coordinate arrays
+        tol: float, posterior mass allowed outside the box in each dimension (split equally between both tails)
+
+    Returns:
+        list of (lower, upper) per dimension
+    """
+    k = len(arrays)
+    batch_shape = log_prob.shape[:-k]
+    log_prob = log_prob.reshape((-1,) + log_prob.shape[-k:])
+    # [B, M1, ..., Mk]
+    log_cell_weights = vmap(lambda log_prob: grid_quadrature(log_prob, *arrays).log_cell_weights)(log_prob)
+    cell_weights = np.exp(np.asarray(log_cell_weights))
+    bounds = []
+    for axis, array in enumerate(arrays):
+        array = np.asarray(array)
+        if array.size == 1:
+            bounds.append((array[0], array[0]))
+            continue
+        other_axes = tuple(a + 1 for a in range(k) if a != axis)
+        # [B, Mi]
+        cdf = np.cumsum(np.sum(cell_weights, axis=other_axes), axis=1)
+        # first and last cells that are inside the central 1 - tol mass
+        first = np.argmax(cdf > 0.5 * tol, axis=1)
+        last = np.minimum(np.sum(cdf < 1. - 0.5 * tol, axis=1), array.size - 2)
+        informative = (first > 0) | (last < array.size - 2)
+        if np.any(informative):
+            first, last = first[informative], last[informative]
+        bounds.append((array[np.min(first)], array[np.max(last) + 1]))
+    return bounds
+
+
+def refine_grid_arrays(arrays, bounds, num_refine):
+    """
+    Add `num_refine` evenly spaced points within `bounds` to each grid array, unless the array already has that many
+    points there. The original points are kept, so the refined grid still spans the whole prior.
+
+    Returns:
+        list of refined 1D arrays, and whether anything changed.
+    """
+    refined = []
+    changed = False
+    for array, (lower, upper) in zip(arrays, bounds):
+        array = np.asarray(array)
+        if array.size == 1 or upper <= lower or np.sum((array >= lower) & (array <= upper)) >= num_refine:
+            refined.append(array)
+            continue
+        new_array = np.union1d(array, np.linspace(lower, upper, num_refine))
+        # drop points that are numerically the same
+        keep = np.concatenate([[True], np.diff(new_array) > 1e-9 * (new_array[-1] - new_array[0])])
+        refined.append(new_array[keep])
+        changed = True
+    return refined, changed
+
+
+def build_adaptive_grid(log_prob_fn, *arrays, tol=1e-3, num_refine=16, max_levels=3):
+    """
+    Coarse-to-fine grid for tabulated likelihoods. Starting from coarse `arrays`, repeatedly find the box holding all
+    but `tol` of the posterior mass (of every batch element) and add `num_refine` points per dimension there, until
+    the box is resolved or `max_levels` refinements are done. The result is a rectilinear (non-uniform) grid, usable by
+    `build_lookup_index` and `grid_quadrature` in place of a dense regular one.
+
+    Smaller `tol` gives wider boxes, so more evaluations; `num_refine` and `max_levels` bound the total.
+
+    Args:
+        log_prob_fn: callable(*arrays) -> [..., N1, ..., Nk] log-likelihood table on the product grid
+        *arrays: k coarse 1D grid arrays
+        tol: float, posterior mass allowed outside the refined region
+        num_refine: int, points added per dimension per refinement
+        max_levels: int, maximum number of refinements
+
+    Returns:
+        list of refined grid arrays, the log_prob table on them, and the total number of grid points evaluated.
+    """
+    arrays = [np.asarray(array) for array in arrays]
+    log_prob = log_prob_fn(*[jnp.asarray(array) for array in arrays])
+    num_evaluations = int(np.prod([array.size for array in arrays]))
+    for level in range(max_levels):
+        bounds = posterior_mass_bounds(log_prob, arrays, tol)
+        arrays, changed = refine_grid_arrays(arrays, bounds, num_refine)
+        if not changed:
+            break
+        log_prob = log_prob_fn(*[jnp.asarray(array) for array in arrays])
+        num_evaluations += int(np.prod([array.size for array in arrays]))
+    return [jnp.asarray(array) for array in arrays], log_prob, num_evaluations
+
+
+def test_build_adaptive_grid():
+    from jax.scipy.stats import norm
+
+    def log_prob_fn(x_array, y_array):
+        X, Y = jnp.meshgrid(x_array, y_array, indexing='ij')
+        # two batch elements with nearby posteriors
+        return jnp.stack([norm.logpdf(X, 0.5, 0.05) + norm.logpdf(Y, 2., 0.03),
+                          norm.logpdf(X, 0.6, 0.05) + norm.logpdf(Y, 2.1, 0.03)], axis=0)
+
+    x_array = jnp.linspace(-5., 5., 201)
+    y_array = jnp.linspace(0., 4., 201)
+    dense = vmap(lambda log_prob: grid_quadrature(log_prob, x_array, y_array).logZ)(log_prob_fn(x_array, y_array))
+    arrays, log_prob, num_evaluations = build_adaptive_grid(log_prob_fn, jnp.linspace(-5., 5., 9),
+                                                            jnp.linspace(0., 4., 9), tol=1e-4, num_refine=16)
+    assert num_evaluations < 201 * 201 // 10
+    assert log_prob.shape == (2, arrays[0].size, arrays[1].size)
+    adaptive = vmap(lambda log_prob: grid_quadrature(log_prob, *arrays).logZ)(log_prob)
+    assert jnp.allclose(adaptive, dense, atol=1e-2)
+    results = grid_quadrature(log_prob[0], *arrays)
+    assert jnp.isclose(grid_posterior_mean(results, lambda x, y: x), 0.5, atol=1e-3)
+    # usable by the lookup
+    lookup = build_lookup_index(*arrays)
+    assert jnp.isclose(lookup(log_prob[0], arrays[0][3], arrays[1][5]), log_prob[0, 3, 5])
+    # a flat batch element (e.g. the reference antenna) doesn't stop the others being refined
+    flat_arrays, _, flat_num_evaluations = build_adaptive_grid(
+        lambda *arrays: jnp.concatenate([log_prob_fn(*arrays), jnp.zeros((1, arrays[0].size, arrays[1].size))]),
+        jnp.linspace(-5., 5., 9), jnp.linspace(0., 4., 9), tol=1e-4, num_refine=16)
+    assert flat_num_evaluations == num_evaluations
+    assert all(jnp.allclose(a, b) for a, b in zip(flat_arrays, arrays))
+
+
+OptimisationResults = namedtuple('OptimisationResults', ['logZ', 'ESS', 'num_likelihood_evaluations'])
+
+
+def masked_log_normal(x, cov, uncert):
+    """
+    Same density as log_normal_with_outliers, but outliers are masked out of the whitening rather than divided by
+    inf, so that it's safe to differentiate with respect to `cov`.
+
+    Args:
+        x: [N] RV value, zero mean
+        cov: [N, N] covariance of underlying, minus the obs. covariance
+        uncert: [N] stddev's of obs. error, inf encodes an outlier.
+    """
+    finite = jnp.isfinite(uncert)
+    w = jnp.where(finite, 1. / jnp.where(finite, uncert, 1.), 0.)
+    C = w[:, None] * cov * w[None, :] + jnp.eye(cov.shape[0])
+    L = jnp.linalg.cholesky(C)
+    log_det = jnp.sum(jnp.log(jnp.diag(L))) - jnp.sum(jnp.where(finite, jnp.log(w), 0.))
+    dx = solve_triangular(L, jnp.where(finite, x * w, 0.), lower=True)
+    return -0.5 * jnp.sum(finite) * jnp.log(2. * jnp.pi) - log_det - 0.5 * dx @ dx
+
+
+def projected_newton(objective, init, lower, upper, num_steps=30, damping=1e-3):
+    """
+    Maximise `objective` with damped (Levenberg-Marquardt) Newton steps, projected back onto the box [lower, upper].
+    A step is only accepted if it improves the objective, otherwise the damping is increased, so it behaves like
+    gradient ascent far from the mode and like Newton's method close to it. Intended for a handful of parameters,
+    where the Hessian is cheap, and where first-order methods crawl along the strongly correlated ridges of GP
+    marginal likelihoods. Runs a fixed number of steps in a scan, so that it can be vmapped/pmapped over a batch of
+    independent problems.
+
+    Args:
+        objective: callable(params[k]) -> scalar
+        init: [k] initial parameters
+        lower: [k]
+        upper: [k]
+        num_steps: int
+        damping: float, initial damping
+
+    Returns:
+        [k] optimised parameters
+    """
+    value_and_grad_fn = value_and_grad(objective)
+    hessian_fn = hessian(objective)
+    k = init.size
+
+    def body(state, _):
+        (params, value, lam) = state
+        _, g = value_and_grad_fn(params)
+        H = -hessian_fn(params)
+        H = 0.5 * (H + H.T)
+        eigvals, eigvecs = jnp.linalg.eigh(H)
+        # positive definite part of the curvature, plus damping relative to its scale
+        scale = jnp.maximum(jnp.max(jnp.abs(eigvals)), 1e-12)
+        eigvals = jnp.maximum(eigvals, 1e-9 * scale) + lam * scale
+        step = eigvecs @ ((eigvecs.T @ g) / eigvals)
+        proposal = jnp.clip(params + step, lower, upper)
+        proposal_value = objective(proposal)
+        accept = jnp.isfinite(proposal_value) & (proposal_value > value) & jnp.all(jnp.isfinite(proposal))
+        params = jnp.where(accept, proposal, params)
+        value = jnp.where(accept, proposal_value, value)
+        lam = jnp.where(accept, lam / 3., lam * 4.)
+        return (params, value, lam), ()
+
+    init_value = objective(init)
+    (params, _, _), _ = scan(body, (init, init_value, jnp.asarray(damping, init_value.dtype)), jnp.arange(num_steps))
+    return params
+
+
+def laplace_approximation(objective, params):
+    """
+    Gaussian approximation N(params, [-Hessian]^-1) of exp(objective) around its mode, and the corresponding
+    approximation of log integral exp(objective).
+
+    Returns:
+        cov [k, k], log_integral
+    """
+    k = params.size
+    H = -hessian(objective)(params)
+    # symmetrise and guard against a mode on a constraint boundary where the curvature may be non-positive
+    H = 0.5 * (H + H.T)
+    eigvals, eigvecs = jnp.linalg.eigh(H)
+    eigvals = jnp.maximum(eigvals, 1e-6)
+    cov = (eigvecs / eigvals) @ eigvecs.T
+    log_integral = objective(params) + 0.5 * k * jnp.log(2. * jnp.pi) - 0.5 * jnp.sum(jnp.log(eigvals))
+    return cov, log_integral
+
+
+def test_projected_newton():
+    np.random.seed(0)
+    N, M = 20, 40
+    x = np.random.uniform(size=(N, 2))
+
+    def kernel(lengthscale):
+        return jnp.exp(-0.5 * jnp.sum((x[:, None, :] - x[None, :, :]) ** 2, axis=-1) / lengthscale ** 2)
+
+    true_lengthscale, true_sigma = 0.3, 2.
+    L = np.linalg.cholesky(np.asarray(true_sigma ** 2 * kernel(true_lengthscale)) + 0.01 ** 2 * np.eye(N))
+    dtec = jnp.asarray((L @ np.random.normal(size=(N, M))).T)
+    dtec_uncert = 0.01 * jnp.ones((M, N))
+    dtec_uncert = dtec_uncert.at[3, 5].set(jnp.inf)
+
+    def objective(params):
+        lengthscale, sigma = jnp.exp(params)
+        K = sigma ** 2 * kernel(lengthscale)
+        return jnp.sum(vmap(lambda x, u: masked_log_normal(x, K, u))(dtec, dtec_uncert))
+
+    assert jnp.isclose(masked_log_normal(dtec[3], kernel(0.3), dtec_uncert[3]),
+                       log_normal_with_outliers(dtec[3], 0., kernel(0.3), dtec_uncert[3]))
+    lower = jnp.log(jnp.asarray([0.05, 0.1]))
+    upper = jnp.log(jnp.asarray([2., 10.]))
+    params = projected_newton(objective, jnp.log(jnp.asarray([1., 1.])), lower, upper)
+    assert jnp.all(jnp.isfinite(params))
+    lengthscale, sigma = jnp.exp(params)
+    assert jnp.abs(lengthscale - true_lengthscale) < 0.05
+    assert jnp.abs(sigma - true_sigma) < 0.5
+    # at the mode, better than nearby points
+    assert objective(params) >= objective(params + jnp.asarray([0.05, 0.])) - 1e-3
+    cov, log_integral = laplace_approximation(objective, params)
+    assert jnp.all(jnp.linalg.eigvalsh(cov) > 0.)
+    assert log_integral > objective(params) - 10.
+
+
+def binned_screen_marginalisation(kernel, X, Xstar, dtec, dtec_uncert, lengthscale, sigma, lengthscale_bins):
+    """
+    Average of the screen predictive over equally weighted hyper-parameter samples, factoring the kernel once per
+    distinct lengthscale rather than once per sample.
+
+    Samples are snapped to the nearest of `lengthscale_bins` and visited in sorted order, so a new factorisation is
+    only done (with lax.cond) when the bin changes. Per timestep, W.K.W = V.diag(mu).V^T for the unit-variance kernel,
+    after which the sigma dependence is diagonal,
+        mean = sigma^2 P^T.diag(1/(sigma^2 mu + 1)).q
+        var = sigma^4 (P*P)^T.(1/(sigma^2 mu + 1))
+    with P = V^T.W.Kstar and q = V^T.W.dtec, so sigma is treated exactly and each sample costs O(N Nstar).
+    Returns the same quantities as the per-sample screen: the predictive mean and the variance explained by the data.
+
+    Args:
+        kernel: callable(X1, X2, lengthscale, sigma)
+        X: [N, D]
+        Xstar: [Nstar, D]
+        dtec: [B, N] timesteps sharing the hyper-parameters
+        dtec_uncert: [B, N] inf encodes an outlier
+        lengthscale: [S] samples
+        sigma: [S] samples
+        lengthscale_bins: [Nl] increasing
+
+    Returns:
+        mean [B, Nstar], var [B, Nstar]
+    """
+    bins = nearest_bin(lengthscale_bins, lengthscale)
+    return marginalise_screen_over_bins(lambda bin: (kernel(X, X, lengthscale_bins[bin], 1.),
+                                                     kernel(X, Xstar, lengthscale_bins[bin], 1.)),
+                                        bins, sigma, dtec, dtec_uncert)
+
+
+def nearest_bin(bins, x):
+    """
+    Index of the nearest of increasing `bins` to each of `x`.
+    """
+    idx = jnp.clip(jnp.searchsorted(bins, x), 1, bins.size - 1)
+    return jnp.where(jnp.abs(x - bins[idx - 1]) < jnp.abs(bins[idx] - x), idx - 1, idx)
+
+
+def marginalise_screen_over_bins(unit_kernels, bins, sigma, dtec, dtec_uncert):
+    """
+    The work of binned_screen_marginalisation, for any kernel that is indexed by a bin, times sigma^2.
+
+    Args:
+        unit_kernels: callable(bin) -> K [N, N], Kstar [N, Nstar] for sigma=1
+        bins: [S] int bin of each sample
+        sigma: [S] samples
+        dtec: [B, N]
+        dtec_uncert: [B, N] inf encodes an outlier
+
+    Returns:
+        mean [B, Nstar], var [B, Nstar]
+    """
+    finite = jnp.isfinite(dtec_uncert)
+    w = jnp.where(finite, 1. / jnp.where(finite, dtec_uncert, 1.), 0.)
+    wY = jnp.where(finite, dtec * w, 0.)
+    order = jnp.argsort(bins)
+    bins, sigma = bins[order], sigma[order]
+
+    def factor(bin):
+        K, Kstar = unit_kernels(bin)
+
+        def _per_timestep(w, wY):
+            mu, V = jnp.linalg.eigh(w[:, None] * K * w[None, :])
+            return jnp.maximum(mu, 0.), V.T @ (w[:, None] * Kstar), V.T @ wY
+
+        # [B, N], [B, N, Nstar], [B, N]
+        return vmap(_per_timestep)(w, wY)
+
+    def body(state, X):
+        (prev_bin, factors, mean, var) = state
+        (bin, sigma) = X
+        factors = cond(bin != prev_bin, factor, lambda bin: factors, bin)
+        (mu, P, q) = factors
+        sigma2 = sigma ** 2
+        d = 1. / (sigma2 * mu + 1.)
+        mean = mean + sigma2 * jnp.einsum('bji,bj->bi', P, d * q)
+        var = var + sigma2 ** 2 * jnp.einsum('bji,bj->bi', P * P, d)
+        return (bin, factors, mean, var), ()
+
+    init_factors = factor(bins[0])
+    zeros = jnp.zeros(init_factors[1].shape[::2])
+    (_, _, mean, var), _ = scan(body, (bins[0], init_factors, zeros, zeros), (bins, sigma))
+    return mean / bins.size, var / bins.size
+
+
+def test_binned_screen_marginalisation():
+    np.random.seed(0)
+    N, Nstar, B = 15, 8, 3
+    X = jnp.asarray(np.random.uniform(size=(N, 2)))
+    Xstar = jnp.asarray(np.random.uniform(size=(Nstar, 2)))
+
+    def kernel(X1, X2, lengthscale, sigma):
+        return sigma ** 2 * jnp.exp(-0.5 * jnp.sum((X1[:, None, :] - X2[None, :, :]) ** 2, axis=-1) / lengthscale ** 2)
+
+    dtec = jnp.asarray(np.random.normal(size=(B, N)))
+    dtec_uncert = jnp.asarray(np.random.uniform(0.1, 0.3, size=(B, N)))
+    dtec_uncert = dtec_uncert.at[1, 4].set(jnp.inf)
+    lengthscale_bins = jnp.linspace(0.1, 1., 10)
+    # samples on the bins, so that snapping is exact
+    lengthscale = lengthscale_bins[jnp.asarray(np.random.randint(0, 10, size=30))]
+    sigma = jnp.asarray(np.random.uniform(0.5, 2., size=30))
+
+    def screen(dtec, dtec_uncert, lengthscale, sigma):
+        K = kernel(X, X, lengthscale, sigma)
+        Kstar = kernel(X, Xstar, lengthscale, sigma)
+        L = jnp.linalg.cholesky(K / (dtec_uncert[:, None] * dtec_uncert[None, :]) + jnp.eye(dtec.shape[0]))
+        dx = solve_triangular(L, dtec / dtec_uncert, lower=True)
+        JT = solve_triangular(L, Kstar / dtec_uncert[:, None], lower=True)
+        return JT.T @ dx, jnp.sum(JT * JT, axis=0)
+
+    expect_mean, expect_var = vmap(lambda l, s: vmap(lambda y, u: screen(y, u, l, s))(dtec, dtec_uncert))(
+        lengthscale, sigma)
+    mean, var = binned_screen_marginalisation(kernel, X, Xstar, dtec, dtec_uncert, lengthscale, sigma,
+                                              lengthscale_bins)
+    assert jnp.allclose(mean, jnp.mean(expect_mean, axis=0))
+    assert jnp.allclose(var, jnp.mean(expect_var, axis=0))
+
+
+def select_inducing_points(X, num_inducing):
+    """
+    Choose `num_inducing` inducing points among the rows of X by greedy farthest-point selection, which spreads them
+    evenly over the observed directions. All of X if num_inducing >= len(X).
+
+    Args:
+        X: [N, D]
+        num_inducing: int
+
+    Returns:
+        [M, D]
+    """
+    X = np.asarray(X)
+    if num_inducing >= X.shape[0]:
+        return jnp.asarray(X)
+    chosen = [0]
+    dist = np.linalg.norm(X - X[0], axis=1)
+    for _ in range(num_inducing - 1):
+        chosen.append(int(np.argmax(dist)))
+        dist = np.minimum(dist, np.linalg.norm(X - X[chosen[-1]], axis=1))
+    return jnp.asarray(X[chosen])
+
+
+def inducing_screen_marginalisation(kernel, X, Xstar, Z, dtec, dtec_uncert, lengthscale, sigma, lengthscale_bins,
+                                    screen_chunksize=1024, jitter=1e-6):
+    """
+    Same as binned_screen_marginalisation, but with the cross-covariance to the screen directions replaced by its
+    projection through M inducing points Z (the DTC/projected process approximation),
+        Kstar ~ K(X, Z).K(Z, Z)^-1.K(Z, Xstar)
+    so the per-sample work and accumulated statistics live in the M-dimensional inducing space, and the screen
+    directions are only visited once per occupied lengthscale bin, in chunks. Memory is O(M Nstar) rather than
+    O(N Nstar) per timestep and sample, so thousands of screen directions (or a regular image grid) are feasible.
+    With Z = X the projection is exact.
+
+    Args:
+        kernel: callable(X1, X2, lengthscale, sigma)
+        X: [N, D]
+        Xstar: [Nstar, D]
+        Z: [M, D] inducing points, see select_inducing_points
+        dtec: [B, N]
+        dtec_uncert: [B, N] inf encodes an outlier
+        lengthscale: [S] samples
+        sigma: [S] samples
+        lengthscale_bins: [Nl] increasing
+        screen_chunksize: int, number of screen directions projected at once
+        jitter: float, relative jitter added to K(Z, Z)
+
+    Returns:
+        mean [B, Nstar], var [B, Nstar]
+    """
+    finite = jnp.isfinite(dtec_uncert)
+    w = jnp.where(finite, 1. / jnp.where(finite, dtec_uncert, 1.), 0.)
+    wY = jnp.where(finite, dtec * w, 0.)
+    B, N = dtec.shape
+    M = Z.shape[0]
+    bins = nearest_bin(lengthscale_bins, lengthscale)
+    order = jnp.argsort(bins)
+    bins, sigma = bins[order], sigma[order]
+
+    def Kzz_cholesky(bin):
+        Kzz = kernel(Z, Z, lengthscale_bins[bin], 1.)
+        return jnp.linalg.cholesky(Kzz + jitter * jnp.eye(M))
+
+    def factor(bin):
+        K = kernel(X, X, lengthscale_bins[bin], 1.)
+        Lzz = Kzz_cholesky(bin)
+        # [M, N] K(Z,Z)^-1.K(Z,X)
+        A = cho_solve((Lzz, True), kernel(Z, X, lengthscale_bins[bin], 1.))
+
+        def _per_timestep(w, wY):
+            mu, V = jnp.linalg.eigh(w[:, None] * K * w[None, :])
+            # [M, N] inducing-space version of P^T
+            return jnp.maximum(mu, 0.), (A * w[None, :]) @ V, V.T @ wY
+
+        return vmap(_per_timestep)(w, wY)
+
+    Nstar = Xstar.shape[0]
+    num_chunks = -(-Nstar // screen_chunksize)
+    Xstar_padded = jnp.concatenate([Xstar, jnp.repeat(Xstar[-1:], num_chunks * screen_chunksize - Nstar, axis=0)],
+                                   axis=0).reshape((num_chunks, screen_chunksize, -1))
+
+    def flush(args):
+        # project one bin's statistics onto the screen directions and add them to the running totals
+        (mean, var, bin, a, G) = args
+
+        def _project(Xstar):
+            # [chunk, M]
+            Ksz = kernel(Xstar, Z, lengthscale_bins[bin], 1.)
+            mean = jnp.einsum('sm,bm->bs', Ksz, a)
+            var = jnp.einsum('sm,bmk,sk->bs', Ksz, G, Ksz)
+            return mean, var
+
+        _mean, _var = lax_map(_project, Xstar_padded)
+        return mean + _mean, var + _var
+
+    def body(state, X):
+        (prev_bin, factors, a, G, mean, var) = state
+        (bin, sigma) = X
+        changed = bin != prev_bin
+        # samples are sorted by bin, so the previous bin is complete and only one bin's statistics are ever held
+        mean, var = cond(changed, flush, lambda args: args[:2], (mean, var, prev_bin, a, G))
+        a = jnp.where(changed, 0., a)
+        G = jnp.where(changed, 0., G)
+        factors = cond(changed, factor, lambda bin: factors, bin)
+        (mu, R, q) = factors
+        sigma2 = sigma ** 2
+        d = 1. / (sigma2 * mu + 1.)
+        # [B, M] and [B, M, M] statistics of the current bin
+        a = a + sigma2 * jnp.einsum('bmj,bj->bm', R, d * q)
+        G = G + sigma2 ** 2 * jnp.einsum('bmj,bj,bkj->bmk', R, d, R)
+        return (bin, factors, a, G, mean, var), ()
+
+    zeros = jnp.zeros((num_chunks, B, screen_chunksize))
+    (bin, _, a, G, mean, var), _ = scan(body, (bins[0], factor(bins[0]), jnp.zeros((B, M)), jnp.zeros((B, M, M)),
+                                               zeros, zeros), (bins, sigma))
+    mean, var = flush((mean, var, bin, a, G))
+    # [num_chunks, B, chunk] -> [B, Nstar]
+    mean = jnp.transpose(mean, (1, 0, 2)).reshape((B, -1))[:, :Nstar]
+    var = jnp.transpose(var, (1, 0, 2)).reshape((B, -1))[:, :Nstar]
+    return mean / bins.size, var / bins.size
+
+
+def test_inducing_screen_marginalisation():
+    np.random.seed(1)
+    N, Nstar, B = 25, 300, 2
+    X = jnp.asarray(np.random.uniform(size=(N, 2)))
+    # regular grid of screen directions
+    Xstar = jnp.stack([a.ravel() for a in jnp.meshgrid(jnp.linspace(0., 1., 20), jnp.linspace(0., 1., 15))], axis=1)
+
+    def kernel(X1, X2, lengthscale, sigma):
+        r = jnp.sqrt(jnp.sum((X1[:, None, :] - X2[None, :, :]) ** 2, axis=-1) + 1e-36) / lengthscale
+        return sigma ** 2 * (1. + jnp.sqrt(3.) * r) * jnp.exp(-jnp.sqrt(3.) * r)
+
+    dtec = jnp.asarray(np.random.normal(size=(B, N)))
+    dtec_uncert = jnp.asarray(np.random.uniform(0.1, 0.3, size=(B, N)))
+    dtec_uncert = dtec_uncert.at[1, 4].set(jnp.inf)
+    lengthscale_bins = jnp.linspace(0.2, 1., 9)
+    lengthscale = jnp.asarray(np.random.uniform(0.3, 0.8, size=40))
+    sigma = jnp.asarray(np.random.uniform(0.5, 2., size=40))
+    dense_mean, dense_var = binned_screen_marginalisation(kernel, X, Xstar, dtec, dtec_uncert, lengthscale, sigma,
+                                                          lengthscale_bins)
+    # inducing points at the data are exact
+    mean, var = inducing_screen_marginalisation(kernel, X, Xstar, X, dtec, dtec_uncert, lengthscale, sigma,
+                                                lengthscale_bins, screen_chunksize=128, jitter=1e-10)
+    assert jnp.allclose(mean, dense_mean, atol=1e-5)
+    assert jnp.allclose(var, dense_var, atol=1e-5)
+    # fewer inducing points, accuracy degrades gracefully
+    errors = []
+    for num_inducing in [20, 12]:
+        Z = select_inducing_points(X, num_inducing)
+        mean, var = inducing_screen_marginalisation(kernel, X, Xstar, Z, dtec, dtec_uncert, lengthscale, sigma,
+                                                    lengthscale_bins)
+        errors.append(jnp.sqrt(jnp.mean((mean - dense_mean) ** 2)) / jnp.std(dense_mean))
+    assert errors[0] < 0.2
+    assert errors[0] < errors[1]
+
+
+def stream_gridded_screen(kernel, X, Xstar, dtec, dtec_uncert, lengthscale, sigma, lengthscale_bins, write,
+                          column_chunksize=32, pixel_chunksize=8192):
+    """
+    Screen predictive for many columns (e.g. every antenna and timestep), each with its own hyper-parameters, at a
+    large number of directions (e.g. every pixel of an image grid). Results are pushed through a callback chunk by
+    chunk, so memory is bounded by the chunk sizes rather than by columns x directions.
+
+    Columns are snapped to the nearest of `lengthscale_bins` and visited bin by bin, so the unit-variance kernel
+    between the data directions is formed once per occupied bin. Per column, W.K.W = V.diag(mu).V^T as in
+    binned_screen_marginalisation, from which
+        mean = Kstar^T.alpha, alpha = sigma^2 W.V.diag(d).V^T.W.dtec
+        var = sum_j (R.Kstar)_j^2, R = sigma^2 diag(sqrt(d)).V^T.W
+    with d = 1/(sigma^2 mu + 1). These are precomputed per chunk of columns, after which each chunk of directions
+    costs one cross-covariance evaluation and a batched matmul. Returns the same quantities as the screen solvers:
+    the predictive mean and the variance explained by the data.
+
+    Args:
+        kernel: callable(X1, X2, lengthscale, sigma)
+        X: [N, D]
+        Xstar: [Nstar, D]
+        dtec: [T, N] one row per column
+        dtec_uncert: [T, N] inf encodes an outlier
+        lengthscale: [T]
+        sigma: [T]
+        lengthscale_bins: [Nl] increasing
+        write: callable(columns[n], pixel_slice, mean[n, P], var[n, P])
+        column_chunksize: int, number of columns predicted at once
+        pixel_chunksize: int, number of directions predicted at once
+
+    Returns:
+        number of occupied lengthscale bins
+    """
+    X = jnp.asarray(X)
+    dtec = np.asarray(dtec)
+    dtec_uncert = np.asarray(dtec_uncert)
+    sigma = np.asarray(sigma)
+    T, N = dtec.shape
+    Nstar = Xstar.shape[0]
+    num_chunks = -(-Nstar // pixel_chunksize)
+    Xstar_padded = jnp.concatenate([Xstar, jnp.repeat(Xstar[-1:], num_chunks * pixel_chunksize - Nstar, axis=0)],
+                                   axis=0).reshape((num_chunks, pixel_chunksize, -1))
+    bins = np.asarray(nearest_bin(lengthscale_bins, lengthscale))
+
+    @jit
+    def factor(lengthscale, dtec, dtec_uncert, sigma):
+        K = kernel(X, X, lengthscale, 1.)
+
+        def _per_column(dtec, dtec_uncert, sigma):
+            finite = jnp.isfinite(dtec_uncert)
+            w = jnp.where(finite, 1. / jnp.where(finite, dtec_uncert, 1.), 0.)
+            mu, V = jnp.linalg.eigh(w[:, None] * K * w[None, :])
+            sigma2 = sigma ** 2
+            d = 1. / (sigma2 * jnp.maximum(mu, 0.) + 1.)
+            # [N, N] W.V
+            WV = w[:, None] * V
+            alpha = sigma2 * (WV @ (d * (WV.T @ jnp.where(finite, dtec, 0.))))
+            R = sigma2 * jnp.sqrt(d)[:, None] * WV.T
+            return alpha, R
+
+        return vmap(_per_column)(dtec, dtec_uncert, sigma)
+
+    @jit
+    def predict(lengthscale, alpha, R, Xstar):
+        # [N, P]
+        Kstar = kernel(X, Xstar, lengthscale, 1.)
+        RK = jnp.einsum('cjn,np->cjp', R, Kstar)
+        return alpha @ Kstar, jnp.sum(RK * RK, axis=1)
+
+    occupied = np.unique(bins)
+    t0 = default_timer()
+    num_predicted = 0
+    for i, bin in enumerate(occupied):
+        columns = np.where(bins == bin)[0]
+        for start in range(0, columns.size, column_chunksize):
+            cols = columns[start:start + column_chunksize]
+            # padded to a fixed size, so that factor and predict are only compiled once
+            padded = np.concatenate([cols, np.full(column_chunksize - cols.size, cols[-1])])
+            alpha, R = factor(lengthscale_bins[bin], dtec[padded], dtec_uncert[padded], sigma[padded])
+            for j in range(num_chunks):
+                pixel_slice = slice(j * pixel_chunksize, min((j + 1) * pixel_chunksize, Nstar))
+                mean, var = predict(lengthscale_bins[bin], alpha, R, Xstar_padded[j])
+                n = pixel_slice.stop - pixel_slice.start
+                write(cols, pixel_slice, np.asarray(mean)[:cols.size, :n], np.asarray(var)[:cols.size, :n])
+        num_predicted += columns.size * Nstar
+        dt = default_timer() - t0
+        logger.info("Bin {}/{} (lengthscale {:.3f}, {} columns): {:.2f} Mpixels/s".format(
+            i + 1, occupied.size, float(lengthscale_bins[bin]), columns.size, num_predicted / max(dt, 1e-9) / 1e6))
+    return occupied.size
+
+
+def test_stream_gridded_screen():
+    np.random.seed(2)
+    N, T = 20, 11
+    X = jnp.asarray(np.random.uniform(size=(N, 2)))
+    Xstar = jnp.stack([a.ravel() for a in jnp.meshgrid(jnp.linspace(0., 1., 13), jnp.linspace(0., 1., 7))], axis=1)
+
+    def kernel(X1, X2, lengthscale, sigma):
+        r = jnp.sqrt(jnp.sum((X1[:, None, :] - X2[None, :, :]) ** 2, axis=-1) + 1e-36) / lengthscale
+        return sigma ** 2 * (1. + jnp.sqrt(3.) * r) * jnp.exp(-jnp.sqrt(3.) * r)
+
+    dtec = jnp.asarray(np.random.normal(size=(T, N)))
+    dtec_uncert = jnp.asarray(np.random.uniform(0.1, 0.3, size=(T, N)))
+    dtec_uncert = dtec_uncert.at[3, 5].set(jnp.inf)
+    dtec = dtec.at[3, 5].set(jnp.nan)
+    lengthscale_bins = jnp.linspace(0.2, 1., 5)
+    # on the bins, so that snapping is exact
+    lengthscale = lengthscale_bins[jnp.arange(T) % 3]
+    sigma = jnp.asarray(np.random.uniform(0.5, 2., size=T))
+    mean = np.zeros((T, Xstar.shape[0]))
+    var = np.zeros((T, Xstar.shape[0]))
+
+    def write(columns, pixel_slice, _mean, _var):
+        mean[columns, pixel_slice] = _mean
+        var[columns, pixel_slice] = _var
+
+    assert stream_gridded_screen(kernel, X, Xstar, dtec, dtec_uncert, lengthscale, sigma, lengthscale_bins, write,
+                                 column_chunksize=2, pixel_chunksize=40) == 3
+    for t in range(T):
+        keep = jnp.isfinite(dtec_uncert[t])
+        expect_mean, expect_var = binned_screen_marginalisation(kernel, X[keep], Xstar, dtec[t][keep][None],
+                                                                dtec_uncert[t][keep][None], lengthscale[t:t + 1],
+                                                                sigma[t:t + 1], lengthscale_bins)
+        assert jnp.allclose(mean[t], expect_mean[0])
+        assert jnp.allclose(var[t], expect_var[0])
+
+
+def kronecker_screen(kernel, time_kernel, X, Xstar, times, dtec, dtec_uncert, lengthscale, sigma, time_lengthscale,
+                     key=None, num_samples=128, tol=1e-6, maxiter=200, max_dense_size=2048):
+    """
+    Screen predictive for a block of timesteps under the separable prior
+        cov(f(x, t), f(x', t')) = sigma^2 k(x, x'; lengthscale) k_t(t, t'; time_lengthscale)
+    so the screen is coherent in time as well as space. The data is whitened by W = 1/dtec_uncert (zero for
+    outliers), and
+        (W.(sigma^2 Ks x Kt).W + I).z = W.dtec
+    is solved by preconditioned conjugate gradients, with the matrix-vector products done as Ks.V.Kt so no
+    (N Nt)^2 matrix is formed. The preconditioner is the same system with W^2 replaced by its mean, which is
+    diagonalised by the separate eigendecompositions of Ks and Kt, and is exact for homoscedastic data. Cost is
+    O(N^3 + Nt^3) plus O(N Nt (N + Nt)) per iteration.
+
+    Like the other screen predictors the returned variance is the part explained by the data,
+    diag(Kstar^T.(K + D)^-1.Kstar). It is exact when N Nt <= `max_dense_size` (e.g. one production block of ~40
+    directions x ~10 timesteps), from a dense Cholesky of the whitened (N Nt)^2 system, and for homoscedastic data
+    without outliers, from the same eigendecompositions as the preconditioner. Otherwise it is estimated
+    stochastically: for g ~ N(0, K + D) drawn with the Kronecker factors, Kstar^T.(K + D)^-1.g has exactly that
+    covariance, so each of the `num_samples` draws costs one more solve (done alongside the mean solve). That
+    estimate is noisy, with a relative standard error of about sqrt(2 / num_samples) per entry.
+
+    Args:
+        kernel: callable(X1, X2, lengthscale, sigma)
+        time_kernel: callable(T1, T2, time_lengthscale, sigma)
+        X: [N, D]
+        Xstar: [Nstar, D]
+        times: [Nt] in the units of time_lengthscale
+        dtec: [N, Nt]
+        dtec_uncert: [N, Nt] inf encodes an outlier
+        lengthscale: float
+        sigma: float
+        time_lengthscale: float
+        key: PRNG key for the variance estimate
+        num_samples: int, samples for the heteroscedastic variance estimate, zero to skip the variance.
+        tol: float, relative tolerance of the conjugate gradient solves.
+        maxiter: int, maximum conjugate gradient iterations.
+        max_dense_size: int, largest N Nt for which the variance is computed exactly with a dense Cholesky.
+
+    Returns:
+        mean [Nstar, Nt], var [Nstar, Nt]
+    """
+    finite = jnp.isfinite(dtec_uncert)
+    w = jnp.where(finite, 1. / jnp.where(finite, dtec_uncert, 1.), 0.)
+    wY = jnp.where(finite, dtec * w, 0.)
+    N, Nt = dtec.shape
+    Ks = kernel(X, X, lengthscale, 1.)
+    Kt = time_kernel(times[:, None], times[:, None], time_lengthscale, 1.)
+    Kstar = kernel(X, Xstar, lengthscale, 1.)
+    sigma2 = sigma ** 2
+
+    def matvec(V):
+        return sigma2 * w * (Ks @ (w * V) @ Kt) + V
+
+    lambda_s, Qs = jnp.linalg.eigh(Ks)
+    lambda_t, Qt = jnp.linalg.eigh(Kt)
+    lambda_s, lambda_t = jnp.maximum(lambda_s, 0.), jnp.maximum(lambda_t, 0.)
+    mean_w2 = jnp.sum(w ** 2) / jnp.maximum(jnp.sum(finite), 1.)
+    precond_diag = 1. / (sigma2 * mean_w2 * lambda_s[:, None] * lambda_t[None, :] + 1.)
+
+    def precond(V):
+        return Qs @ ((Qs.T @ V @ Qt) * precond_diag) @ Qt.T
+
+    def predict(b):
+        z, _ = cg(matvec, b, M=precond, tol=tol, maxiter=maxiter)
+        return sigma2 * Kstar.T @ (w * z) @ Kt
+
+    mean = predict(wY)
+    if num_samples == 0:
+        return mean, jnp.zeros_like(mean)
+    if N * Nt <= max_dense_size:
+        # whitened system, directions major, outliers have zero weight so their rows are the identity
+        w_flat = w.reshape((-1,))
+        L = jnp.linalg.cholesky(sigma2 * w_flat[:, None] * jnp.kron(Ks, Kt) * w_flat[None, :] + jnp.eye(N * Nt))
+
+        def dense_var(kstar):
+            # [N Nt, Nt] whitened cross-covariance to one screen direction at every timestep
+            J = solve_triangular(L, sigma2 * w_flat[:, None] * jnp.kron(kstar[:, None], Kt), lower=True)
+            return jnp.sum(J * J, axis=0)
+
+        return mean, lax_map(dense_var, Kstar.T)
+
+    def exact_var(operand):
+        # the preconditioner is the system itself, sum_ij (Qs^T.Kstar)_is^2 (Qt^T.Kt)_jt^2 precond_diag_ij
+        a2 = (Qs.T @ Kstar) ** 2
+        b2 = (lambda_t[:, None] * Qt.T) ** 2
+        return sigma2 ** 2 * mean_w2 * (a2.T @ precond_diag @ b2)
+
+    def stochastic_var(key):
+        # g ~ N(0, K + D) in whitened form
+        key1, key2 = random.split(key)
+        Ls = Qs * jnp.sqrt(lambda_s)
+        Lt = Qt * jnp.sqrt(lambda_t)
+        f = jnp.sqrt(sigma2) * jnp.einsum('ij,sjk,lk->sil', Ls, random.normal(key1, (num_samples, N, Nt)), Lt)
+        g = w * f + jnp.where(finite, random.normal(key2, (num_samples, N, Nt)), 0.)
+        return jnp.mean(vmap(predict)(g) ** 2, axis=0)
+
+    homoscedastic = jnp.all(finite) & jnp.all(w == w[0, 0])
+    var = cond(homoscedastic, exact_var, stochastic_var, key)
+    return mean, var
+
+
+def test_kronecker_screen():
+    np.random.seed(2)
+    N, Nstar, Nt = 12, 5, 9
+    X = jnp.asarray(np.random.uniform(size=(N, 2)))
+    Xstar = jnp.asarray(np.random.uniform(size=(Nstar, 2)))
+    times = jnp.arange(Nt) * 30.
+
+    def kernel(X1, X2, lengthscale, sigma):
+        r = jnp.sqrt(jnp.sum((X1[:, None, :] - X2[None, :, :]) ** 2, axis=-1) + 1e-36) / lengthscale
+        return sigma ** 2 * (1. + jnp.sqrt(3.) * r) * jnp.exp(-jnp.sqrt(3.) * r)
+
+    dtec = jnp.asarray(np.random.normal(size=(N, Nt)))
+    dtec_uncert = jnp.asarray(np.random.uniform(0.2, 0.5, size=(N, Nt)))
+    dtec_uncert = dtec_uncert.at[3, 4].set(jnp.inf)
+    lengthscale, sigma, time_lengthscale = 0.5, 1.5, 120.
+    mean, var = kronecker_screen(kernel, kernel, X, Xstar, times, dtec, dtec_uncert, lengthscale, sigma,
+                                 time_lengthscale, key=random.PRNGKey(0), tol=1e-10)
+    _, stochastic_var = kronecker_screen(kernel, kernel, X, Xstar, times, dtec, dtec_uncert, lengthscale, sigma,
+                                         time_lengthscale, key=random.PRNGKey(0), num_samples=2000, tol=1e-10,
+                                         max_dense_size=0)
+    # dense reference, directions major
+    K = jnp.kron(kernel(X, X, lengthscale, sigma), kernel(times[:, None], times[:, None], time_lengthscale, 1.))
+    Kstar = jnp.kron(kernel(X, Xstar, lengthscale, sigma), kernel(times[:, None], times[:, None], time_lengthscale, 1.))
+    finite = jnp.isfinite(dtec_uncert.ravel())
+    keep = jnp.where(finite)[0]
+    K, Kstar = K[keep][:, keep], Kstar[keep]
+    A = K + jnp.diag(dtec_uncert.ravel()[keep] ** 2)
+    expect_mean = (Kstar.T @ jnp.linalg.solve(A, dtec.ravel()[keep])).reshape((Nstar, Nt))
+    expect_var = jnp.sum(Kstar * jnp.linalg.solve(A, Kstar), axis=0).reshape((Nstar, Nt))
+    assert jnp.allclose(mean, expect_mean, atol=1e-6)
+    # small enough for the exact dense variance, and the stochastic estimate agrees
+    assert jnp.allclose(var, expect_var, atol=1e-8)
+    assert jnp.allclose(stochastic_var, expect_var, rtol=0.15)
+    # homoscedastic, the variance is exact without the dense system too
+    dtec_uncert = jnp.full((N, Nt), 0.3)
+    mean, var = kronecker_screen(kernel, kernel, X, Xstar, times, dtec, dtec_uncert, lengthscale, sigma,
+                                 time_lengthscale, key=random.PRNGKey(0), tol=1e-10, max_dense_size=0)
+    K = jnp.kron(kernel(X, X, lengthscale, sigma), kernel(times[:, None], times[:, None], time_lengthscale, 1.))
+    Kstar = jnp.kron(kernel(X, Xstar, lengthscale, sigma), kernel(times[:, None], times[:, None], time_lengthscale, 1.))
+    A = K + 0.3 ** 2 * jnp.eye(N * Nt)
+    expect_var = jnp.sum(Kstar * jnp.linalg.solve(A, Kstar), axis=0).reshape((Nstar, Nt))
+    assert jnp.allclose(var, expect_var, atol=1e-8)
+
+
+def antenna_group_members(antenna_groups):
+    """
+    Member table of antenna groups.
+
+    Args:
+        antenna_groups: [Na] int group labels 0..G-1
+
+    Returns:
+        members [G, S] antenna indices of each group, padded with Na, where S is the largest group size,
+        and the group [Na] and slot [Na] of each antenna within members.
+    """
+    antenna_groups = np.asarray(antenna_groups)
+    Na = antenna_groups.size
+    G = antenna_groups.max() + 1
+    S = np.bincount(antenna_groups, minlength=G).max()
+    members = np.full((G, S), Na)
+    slot = np.zeros(Na, dtype=np.int64)
+    for g in range(G):
+        idx = np.where(antenna_groups == g)[0]
+        members[g, :idx.size] = idx
+        slot[idx] = np.arange(idx.size)
+    return members, antenna_groups, slot
+
+
+def sequential_grid_marginalisation(key, kernel, X, dtec, dtec_uncert, lengthscale_array, sigma_array,
+                                    screen_marginalisation, num_samples, box_shape=(16, 16), widen=2., tol=1e-3,
+                                    edge_mass=0.01, max_evidence_drop=0.5):
+    """
+    Grid marginalisation over consecutive time blocks, where each block's prior is the previous block's posterior
+    box widened by `widen`, rather than the whole prior box. The log_prob table of a block is evaluated only on a
+    `box_shape` grid spanning that box, so it's both smaller than the dense table over the whole prior and finer
+    where the posterior is. The first block, and blocks that fall back, are tabulated on the dense
+    `lengthscale_array` x `sigma_array` grid over the whole prior.
+
+    A block falls back to the whole prior box when more than `edge_mass` of its posterior lies in the outer cells on a
+    side of the warm-start box that isn't also a side of the whole prior (the hyper-parameters moved), or when its
+    evidence per observation drops by more than `max_evidence_drop` nats from the previous block's (the box no longer
+    explains the data). Evidences are always with respect to the uniform prior over the whole box, taking the
+    likelihood outside a warm-start box as negligible, so they are comparable between blocks.
+
+    Args:
+        key: PRNG key
+        kernel: callable(X1, X2, lengthscale, sigma)
+        X: [N, D]
+        dtec: [Nb, B, N] consecutive time blocks
+        dtec_uncert: [Nb, B, N] inf encodes an outlier
+        lengthscale_array: [Nl] dense grid spanning the whole lengthscale prior
+        sigma_array: [Ns] dense grid spanning the whole sigma prior
+        screen_marginalisation: callable(dtec, dtec_uncert, lengthscale, sigma) -> mean [B, Nstar], var [B, Nstar]
+            averaged over hyper-parameter samples
+        num_samples: int, number of hyper-parameter samples per block
+        box_shape: (int, int), grid size within warm-start boxes
+        widen: float, factor the posterior box is widened by to give the next block's prior
+        tol: float, posterior mass allowed outside the posterior box
+        edge_mass: float, posterior mass in the outer cells of the warm-start box that triggers a fallback
+        max_evidence_drop: float, nats per observation
+
+    Returns:
+        per block: mean [Nb, B, Nstar], var [Nb, B, Nstar], mean_lengthscale [Nb], mean_logsigma [Nb], ESS [Nb],
+        logZ [Nb], num_likelihood_evaluations [Nb], restarted [Nb] bool
+    """
+    Nl, Ns = lengthscale_array.size, sigma_array.size
+    full_lower = jnp.asarray([lengthscale_array[0], sigma_array[0]])
+    full_upper = jnp.asarray([lengthscale_array[-1], sigma_array[-1]])
+    # the warm-start box is never narrower than a few cells of the dense grid
+    min_width = 4. * (full_upper - full_lower) / jnp.asarray([Nl - 1, Ns - 1])
+    # the uncertainties are traced, so every column takes the general path
+    homoscedastic = np.zeros(dtec.shape[1], dtype=np.bool_)
+
+    def tabulate(lengthscale_array, sigma_array, dtec, dtec_uncert):
+        def compute_log_prob_components(lengthscale):
+            K = kernel(X, X, lengthscale, 1.)
+            # Ns
+            return jnp.sum(batched_log_normal_with_outliers(K, sigma_array, dtec, dtec_uncert, homoscedastic),
+                           axis=-1)
+
+        # Nl, Ns
+        log_prob = lax_map(compute_log_prob_components, lengthscale_array)
+        return grid_quadrature(log_prob, lengthscale_array, sigma_array)
+
+    def marginals(results):
+        cell_weights = jnp.exp(results.log_cell_weights)
+        return [jnp.sum(cell_weights, axis=1 - axis) for axis in range(2)]
+
+    def mass_box(results):
+        lower, upper = [], []
+        for axis, marginal in enumerate(marginals(results)):
+            cdf = jnp.cumsum(marginal)
+            first = jnp.argmax(cdf > 0.5 * tol)
+            last = jnp.minimum(jnp.sum(cdf < 1. - 0.5 * tol), cdf.size - 1)
+            centres, widths = results.cell_centres[axis], results.cell_widths[axis]
+            lower.append(centres[first] - 0.5 * widths[first])
+            upper.append(centres[last] + 0.5 * widths[last])
+        return jnp.stack(lower), jnp.stack(upper)
+
+    def summarise(key, results, lower, upper):
+        # fixed-size summary of a block's table, whichever grid it is on
+        lengthscale, sigma = sample_grid_posterior(key, results, num_samples)
+        mean_lengthscale = grid_posterior_mean(results, lambda lengthscale, sigma: lengthscale)
+        mean_logsigma = grid_posterior_mean(results, lambda lengthscale, sigma: jnp.log(sigma))
+        # evidence under the uniform prior over the whole box
+        logZ = results.logZ + jnp.sum(jnp.log((upper - lower) / (full_upper - full_lower)))
+        post_lower, post_upper = mass_box(results)
+        return lengthscale, sigma, mean_lengthscale, mean_logsigma, results.ESS, logZ, post_lower, post_upper
+
+    def cold_block(operand):
+        (lower, upper, prev_logZ, key, dtec, dtec_uncert) = operand
+        return summarise(key, tabulate(lengthscale_array, sigma_array, dtec, dtec_uncert), full_lower, full_upper)
+
+    def warm_block(operand):
+        (lower, upper, prev_logZ, key, dtec, dtec_uncert) = operand
+        results = tabulate(jnp.linspace(lower[0], upper[0], box_shape[0]),
+                           jnp.linspace(lower[1], upper[1], box_shape[1]), dtec, dtec_uncert)
+        lower_mass, upper_mass = jnp.stack([marginal[0] for marginal in marginals(results)]), \
+                                 jnp.stack([marginal[-1] for marginal in marginals(results)])
+        moved = jnp.any(((lower_mass > edge_mass) & (lower > full_lower))
+                        | ((upper_mass > edge_mass) & (upper < full_upper)))
+        summary = summarise(key, results, lower, upper)
+        restarted = moved | (summary[5] / num_observations(dtec_uncert) < prev_logZ - max_evidence_drop)
+        return cond(restarted, cold_block, lambda _: summary, operand), restarted
+
+    def num_observations(dtec_uncert):
+        return jnp.maximum(jnp.sum(jnp.isfinite(dtec_uncert)), 1)
+
+    def body(state, X):
+        (lower, upper, prev_logZ) = state
+        (key, dtec, dtec_uncert) = X
+        operand = (lower, upper, prev_logZ, key, dtec, dtec_uncert)
+        # no previous block to start from
+        first = jnp.isneginf(prev_logZ)
+        summary, restarted = cond(first, lambda operand: (cold_block(operand), jnp.asarray(False)), warm_block,
+                                  operand)
+        lengthscale, sigma, mean_lengthscale, mean_logsigma, ESS, logZ, post_lower, post_upper = summary
+        mean, var = screen_marginalisation(dtec, dtec_uncert, lengthscale, sigma)
+        # next block's prior
+        centre = 0.5 * (post_lower + post_upper)
+        half_width = jnp.maximum(0.5 * widen * (post_upper - post_lower), 0.5 * min_width)
+        lower = jnp.maximum(centre - half_width, full_lower)
+        upper = jnp.minimum(centre + half_width, full_upper)
+        num_evaluations = jnp.where(first, 0, box_shape[0] * box_shape[1]) + jnp.where(first | restarted, Nl * Ns, 0)
+        return (lower, upper, logZ / num_observations(dtec_uncert)), (mean, var, mean_lengthscale, mean_logsigma, ESS,
+                                                                      logZ, num_evaluations, restarted)
+
+    keys = random.split(key, dtec.shape[0])
+    _, outputs = scan(body, (full_lower, full_upper, -jnp.inf), (keys, dtec, dtec_uncert))
+    return outputs
+
+
+def test_sequential_grid_marginalisation():
+    np.random.seed(3)
+    N, B, Nb = 15, 3, 6
+    X = jnp.asarray(np.random.uniform(size=(N, 2)))
+
+    def kernel(X1, X2, lengthscale, sigma):
+        r = jnp.sqrt(jnp.sum((X1[:, None, :] - X2[None, :, :]) ** 2, axis=-1) + 1e-36) / lengthscale
+        return sigma ** 2 * (1. + jnp.sqrt(3.) * r) * jnp.exp(-jnp.sqrt(3.) * r)
+
+    def simulate(lengthscale, sigma):
+        L = jnp.linalg.cholesky(kernel(X, X, lengthscale, sigma) + 1e-6 * jnp.eye(N))
+        return (L @ np.random.normal(size=(N, B))).T + 0.1 * np.random.normal(size=(B, N))
+
+    # slowly varying, then a jump
+    truth = [(0.3, 2.), (0.3, 2.1), (0.32, 2.), (0.3, 1.9), (0.9, 8.), (0.9, 8.)]
+    dtec = jnp.stack([simulate(*params) for params in truth])
+    dtec_uncert = 0.1 * jnp.ones((Nb, B, N))
+    lengthscale_array = jnp.linspace(0.05, 2., 40)
+    sigma_array = jnp.linspace(0., 10., 50)
+
+    def screen_marginalisation(dtec, dtec_uncert, lengthscale, sigma):
+        return jnp.zeros((B, 1)), jnp.zeros((B, 1))
+
+    mean, var, mean_lengthscale, mean_logsigma, ESS, logZ, num_evaluations, restarted = \
+        sequential_grid_marginalisation(random.PRNGKey(0), kernel, X, dtec, dtec_uncert, lengthscale_array,
+                                        sigma_array, screen_marginalisation, num_samples=10)
+    # warm-started while the hyper-parameters drift, and recovered at the jump
+    assert not jnp.any(restarted[:4])
+    assert restarted[4]
+    assert jnp.all(jnp.isfinite(logZ))
+    assert num_evaluations[0] == 40 * 50 and num_evaluations[1] == 16 * 16
+    # warm-start evidences are with respect to the whole prior, so they match the dense table's
+    results = grid_quadrature(vmap(lambda l: jnp.sum(batched_log_normal_with_outliers(
+        kernel(X, X, l, 1.), sigma_array, dtec[1], dtec_uncert[1], np.zeros(B, dtype=np.bool_)), axis=-1))(
+        lengthscale_array), lengthscale_array, sigma_array)
+    assert jnp.abs(logZ[1] - results.logZ) < 0.5
+    sigma = jnp.exp(mean_logsigma)
+    assert jnp.all(jnp.abs(sigma[:4] - 2.) < 0.6)
+    assert jnp.all(jnp.abs(sigma[4:] - 8.) < 2.5)
+
+
+def test_antenna_group_members():
+    members, group, slot = antenna_group_members(np.asarray([0, 1, 0, 2, 0, 1]))
+    assert np.all(members == [[0, 2, 4], [1, 5, 6], [3, 6, 6]])
+    assert np.all(members[group, slot] == np.arange(6))
+
+
+def solve_with_vanilla_kernel(key, dtec, dtec_uncert, X, Xstar, fed_kernel, time_block_size, chunksize,
+                              marginalisation='nested_sampling', num_samples=500, adaptive_grid_tol=None,
+                              laplace=False, cache_dir=None, num_inducing=None, antenna_groups=None, warm_start=False):
     """
     Precompute look-up tables for all blocks.
 
@@ -240,67 +1537,118 @@ def solve_with_vanilla_kernel(key, dtec, dtec_uncert, X, Xstar, fed_kernel, time
         fed_kernel: StationaryKernel
         time_block_size: int
         chunksize: int number of parallel devices to use.
+        marginalisation: str, 'grid' to integrate the (lengthscale, sigma) posterior by quadrature over the
+            precomputed log_prob table, 'nested_sampling' to run a nested sampler on the interpolated table, or
+            'optimise' for a type-II maximum likelihood point estimate found with damped Newton steps from the best
+            point of a coarse table. Without laplace there is no evidence estimate, so logZ is NaN.
+        num_samples: int, number of hyper-parameter samples the screen is marginalised over.
+        adaptive_grid_tol: float or None, if given the (lengthscale, sigma) table is built coarse-to-fine, refining
+            where all but this much posterior mass lies (see build_adaptive_grid), instead of on the dense grid.
+        laplace: bool, with marginalisation='optimise', find the MAP (in log-hyper-parameters) instead and marginalise
+            the screen over a Laplace approximation around it, which also gives an evidence estimate.
+        cache_dir: str or None, if given log_prob tables are cached there (see ArrayCache), keyed by X, the kernel,
+            the hyper-parameter grids and the data, so reruns with other marginalisation settings skip computing them.
+        num_inducing: int or None, if given the screen is predicted through this many inducing points chosen among
+            X (see inducing_screen_marginalisation), so memory scales as O(num_inducing * Nd_screen) and thousands of
+            screen directions are feasible. Does not apply to marginalisation='optimise' without laplace, which
+            predicts at a single point densely.
+        antenna_groups: [Na] int or None, group label of each antenna (see utils.cluster_antennas). If given, the
+            log_prob tables of a group's antennas are summed and the hyper-parameters are inferred once per group and
+            block, while screens are still predicted per antenna.
+        warm_start: bool, with marginalisation='grid', process the time blocks of each antenna (or group) in order,
+            with each block's prior the previous block's widened posterior box, and its table only evaluated there
+            (see sequential_grid_marginalisation). Replaces the up-front table over the whole prior.
 
     """
+    if marginalisation not in ('grid', 'nested_sampling', 'optimise'):
+        raise ValueError(f"marginalisation should be 'grid', 'nested_sampling' or 'optimise', got {marginalisation}.")
+    if warm_start and (marginalisation != 'grid' or adaptive_grid_tol is not None):
+        raise ValueError("warm_start needs marginalisation='grid' without adaptive_grid_tol.")
     field_of_view = 4. #deg
     min_separation_arcmin = 4. #drcmin
     min_separation_deg = min_separation_arcmin / 60.
-    lengthscale_array = jnp.linspace(min_separation_deg, field_of_view, 120)
-    sigma_array = jnp.linspace(0., 150., 150)
     kernel = fed_kernel
-    lookup_func = build_lookup_index(lengthscale_array, sigma_array)
 
     dtec_uncert = jnp.maximum(dtec_uncert, 1e-6)
 
     Nd,Na,Nt = dtec.shape
-    remainder = Nt % time_block_size
-    extra = time_block_size - remainder
-    dtec = jnp.concatenate([dtec,dtec[:, :,Nt-extra:]], axis=-1)
-    dtec_uncert = jnp.concatenate([dtec_uncert,dtec_uncert[:, :,Nt-extra:]], axis=-1)
-    Nt = dtec.shape[-1]
+    extra = (-Nt) % time_block_size
+    # repeat the last timestep up to a whole number of blocks, which may be more than Nt
+    dtec = jnp.pad(dtec, ((0, 0), (0, 0), (0, extra)), mode='edge')
+    dtec_uncert = jnp.pad(dtec_uncert, ((0, 0), (0, 0), (0, extra)), mode='edge')
+    Nt_data, Nt = Nt, dtec.shape[-1]
     size_dict = dict(a=Na, d=Nd, b=time_block_size)
     dtec = axes_move(dtec, ['d','a','tb'], ['atb','d'],size_dict=size_dict)
     dtec_uncert = axes_move(dtec_uncert, ['d','a','tb'], ['atb', 'd'],size_dict=size_dict)
 
-    def compute_log_prob_components(lengthscale):
-        # N, N
-        K = kernel(X, X, lengthscale, 1.)
-        def _compute_with_sigma(sigma):
-            def _compute(dtec, dtec_uncert):
-                #each [Nd]
-                return log_normal_with_outliers(dtec, 0., sigma ** 2 * K, dtec_uncert)
-            return chunked_pmap(_compute, dtec, dtec_uncert, chunksize=1)#M
-        # Ns,M
-        return chunked_pmap(_compute_with_sigma, sigma_array, chunksize=1)
-    # Nl,Ns,M
-    log_prob = chunked_pmap(compute_log_prob_components, lengthscale_array, chunksize=chunksize)
-    # Na * (Nt//time_block_size),block_size,Nl,Ns
-    log_prob = axes_move(log_prob, ['l','s','atb'],['at', 'b', 'l','s'], size_dict=size_dict)
-    # Na * (Nt//time_block_size),Nl,Ns
-    log_prob = jnp.sum(log_prob, axis=1)#independent datasets summed up.
+    homoscedastic = _homoscedastic_columns(dtec_uncert)
+
+    def compute_log_prob(lengthscale_array, sigma_array):
+        def compute_log_prob_components(lengthscale):
+            # N, N
+            K = kernel(X, X, lengthscale, 1.)
+            # Ns,M
+            return batched_log_normal_with_outliers(K, sigma_array, dtec, dtec_uncert, homoscedastic)
+        # Nl,Ns,M
+        log_prob = chunked_pmap(compute_log_prob_components, lengthscale_array, chunksize=chunksize)
+        # Na * (Nt//time_block_size),block_size,Nl,Ns
+        log_prob = axes_move(log_prob, ['l','s','atb'],['at', 'b', 'l','s'], size_dict=size_dict)
+        # Na * (Nt//time_block_size),Nl,Ns
+        return jnp.sum(log_prob, axis=1)#independent datasets summed up.
+
+    if cache_dir is not None:
+        cache = ArrayCache(cache_dir)
+        _compute_log_prob = compute_log_prob
+
+        def compute_log_prob(lengthscale_array, sigma_array):
+            # bump log_prob_version when the table computation changes
+            key = cache.key(X, lengthscale_array, sigma_array, dtec, dtec_uncert,
+                            kernel=type(kernel).__name__, time_block_size=time_block_size, Na=Na,
+                            log_prob_version=1)
+            # the table is used on device, so a hit is read in full: the cache saves the computation, not memory
+            return jnp.asarray(cache.get_or_compute(key, lambda: _compute_log_prob(lengthscale_array, sigma_array)))
+
+    if warm_start:
+        # the dense grid for cold and fallback blocks, the rest are tabulated per block by
+        # sequential_grid_marginalisation
+        lengthscale_array = jnp.linspace(min_separation_deg, field_of_view, 120)
+        sigma_array = jnp.linspace(0., 150., 150)
+        log_prob = None
+    elif marginalisation == 'optimise':
+        # only used to initialise the optimiser
+        lengthscale_array = jnp.linspace(min_separation_deg, field_of_view, 16)
+        sigma_array = jnp.linspace(0., 150., 16)
+        log_prob = compute_log_prob(lengthscale_array, sigma_array)
+    elif adaptive_grid_tol is None:
+        lengthscale_array = jnp.linspace(min_separation_deg, field_of_view, 120)
+        sigma_array = jnp.linspace(0., 150., 150)
+        log_prob = compute_log_prob(lengthscale_array, sigma_array)
+    else:
+        (lengthscale_array, sigma_array), log_prob, num_evaluations = \
+            build_adaptive_grid(compute_log_prob,
+                                jnp.linspace(min_separation_deg, field_of_view, 16),
+                                jnp.linspace(0., 150., 16),
+                                tol=adaptive_grid_tol)
+        logger.info(f"Adaptive grid: {lengthscale_array.size} lengthscales x {sigma_array.size} sigmas, "
+                    f"{num_evaluations} grid points evaluated.")
+    lookup_func = build_lookup_index(lengthscale_array, sigma_array)
+    # hyper-parameter samples are snapped to these lengthscales when marginalising the screen
+    lengthscale_bins = jnp.linspace(min_separation_deg, field_of_view, 120)
+    if num_inducing is None:
+        def screen_marginalisation(dtec, dtec_uncert, lengthscale, sigma):
+            return binned_screen_marginalisation(kernel, X, Xstar, dtec, dtec_uncert, lengthscale, sigma,
+                                                 lengthscale_bins)
+    else:
+        Z = select_inducing_points(X, num_inducing)
+        logger.info(f"Predicting {Xstar.shape[0]} screen directions through {Z.shape[0]} inducing points.")
+
+        def screen_marginalisation(dtec, dtec_uncert, lengthscale, sigma):
+            return inducing_screen_marginalisation(kernel, X, Xstar, Z, dtec, dtec_uncert, lengthscale, sigma,
+                                                   lengthscale_bins)
 
     def run_block(key, dtec, dtec_uncert, log_prob):
         key1, key2 = random.split(key, 2)
 
-        def log_likelihood(lengthscale, sigma, **kwargs):
-            # K = kernel(X, X, lengthscale, sigma)
-            # def _compute(dtec, dtec_uncert):
-            #     #each [Nd]
-            #     return log_normal_with_outliers(dtec, 0., K, jnp.maximum(1e-6, dtec_uncert))
-            # return chunked_pmap(_compute, dtec, dtec_uncert, chunksize=1).sum()
-            return lookup_func(log_prob, lengthscale, sigma)
-
-        lengthscale = UniformPrior('lengthscale', jnp.min(lengthscale_array), jnp.max(lengthscale_array))
-        sigma = UniformPrior('sigma', sigma_array.min(), sigma_array.max())
-        prior_chain = PriorChain(lengthscale, sigma)
-
-        ns = NestedSampler(loglikelihood=log_likelihood,
-                           prior_chain=prior_chain,
-                           sampler_kwargs=dict(num_slices=prior_chain.U_ndims * 1),
-                           num_live_points=prior_chain.U_ndims * 50)
-        ns = jit(ns)
-        results = ns(key1, termination_evidence_frac=0.1)
-
         def marg_func(lengthscale, sigma, **kwargs):
             def screen(dtec, dtec_uncert, **kw):
                 K = kernel(X, X, lengthscale, sigma)
@@ -315,23 +1663,145 @@ def solve_with_vanilla_kernel(key, dtec, dtec_uncert, X, Xstar, fed_kernel, time
                 return mean, var
             return vmap(screen)(dtec, dtec_uncert), lengthscale, jnp.log(sigma)#[time_block_size,  Nd_screen], [time_block_size,  Nd_screen]
 
-        #[time_block_size,  Nd_screen], [time_block_size,  Nd_screen], [time_block_size]
-        (mean, var), mean_lengthscale, mean_logsigma = marginalise_static(key2, results.samples, results.log_p, 500, marg_func)
+        if marginalisation == 'grid':
+            results = grid_quadrature(log_prob, lengthscale_array, sigma_array)
+            lengthscale, sigma = sample_grid_posterior(key1, results, num_samples)
+            # [time_block_size,  Nd_screen], [time_block_size,  Nd_screen]
+            mean, var = screen_marginalisation(dtec, dtec_uncert, lengthscale, sigma)
+            mean_lengthscale = grid_posterior_mean(results, lambda lengthscale, sigma: lengthscale)
+            mean_logsigma = grid_posterior_mean(results, lambda lengthscale, sigma: jnp.log(sigma))
+        elif marginalisation == 'optimise':
+            # optimise over log(lengthscale), log(sigma) within the prior box
+            lower = jnp.log(jnp.asarray([min_separation_deg, 0.1]))
+            upper = jnp.log(jnp.asarray([field_of_view, 150.]))
+            log_prior_volume = jnp.log((field_of_view - min_separation_deg) * 150.)
+
+            def objective(params):
+                lengthscale, sigma = jnp.exp(params)
+                K = kernel(X, X, lengthscale, sigma)
+                log_likelihood = jnp.sum(vmap(lambda dtec, dtec_uncert: masked_log_normal(dtec, K, dtec_uncert))(
+                    dtec, dtec_uncert))
+                if laplace:
+                    # uniform prior on (lengthscale, sigma), in log coordinates
+                    return log_likelihood + jnp.sum(params) - log_prior_volume
+                return log_likelihood
+
+            i, j = jnp.unravel_index(jnp.argmax(log_prob), log_prob.shape)
+            init = jnp.clip(jnp.log(jnp.asarray([lengthscale_array[i], jnp.maximum(sigma_array[j], 0.1)])),
+                            lower, upper)
+            num_steps = 30
+            params = projected_newton(objective, init, lower, upper, num_steps=num_steps)
+            if laplace:
+                cov, logZ = laplace_approximation(objective, params)
+                samples = params + random.normal(key1, (num_samples, 2)) @ jnp.linalg.cholesky(cov).T
+                samples = jnp.exp(jnp.clip(samples, lower, upper))
+                mean, var = screen_marginalisation(dtec, dtec_uncert, samples[:, 0], samples[:, 1])
+                ESS = num_samples
+            else:
+                (mean, var), _, _ = marg_func(*jnp.exp(params))
+                # a point estimate gives no evidence; the maximised likelihood is not comparable to logZ elsewhere
+                logZ = jnp.nan
+                ESS = 1.
+            mean_lengthscale, mean_logsigma = jnp.exp(params[0]), params[1]
+            # coarse table, then per step a gradient, a Hessian and a trial evaluation
+            results = OptimisationResults(logZ=logZ, ESS=ESS,
+                                          num_likelihood_evaluations=log_prob.size + 3 * num_steps + 1)
+        else:
+            def log_likelihood(lengthscale, sigma, **kwargs):
+                return lookup_func(log_prob, lengthscale, sigma)
+
+            lengthscale = UniformPrior('lengthscale', jnp.min(lengthscale_array), jnp.max(lengthscale_array))
+            sigma = UniformPrior('sigma', sigma_array.min(), sigma_array.max())
+            prior_chain = PriorChain(lengthscale, sigma)
+
+            ns = NestedSampler(loglikelihood=log_likelihood,
+                               prior_chain=prior_chain,
+                               sampler_kwargs=dict(num_slices=prior_chain.U_ndims * 1),
+                               num_live_points=prior_chain.U_ndims * 50)
+            ns = jit(ns)
+            results = ns(key1, termination_evidence_frac=0.1)
+            # resample the weighted nested samples, so the screen takes the same binned path as the grid
+            indices = random.categorical(key2, results.log_p, shape=(num_samples,))
+            lengthscale = results.samples['lengthscale'].reshape((-1,))
+            sigma = results.samples['sigma'].reshape((-1,))
+            #[time_block_size,  Nd_screen], [time_block_size,  Nd_screen]
+            mean, var = screen_marginalisation(dtec, dtec_uncert, lengthscale[indices], sigma[indices])
+            # unused sample slots have zero weight
+            weights = jnp.exp(results.log_p - logsumexp(results.log_p))
+            mean_lengthscale = jnp.sum(jnp.where(weights > 0., weights * lengthscale, 0.))
+            mean_logsigma = jnp.sum(jnp.where(weights > 0., weights * jnp.log(sigma), 0.))
         uncert = jnp.sqrt(var)
         mean_sigma = jnp.exp(mean_logsigma)
-        mean_lengthscale = jnp.ones(time_block_size)*mean_lengthscale
-        mean_sigma = jnp.ones(time_block_size)*mean_sigma
-        ESS = results.ESS*jnp.ones(time_block_size)
-        logZ = results.logZ*jnp.ones(time_block_size)
-        likelihood_evals = results.num_likelihood_evaluations*jnp.ones(time_block_size)
+        # one per row of dtec, i.e. time_block_size, or the group's antennas times that
+        ones = jnp.ones(dtec.shape[0])
+        mean_lengthscale = ones*mean_lengthscale
+        mean_sigma = ones*mean_sigma
+        ESS = results.ESS*ones
+        logZ = results.logZ*ones
+        likelihood_evals = results.num_likelihood_evaluations*ones
         return mean, uncert, mean_lengthscale, mean_sigma, ESS, logZ, likelihood_evals
 
-    T = Na * (Nt//time_block_size)
-    keys = random.split(key, T)
-    # [T, time_block_size, Nd_screen], [T, time_block_size, Nd_screen], [T, time_block_size], [T, time_block_size]
+    # [Na*Nb, time_block_size, Nd]
     dtec = axes_move(dtec,['atb','d'], ['at','b','d'], size_dict=size_dict)
     dtec_uncert = axes_move(dtec_uncert,['atb','d'], ['at','b','d'], size_dict=size_dict)
-    mean, uncert, mean_lengthscale, mean_sigma, ESS, logZ, likelihood_evals = chunked_pmap(run_block, keys, dtec, dtec_uncert, log_prob, chunksize=chunksize)
+    grouped = antenna_groups is not None
+    if not grouped:
+        # every antenna is its own group
+        antenna_groups = np.arange(Na)
+    members, _, _ = antenna_group_members(antenna_groups)
+    G, S = members.shape
+    group_sizes = np.sum(members < Na, axis=1)
+    Nb = Nt // time_block_size
+    if grouped:
+        logger.info(f"Sharing hyper-parameters within {G} antenna groups of up to {S} antennas.")
+
+    def gather(array, members):
+        # [Na*Nb, ...] -> [Gs, Nb, s, ...] for Gs groups of s antennas
+        array = array.reshape((Na, -1) + array.shape[1:])[members]
+        return jnp.swapaxes(array, 1, 2)
+
+    def run_groups(key, members):
+        # a group's antennas are batched together so the kernel factorisations are shared,
+        # [Gs*Nb, s*time_block_size, Nd]
+        Gs, s = members.shape
+        _dtec = gather(dtec, members).reshape((Gs * Nb, s * time_block_size, Nd))
+        _dtec_uncert = gather(dtec_uncert, members).reshape((Gs * Nb, s * time_block_size, Nd))
+        if warm_start:
+            def run_sequence(key, dtec, dtec_uncert):
+                mean, var, mean_lengthscale, mean_logsigma, ESS, logZ, likelihood_evals, restarted = \
+                    sequential_grid_marginalisation(key, kernel, X, dtec, dtec_uncert, lengthscale_array, sigma_array,
+                                                    screen_marginalisation, num_samples)
+                ones = jnp.ones(dtec.shape[:2])
+                return (mean, jnp.sqrt(var), mean_lengthscale[:, None] * ones, jnp.exp(mean_logsigma)[:, None] * ones,
+                        ESS[:, None] * ones, logZ[:, None] * ones, likelihood_evals[:, None] * ones), restarted
+
+            keys = random.split(key, Gs)
+            outputs, restarted = chunked_pmap(run_sequence, keys, _dtec.reshape((Gs, Nb) + _dtec.shape[1:]),
+                                              _dtec_uncert.reshape((Gs, Nb) + _dtec_uncert.shape[1:]),
+                                              chunksize=chunksize)
+            logger.info(f"Warm-started {Gs * Nb} blocks of {s} antennas, {int(jnp.sum(restarted))} fell back to the "
+                        f"whole prior.")
+            outputs = [output.reshape((Gs * Nb,) + output.shape[2:]) for output in outputs]
+        else:
+            # summed tables, [Gs*Nb, Nl, Ns]
+            _log_prob = jnp.sum(gather(log_prob, members), axis=2).reshape((Gs * Nb,) + log_prob.shape[1:])
+            keys = random.split(key, Gs * Nb)
+            outputs = chunked_pmap(run_block, keys, _dtec, _dtec_uncert, _log_prob, chunksize=chunksize)
+        # [Gs*Nb, s*time_block_size, ...] -> [Gs*s, Nb, time_block_size, ...]
+        return [jnp.swapaxes(output.reshape((Gs, Nb, s, time_block_size) + output.shape[2:]), 1, 2).reshape(
+            (Gs * s, Nb, time_block_size) + output.shape[2:]) for output in outputs]
+
+    # groups are batched at their own size, so small groups are not padded to the largest one
+    outputs = None
+    for group_key, size in zip(random.split(key, len(np.unique(group_sizes))), np.unique(group_sizes)):
+        _members = members[group_sizes == size, :size]
+        _outputs = run_groups(group_key, _members)
+        if outputs is None:
+            outputs = [jnp.zeros((Na,) + output.shape[1:], output.dtype) for output in _outputs]
+        outputs = [output.at[_members.ravel()].set(_output) for output, _output in zip(outputs, _outputs)]
+    # [Na*Nb, time_block_size, ...]
+    mean, uncert, mean_lengthscale, mean_sigma, ESS, logZ, likelihood_evals = [
+        output.reshape((Na * Nb,) + output.shape[2:]) for output in outputs]
     mean = axes_move(mean, ['at','b','n'],['n','a','tb'], size_dict=size_dict)
     uncert = axes_move(uncert, ['at','b','n'],['n','a','tb'], size_dict=size_dict)
     mean_lengthscale = axes_move(mean_lengthscale, ['at','b'],['a','tb'], size_dict=size_dict)
@@ -339,7 +1809,74 @@ def solve_with_vanilla_kernel(key, dtec, dtec_uncert, X, Xstar, fed_kernel, time
     ESS = axes_move(ESS, ['at', 'b'],['a','tb'], size_dict=size_dict)
     logZ = axes_move(logZ, ['at', 'b'],['a','tb'], size_dict=size_dict)
     likelihood_evals = axes_move(likelihood_evals, ['at', 'b'],['a','tb'], size_dict=size_dict)
-    return mean[...,Nt-extra:], uncert[...,Nt-extra:], mean_lengthscale[...,Nt-extra:], mean_sigma[...,Nt-extra:], ESS[...,Nt-extra:], logZ,likelihood_evals[...,Nt-extra:]
+    return mean[...,:Nt_data], uncert[...,:Nt_data], mean_lengthscale[...,:Nt_data], mean_sigma[...,:Nt_data], ESS[...,:Nt_data], logZ[...,:Nt_data],likelihood_evals[...,:Nt_data]
+
+def solve_with_kronecker_kernel(key, dtec, dtec_uncert, X, Xstar, times, fed_kernel, lengthscale, sigma,
+                                time_lengthscale, time_block_size, chunksize, time_kernel=None, num_samples=128):
+    """
+    Temporally coherent screens. Unlike solve_with_vanilla_kernel, which treats the timesteps of a block as
+    independent given the hyper-parameters, each (antenna, time block) is solved jointly under a separable
+    space x time kernel with Kronecker algebra (see kronecker_screen), at O(Nd^3 + time_block_size^3) cost.
+    The spatial hyper-parameters are given, e.g. the ones found by solve_with_vanilla_kernel, and averaged over
+    each block.
+
+    Args:
+        key: PRNG key
+        dtec: [Nd, Na, Nt] TECU
+        dtec_uncert: [Nd, Na, Nt] TECU
+        X: [Nd,2] coordinates in deg
+        Xstar: [Nd_screen, 2] screen coordinates
+        times: [Nt] seconds, uniformly spaced
+        fed_kernel: StationaryKernel
+        lengthscale: [Na, Nt] deg
+        sigma: [Na, Nt] TECU
+        time_lengthscale: float, seconds
+        time_block_size: int, timesteps solved jointly
+        chunksize: int number of parallel devices to use.
+        time_kernel: StationaryKernel, M32 by default.
+        num_samples: int, samples for the stochastic variance estimate of heteroscedastic blocks with more than
+            2048 directions x timesteps, whose relative standard error is about sqrt(2 / num_samples). Smaller
+            blocks get the exact variance (see kronecker_screen).
+
+    Returns:
+        mean [Nd_screen, Na, Nt], uncert [Nd_screen, Na, Nt]
+    """
+    if time_kernel is None:
+        time_kernel = M32()
+    kernel = fed_kernel
+    dtec_uncert = jnp.maximum(dtec_uncert, 1e-6)
+
+    Nd, Na, Nt = dtec.shape
+    extra = (-Nt) % time_block_size
+    # pad up to a whole number of blocks, which may be more than Nt, with timesteps that are all outliers, since
+    # unlike independent timesteps copies would be correlated with the data
+    dtec = jnp.pad(dtec, ((0, 0), (0, 0), (0, extra)), mode='edge')
+    dtec_uncert = jnp.pad(dtec_uncert, ((0, 0), (0, 0), (0, extra)), constant_values=jnp.inf)
+    lengthscale = jnp.pad(lengthscale, ((0, 0), (0, extra)), mode='edge')
+    sigma = jnp.pad(sigma, ((0, 0), (0, extra)), mode='edge')
+    size_dict = dict(a=Na, d=Nd, b=time_block_size)
+    # [T, Nd, time_block_size]
+    dtec = axes_move(dtec, ['d', 'a', 'tb'], ['at', 'd', 'b'], size_dict=size_dict)
+    dtec_uncert = axes_move(dtec_uncert, ['d', 'a', 'tb'], ['at', 'd', 'b'], size_dict=size_dict)
+    # [T]
+    lengthscale = jnp.mean(axes_move(lengthscale, ['a', 'tb'], ['at', 'b'], size_dict=size_dict), axis=-1)
+    sigma = jnp.mean(axes_move(sigma, ['a', 'tb'], ['at', 'b'], size_dict=size_dict), axis=-1)
+    # uniformly spaced, so the same for every block, even if the (short) observation has fewer timesteps
+    block_times = jnp.arange(time_block_size) * (times[1] - times[0] if times.size > 1 else 1.)
+
+    def run_block(key, dtec, dtec_uncert, lengthscale, sigma):
+        mean, var = kronecker_screen(kernel, time_kernel, X, Xstar, block_times, dtec, dtec_uncert, lengthscale,
+                                     sigma, time_lengthscale, key=key, num_samples=num_samples)
+        return mean, jnp.sqrt(var)
+
+    T = Na * ((Nt + extra) // time_block_size)
+    keys = random.split(key, T)
+    # [T, Nd_screen, time_block_size]
+    mean, uncert = chunked_pmap(run_block, keys, dtec, dtec_uncert, lengthscale, sigma, chunksize=chunksize)
+    mean = axes_move(mean, ['at', 'n', 'b'], ['n', 'a', 'tb'], size_dict=size_dict)
+    uncert = axes_move(uncert, ['at', 'n', 'b'], ['n', 'a', 'tb'], size_dict=size_dict)
+    return mean[..., :Nt], uncert[..., :Nt]
+
 
 if __name__ == '__main__':
     from jax.config import config
@@ -0,0 +1,103 @@
+import argparse
+import os
+import sys
+import numpy as np
+import logging
+
+from bayes_gain_screens.utils import wrap
+from bayes_gain_screens.outlier_detection import stream_detect_dphase_outliers
+
+from h5parm import DataPack
+from h5parm.utils import make_soltab
+
+logger = logging.getLogger(__name__)
+
+
+def prepare_soltabs(dds5_h5parm):
+    with DataPack(dds5_h5parm, readonly=True) as h:
+        h.current_solset = 'sol000'
+        exists = 'phase_outliers000' in h.soltabs
+    if not exists:
+        logger.info("Creating sol000/phase_outliers000")
+        make_soltab(dds5_h5parm, from_solset='sol000', to_solset='sol000', from_soltab='phase000',
+                    to_soltab=['phase_outliers000'], remake_solset=False)
+
+
+def main(data_dir, working_dir, obs_num, ant_chunksize, window, threshold):
+    """
+    Flag outliers in the residual phase between the DDS4 solutions and the DDS5 smoothed phase, reading and writing
+    one (direction, antenna chunk) at a time so that memory use doesn't grow with the number of directions and
+    antennas.
+
+    The flags are written to sol000/phase_outliers000 as a diagnostic; no later stage reads them. The pipeline runs
+    this before infer_screen, which overwrites the DDS5 phases of tec outliers with the screen.
+    """
+    logger.info("Performing streaming dphase outlier detection.")
+    dds4_h5parm = os.path.join(data_dir, 'L{}_DDS4_full_merged.h5'.format(obs_num))
+    dds5_h5parm = os.path.join(data_dir, 'L{}_DDS5_full_merged.h5'.format(obs_num))
+    logger.info("Looking for {} and {}".format(dds4_h5parm, dds5_h5parm))
+    prepare_soltabs(dds5_h5parm)
+    with DataPack(dds4_h5parm, readonly=True) as dds4, DataPack(dds5_h5parm, readonly=False) as dds5:
+        dds4.current_solset = 'sol000'
+        dds5.current_solset = 'sol000'
+        dds4.select(pol=slice(0, 1, 1))
+        axes = dds4.axes_phase
+        _, antennas = dds4.get_antennas(axes['ant'])
+        _, directions = dds4.get_directions(axes['dir'])
+        Nd, Na = len(directions), len(antennas)
+        logger.info("Processing {} directions and {} antennas in chunks of {} antennas.".format(Nd, Na, ant_chunksize))
+
+        def read_dphase(d, ant_slice):
+            select = dict(pol=slice(0, 1, 1), dir=slice(d, d + 1, 1), ant=ant_slice)
+            dds4.select(**select)
+            dds5.select(**select)
+            phase_obs, _ = dds4.phase
+            phase_mean, _ = dds5.phase
+            return wrap(wrap(phase_mean[0, 0]) - phase_obs[0, 0])
+
+        def write_outliers(d, ant_slice, outliers):
+            dds5.select(pol=slice(0, 1, 1), dir=slice(d, d + 1, 1), ant=ant_slice)
+            dds5.phase_outliers = outliers[None, None, ...].astype(np.float64)
+
+        stream_detect_dphase_outliers(read_dphase, write_outliers, Nd, Na, ant_chunksize=ant_chunksize,
+                                      window=window, threshold=threshold)
+
+
+def debug_main():
+    main(obs_num=342938,
+         data_dir="/home/albert/data/gains_screen/data",
+         working_dir="/home/albert/data/gains_screen/data",
+         ant_chunksize=8,
+         window=15,
+         threshold=5.)
+
+
+def add_args(parser):
+    parser.register("type", "bool", lambda v: v.lower() == "true")
+    parser.add_argument('--obs_num', help='Obs number L*',
+                        default=None, type=int, required=True)
+    parser.add_argument('--data_dir', help='Where are the h5parm files are stored.',
+                        default=None, type=str, required=True)
+    parser.add_argument('--working_dir', help='Where to perform the work.',
+                        default=None, type=str, required=True)
+    parser.add_argument('--ant_chunksize', help='Number of antennas read from the h5parm at once.',
+                        default=8, type=int, required=False)
+    parser.add_argument('--window', help='Rolling median window size in time steps.',
+                        default=15, type=int, required=False)
+    parser.add_argument('--threshold', help='Outlier threshold in robust standard deviations.',
+                        default=5., type=float, required=False)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        debug_main()
+        exit(0)
+    parser = argparse.ArgumentParser(
+        description='Flag outliers in the dphase between DDS4 and the smoothed DDS5 solutions.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_args(parser)
+    flags, unparsed = parser.parse_known_args()
+    logger.info("Running with:")
+    for option, value in vars(flags).items():
+        logger.info("    {} -> {}".format(option, value))
+    main(**vars(flags))
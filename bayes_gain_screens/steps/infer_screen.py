@@ -8,11 +8,16 @@ import os
 import numpy as np
 import pylab as plt
 import astropy.units as au
+import astropy.coordinates as ac
 
 from jax import random, vmap, numpy as jnp, jit
 
-from bayes_gain_screens.utils import get_screen_directions_from_image, link_overwrite, make_coord_array, axes_move, great_circle_sep
-from bayes_gain_screens.screen_solvers import solve_with_vanilla_kernel
+from bayes_gain_screens.utils import get_screen_directions_from_image, link_overwrite, make_coord_array, great_circle_sep, \
+    cluster_antennas
+from bayes_gain_screens.screen_solvers import solve_with_vanilla_kernel, solve_with_kronecker_kernel, \
+    solve_with_tomographic_kernel
+from bayes_gain_screens.frames import ENU
+from bayes_gain_screens.outlier_detection import batched_leave_one_out_outlier_detection
 from bayes_gain_screens.plotting import make_animation, DatapackPlotter, animate_datapack
 
 from h5parm import DataPack
@@ -28,42 +33,42 @@ logger = logging.getLogger(__name__)
 TEC_CONV = -8.4479745e6  # mTECU/Hz
 
 @jit
-def nn_interp(x,y,xstar):
+def nn_index(x, xstar):
     """
-    Nearest-neighbour interpolation.
+    Index of the nearest neighbour in x of each of xstar, by great-circle distance. Depends only on the geometry, so
+    it is computed once and shared by every column that is interpolated.
 
     Args:
-        x: [N,D]
-        y: [N]
-        xstar: [M,D]
+        x: [N,D] in deg
+        xstar: [M,D] in deg
 
     Returns:
-        [M] y interpolated from x to xstar.
+        [M] int
     """
-    def single_interp(xstar):
+    def single_index(xstar):
         #N
         dx = great_circle_sep(ra1=x[:,0]*jnp.pi/180.,dec1=x[:,1]*jnp.pi/180.,
                               ra2=xstar[0]*jnp.pi/180.,dec2=xstar[1]*jnp.pi/180.)
         # dx = jnp.linalg.norm(xstar - x, axis=-1)
         dx = jnp.where(dx == 0., jnp.inf, dx)
-        imin = jnp.argmin(dx)
-        return y[imin]
-    return vmap(single_interp)(xstar)
+        return jnp.argmin(dx)
+    return vmap(single_index)(xstar)
 
 @jit
-def nn_smooth(x,y,xstar,outliers=None):
+def nn_smooth_weights(x, xstar, outliers=None):
     """
-    Smoothed nearest neighbours, where the smoothing length is tuned to the local nearest neighbour distance.
+    Weight matrix of smoothed nearest neighbours, where the smoothing length is tuned to the local nearest neighbour
+    distance. Depends only on the geometry, so it is computed once and shared by every column that is interpolated.
 
     Args:
-        x: [N,D]
-        y: [N]
-        xstar: [M,D]
+        x: [N,D] in deg
+        xstar: [M,D] in deg
+        outliers: optional [N] bool, given zero weight
 
     Returns:
-        [M] y interpolated from x to xstar.
+        [M, N] rows sum to one
     """
-    def single_interp(xstar):
+    def single_weights(xstar):
         # N
         dx = great_circle_sep(ra1=x[:, 0] * jnp.pi / 180., dec1=x[:, 1] * jnp.pi / 180.,
                               ra2=xstar[0] * jnp.pi / 180., dec2=xstar[1] * jnp.pi / 180.)
@@ -73,9 +78,107 @@ def nn_smooth(x,y,xstar,outliers=None):
         weight = jnp.exp(-0.5*dx**2)
         if outliers is not None:
             weight = jnp.where(outliers, 0., weight)
-        weight /= jnp.sum(weight)
-        return jnp.sum(y*weight)
-    return vmap(single_interp)(xstar)
+        return weight / jnp.sum(weight)
+    return vmap(single_weights)(xstar)
+
+@jit
+def nn_interp(x,y,xstar,index=None):
+    """
+    Nearest-neighbour interpolation.
+
+    Args:
+        x: [N,D]
+        y: [N,...] interpolated along the first axis, all trailing columns at once
+        xstar: [M,D]
+        index: optional [M] precomputed nn_index(x, xstar)
+
+    Returns:
+        [M,...] y interpolated from x to xstar.
+    """
+    if index is None:
+        index = nn_index(x, xstar)
+    return y[index]
+
+@jit
+def nn_smooth(x,y,xstar,outliers=None,weights=None):
+    """
+    Smoothed nearest neighbours, where the smoothing length is tuned to the local nearest neighbour distance.
+
+    Args:
+        x: [N,D]
+        y: [N,...] interpolated along the first axis, all trailing columns at once
+        xstar: [M,D]
+        weights: optional [M,N] precomputed nn_smooth_weights(x, xstar, outliers)
+
+    Returns:
+        [M,...] y interpolated from x to xstar.
+    """
+    if weights is None:
+        weights = nn_smooth_weights(x, xstar, outliers)
+    return jnp.tensordot(weights, y, axes=1)
+
+
+def test_nn_interp():
+    np.random.seed(0)
+    x = jnp.asarray(np.random.uniform(0., 5., size=(15, 2)))
+    xstar = jnp.concatenate([x[:5], jnp.asarray(np.random.uniform(0., 5., size=(20, 2)))], axis=0)
+    y = jnp.asarray(np.random.normal(size=(15, 3, 4)))
+    index = nn_index(x, xstar)
+    weights = nn_smooth_weights(x, xstar)
+    assert jnp.allclose(jnp.sum(weights, axis=1), 1.)
+    # one gather or matmul over all columns, as column by column
+    for i in range(3):
+        for j in range(4):
+            assert jnp.all(nn_interp(x, y, xstar, index=index)[:, i, j] == y[:, i, j][index])
+            assert jnp.allclose(nn_smooth(x, y, xstar, weights=weights)[:, i, j], nn_smooth(x, y[:, i, j], xstar))
+    outliers = jnp.arange(15) == 3
+    assert jnp.all(nn_smooth_weights(x, xstar[5:], outliers)[:, 3] == 0.)
+
+
+def detect_spatial_outliers(dtec_mean, dtec_std, X, fed_kernel, lengthscale=1.):
+    """
+    Leave-one-out spatial outlier detection over all antennas and times at once, with nominal screen
+    hyper-parameters so that the prior covariance is shared by every (antenna, time).
+
+    Args:
+        dtec_mean: [Nd, Na, Nt]
+        dtec_std: [Nd, Na, Nt] inf encodes known outliers
+        X: [Nd, 2] directions in deg
+        fed_kernel: StationaryKernel
+        lengthscale: nominal lengthscale in deg
+
+    Returns:
+        [Nd, Na, Nt] bool newly detected outliers
+    """
+    Nd, Na, Nt = dtec_mean.shape
+    finite = np.isfinite(dtec_std)
+    sigma = np.sqrt(np.mean(np.asarray(dtec_mean)[finite] ** 2))
+    K = fed_kernel(X, X, lengthscale, sigma)
+    outliers = batched_leave_one_out_outlier_detection(K,
+                                                       np.asarray(dtec_mean).reshape((Nd, Na * Nt)),
+                                                       np.asarray(dtec_std).reshape((Nd, Na * Nt)))
+    outliers = outliers.reshape((Nd, Na, Nt))
+    logger.info(f"Spatial outlier pass found {outliers.sum()} outliers.")
+    return outliers
+
+
+def tomographic_geometry(antennas, directions, screen_directions, obstime):
+    """
+    Geometry for solve_with_tomographic_kernel, in the East-North-Up frame of the first antenna at `obstime`.
+
+    Returns:
+        antennas [Na, 3] km, directions [Nd, 3] and screen_directions [Nd_screen, 3] unit vectors,
+        reference antenna [3] km, Earth's centre [3] km
+    """
+    antennas = ac.ITRS(*antennas.cartesian.xyz, obstime=obstime)
+    earth_centre = ac.ITRS(x=0. * au.m, y=0. * au.m, z=0. * au.m, obstime=obstime)
+    frame = ENU(obstime=obstime, location=antennas[0].earth_location)
+    antennas = antennas.transform_to(frame).cartesian.xyz.to(au.km).value.T
+    earth_centre = earth_centre.transform_to(frame).cartesian.xyz.to(au.km).value
+    directions = directions.transform_to(frame).cartesian.xyz.value.T
+    screen_directions = screen_directions.transform_to(frame).cartesian.xyz.value.T
+    return (jnp.asarray(antennas), jnp.asarray(directions), jnp.asarray(screen_directions), jnp.asarray(antennas[0]),
+            jnp.asarray(earth_centre))
 
 
 def prepare_soltabs(dds5_h5parm, dds6_h5parm, screen_directions):
@@ -88,14 +191,15 @@ def prepare_soltabs(dds5_h5parm, dds6_h5parm, screen_directions):
 
 
 def get_data(dds5_h5parm):
+    """
+    Read what the screen solve needs from DDS5. The phases and amplitudes are [Nd, Na, Nf, Nt], so they are left
+    on disk and streamed by write_screen_solutions.
+    """
     with DataPack(dds5_h5parm, readonly=True) as h:
         select = dict(pol=slice(0, 1, 1))
         h.current_solset = 'sol000'
         h.select(**select)
-        amp, axes = h.amplitude
-        amp = amp[0, ...]
-        phase, axes = h.phase
-        phase = phase[0, ...]
+        axes = h.axes_phase
         _, freqs = h.get_freqs(axes['freq'])
         freqs = freqs.to(au.Hz).value
         _, times = h.get_times(axes['time'])
@@ -111,20 +215,104 @@ def get_data(dds5_h5parm):
         const, _ = h.const
         const = const[0, ...]
 
-    return phase, amp, tec_mean, tec_std, tec_outliers, const, antennas, directions, freqs, times
+    return tec_mean, tec_std, tec_outliers, const, antennas, directions, freqs, times
 
-def main(data_dir, working_dir, obs_num, ref_image_fits, ncpu, max_N, plot_results):
+
+def write_screen_solutions(dds5_h5parm, dds6_h5parm, directions, screen_directions, freqs, post_dtec_screen_mean,
+                           post_dtec_screen_uncert, const, tec_outliers, ant_chunksize=8,
+                           interp_type='nearest_neighbour'):
+    """
+    Write the screen into DDS6 one antenna chunk at a time. Amplitudes and constants are interpolated to the screen
+    directions, and phases derived from tec/const, only for the chunk being written, so that peak memory is
+    [Nd_screen, ant_chunksize, Nf, Nt] rather than the whole phase cube. Calibrator phases flagged as tec outliers
+    are replaced by the screen, in both DDS6 and DDS5.
+
+    Args:
+        directions: [Nd, 2] calibrator directions in deg
+        screen_directions: [Nd_screen, 2] screen directions in deg, the first Nd of which are the calibrators
+        freqs: [Nf] Hz
+        post_dtec_screen_mean: [Nd_screen, Na, Nt]
+        post_dtec_screen_uncert: [Nd_screen, Na, Nt]
+        const: [Nd, Na, Nt]
+        tec_outliers: [Nd, Na, Nt]
+        ant_chunksize: int, number of antennas written at once
+        interp_type: 'nearest_neighbour' or 'smoothed_nearest_neighbour'
+    """
+    # the geometry is shared by every antenna, frequency and time, so the neighbours are found once
+    if interp_type == 'nearest_neighbour':
+        index = nn_index(directions, screen_directions)
+        interp = lambda y: nn_interp(directions, y, screen_directions, index=index)
+    elif interp_type == 'smoothed_nearest_neighbour':
+        weights = nn_smooth_weights(directions, screen_directions)
+        interp = lambda y: nn_smooth(directions, y, screen_directions, weights=weights)
+    else:
+        raise ValueError(f"Invalid interp_type {interp_type}")
+    Nd, Na, Nt = const.shape
+    with DataPack(dds5_h5parm, readonly=False) as dds5, DataPack(dds6_h5parm, readonly=False) as dds6:
+        dds5.current_solset = 'sol000'
+        dds6.current_solset = 'sol000'
+        for start in range(0, Na, ant_chunksize):
+            ant_slice = slice(start, min(start + ant_chunksize, Na), 1)
+            logger.info(f"Writing screen for antennas {ant_slice.start} to {ant_slice.stop} of {Na}.")
+            dds5.select(pol=slice(0, 1, 1), ant=ant_slice)
+            phase, _ = dds5.phase
+            phase = phase[0, ...]
+            amp, _ = dds5.amplitude
+            amp = amp[0, ...]
+
+            post_amp = interp(amp)
+            post_const = interp(const[:, ant_slice])
+
+            tec_mean = post_dtec_screen_mean[:, ant_slice]
+            tec_uncert = post_dtec_screen_uncert[:, ant_slice]
+            post_phase = tec_mean[..., None, :] * (TEC_CONV / freqs[:, None]) + post_const[..., None, :]
+            post_uncert = jnp.abs(tec_uncert[..., None, :] * (TEC_CONV / freqs[:, None]))
+
+            # Replace outliers with screen solutions, else the calibrators.
+            phase_outliers_replaced_with_screen = jnp.where(tec_outliers[:, ant_slice, None, :], post_phase[:Nd],
+                                                            phase)
+            phase_outliers_replaced_with_screen = np.asarray(phase_outliers_replaced_with_screen)[None, ...]
+
+            # set screen
+            dds6.select(pol=slice(0, 1, 1), ant=ant_slice)
+            dds6.tec = np.asarray(tec_mean)[None, ...]
+            dds6.weights_tec = np.asarray(tec_uncert)[None, ...]
+            dds6.const = np.asarray(post_const)[None, ...]
+            dds6.amplitude = np.asarray(post_amp)[None, ...]
+            dds6.phase = np.asarray(post_phase)[None, ...]
+            dds6.weights_phase = np.asarray(post_uncert)[None, ...]
+            # put calibrators in original diretions
+            dds6.select(pol=slice(0, 1, 1), dir=slice(0, Nd, 1), ant=ant_slice)
+            dds6.phase = phase_outliers_replaced_with_screen
+            dds6.amplitude = np.asarray(amp)[None, ...]
+            # replace the outlier phase calibrators in dds5
+            dds5.select(pol=slice(0, 1, 1), ant=ant_slice)
+            dds5.phase = phase_outliers_replaced_with_screen
+
+
+def main(data_dir, working_dir, obs_num, ref_image_fits, ncpu, max_N, plot_results, spatial_outliers=False,
+         marginalisation='nested_sampling', adaptive_grid_tol=None, laplace=False, cache_log_prob=False,
+         num_inducing=None, time_lengthscale=None, solver='vanilla', frame_update=30.,
+         antenna_group_distance=None, warm_start=False, ant_chunksize=8):
+    if solver not in ('vanilla', 'tomographic'):
+        raise ValueError(f"solver should be 'vanilla' or 'tomographic', got {solver}.")
+    if solver == 'tomographic' and time_lengthscale is not None:
+        raise ValueError("time_lengthscale needs the angular lengthscales of solver='vanilla'.")
     # os.environ['XLA_FLAGS'] = "--xla_force_host_platform_device_count={}".format(max(1,ncpu//4))
 
     dds5_h5parm = os.path.join(data_dir, 'L{}_DDS5_full_merged.h5'.format(obs_num))
     dds6_h5parm = os.path.join(working_dir, 'L{}_DDS6_full_merged.h5'.format(obs_num))
     linked_dds6_h5parm = os.path.join(data_dir, 'L{}_DDS6_full_merged.h5'.format(obs_num))
+    hyperparameters_file = os.path.join(working_dir, 'L{}_screen_hyperparameters.npz'.format(obs_num))
+    linked_hyperparameters_file = os.path.join(data_dir, 'L{}_screen_hyperparameters.npz'.format(obs_num))
     logger.info("Looking for {}".format(dds5_h5parm))
     link_overwrite(dds6_h5parm, linked_dds6_h5parm)
+    link_overwrite(hyperparameters_file, linked_hyperparameters_file)
 
-    phase, amp, dtec_mean, dtec_std, tec_outliers, const, antennas, directions, freqs, times = get_data(dds5_h5parm)
-    Nd, Na, Nf, Nt = amp.shape
+    dtec_mean, dtec_std, tec_outliers, const, antennas, directions, freqs, times = get_data(dds5_h5parm)
+    Nd, Na, Nt = dtec_mean.shape
 
+    obstimes = times
     times = times.mjd
     times -= times[0]
     times *= 86400.
@@ -140,63 +328,77 @@ def main(data_dir, working_dir, obs_num, ref_image_fits, ncpu, max_N, plot_resul
                                                             fill_in_flux_limit=0.01)
 
     prepare_soltabs(dds5_h5parm, dds6_h5parm, screen_directions)
+    sky_directions, sky_screen_directions = directions, screen_directions
 
     directions = jnp.stack([directions.ra.deg, directions.dec.deg], axis=1)
     X = make_coord_array(directions, flat=True)
     screen_directions = jnp.stack([screen_directions.ra.deg, screen_directions.dec.deg], axis=1)
     Xstar = make_coord_array(screen_directions, flat=True)
 
+    if spatial_outliers:
+        outliers = detect_spatial_outliers(dtec_mean, dtec_std, X, M32())
+        dtec_std = jnp.where(outliers, jnp.inf, dtec_std)
+        tec_outliers = np.logical_or(tec_outliers, outliers)
+
     regularity_window = 5.#minutes over which ionosphere properties remain the same
     time_block_size = max(1,int(regularity_window*60./dt))
     logger.info(f"Ionosphere properties assumed constant over {regularity_window} minutes ({time_block_size} timesteps).")
 
-    post_dtec_screen_mean, post_dtec_screen_uncert, lengthscale, sigma, ESS, logZ, likelihood_evals = \
-        solve_with_vanilla_kernel(random.PRNGKey(42),
-                                  dtec=dtec_mean, dtec_uncert=dtec_std,
-                              X=X, Xstar=Xstar,fed_kernel=M32(),
-                              time_block_size=time_block_size,#assume screen hyper-parameters are constant over 10 time-steps.
-                              chunksize=max(1,ncpu//4))
-
-    interp_type = 'nearest_neighbour'
-    amp = axes_move(amp, ['d','a','f','t'],['aft','d'])
-    const = axes_move(const,['d','a','t'],['at','d'])
-    if interp_type == 'nearest_neighbour':
-        post_amp = vmap(lambda amp: nn_interp(directions,amp,screen_directions))(amp.T).T
-        post_const = nn_interp(directions, const, screen_directions)
-    elif interp_type == 'smoothed_nearest_neighbour':
-        post_amp = vmap(lambda amp: nn_smooth(directions, amp, screen_directions))(amp.T).T
-        post_const = nn_smooth(directions, const, screen_directions)
+    if solver == 'tomographic':
+        # the directions move through the antenna frame, so the geometry is updated every `frame_update` minutes
+        epoch_size = time_block_size * max(1, int(frame_update * 60. / dt) // time_block_size)
+        outputs = []
+        for start in range(0, Nt, epoch_size):
+            stop = min(Nt, start + epoch_size)
+            logger.info(f"Tomographic screens for timesteps {start} to {stop}.")
+            geometry = tomographic_geometry(antennas, sky_directions, sky_screen_directions,
+                                            obstimes[(start + stop) // 2])
+            outputs.append(solve_with_tomographic_kernel(random.PRNGKey(42 + start),
+                                                         dtec_mean[..., start:stop], dtec_std[..., start:stop],
+                                                         *geometry,
+                                                         fed_kernel=M32(),
+                                                         time_block_size=time_block_size,
+                                                         chunksize=max(1, ncpu // 4)))
+        post_dtec_screen_mean, post_dtec_screen_uncert, lengthscale, sigma, ESS, logZ, likelihood_evals = \
+            [jnp.concatenate(output, axis=-1) for output in zip(*outputs)]
     else:
-        raise ValueError(f"Invalid interp_type {interp_type}")
-    post_amp = axes_move(post_amp, ['aft', 'd'], ['d', 'a', 'f', 't'],size_dict=dict(a=Na,f=Nf,t=Nt))
-    post_const = axes_move(post_const, ['at', 'd'], ['d', 'a', 't'],size_dict=dict(a=Na,t=Nt))
-
-    post_phase = post_dtec_screen_mean[...,None,:]*(TEC_CONV/freqs[:,None]) + post_const[..., None,:]
-    post_uncert = jnp.abs(post_dtec_screen_uncert[...,None,:]*(TEC_CONV/freqs[:,None]))
-
-    #Replace outliers with screen solutions, else the calibrators.
-    phase_outliers_replaced_with_screen = jnp.where(tec_outliers[...,None,:], post_phase[:Nd], phase)
-
-    with DataPack(dds6_h5parm, readonly=False) as h:
-        h.current_solset = 'sol000'
-        # set screen
-        h.select(pol=slice(0, 1, 1))
-        h.tec = np.asarray(post_dtec_screen_mean)[None, ...]
-        h.weights_tec = np.asarray(post_dtec_screen_uncert)[None, ...]
-        h.const = np.asarray(post_const)[None, ...]
-        h.amplitude = np.asarray(post_amp)[None, ...]
-        h.phase = np.asarray(post_phase)[None, ...]
-        h.weights_phase = np.asarray(post_uncert)[None, ...]
-        # put calibrators in original diretions
-        h.select(pol=slice(0, 1, 1), dir=slice(0, Nd, 1))
-        h.phase = np.asarray(phase_outliers_replaced_with_screen)[None, ...]
-        h.amplitude = np.asarray(amp)[None, ...]
-
-    # replace the outlier phase calibrators in dds5
-    with DataPack(dds5_h5parm, readonly=False) as h:
-        h.current_solset = 'sol000'
-        h.select(pol=slice(0, 1, 1))
-        h.phase = np.asarray(phase_outliers_replaced_with_screen)[None, ...]
+        antenna_groups = None
+        if antenna_group_distance is not None:
+            antenna_groups = cluster_antennas(antennas.cartesian.xyz.to(au.km).value.T, antenna_group_distance)
+            logger.info(f"Grouped {Na} antennas into {antenna_groups.max() + 1} groups within {antenna_group_distance} km.")
+        post_dtec_screen_mean, post_dtec_screen_uncert, lengthscale, sigma, ESS, logZ, likelihood_evals = \
+            solve_with_vanilla_kernel(random.PRNGKey(42),
+                                      dtec=dtec_mean, dtec_uncert=dtec_std,
+                                  X=X, Xstar=Xstar,fed_kernel=M32(),
+                                  time_block_size=time_block_size,#assume screen hyper-parameters are constant over 10 time-steps.
+                                  chunksize=max(1,ncpu//4),
+                                  marginalisation=marginalisation,
+                                  adaptive_grid_tol=adaptive_grid_tol,
+                                  laplace=laplace,
+                                  cache_dir=os.path.join(working_dir, 'log_prob_cache') if cache_log_prob else None,
+                                  num_inducing=num_inducing,
+                                  antenna_groups=antenna_groups,
+                                  warm_start=warm_start)
+
+    if time_lengthscale is not None:
+        logger.info(f"Re-solving the screen jointly in time with a {time_lengthscale} second time lengthscale.")
+        post_dtec_screen_mean, post_dtec_screen_uncert = \
+            solve_with_kronecker_kernel(random.PRNGKey(43),
+                                        dtec=dtec_mean, dtec_uncert=dtec_std,
+                                        X=X, Xstar=Xstar, times=times, fed_kernel=M32(),
+                                        lengthscale=lengthscale, sigma=sigma,
+                                        time_lengthscale=time_lengthscale,
+                                        time_block_size=time_block_size,
+                                        chunksize=max(1, ncpu // 4))
+
+    # for render_screen, which re-predicts the screen on an image grid, NaN time_lengthscale for independent timesteps
+    np.savez(hyperparameters_file, solver=solver, lengthscale=np.asarray(lengthscale), sigma=np.asarray(sigma),
+             time_lengthscale=np.nan if time_lengthscale is None else time_lengthscale,
+             dtec_outliers=~np.isfinite(np.asarray(dtec_std)))
+
+    write_screen_solutions(dds5_h5parm, dds6_h5parm, directions, screen_directions, freqs,
+                           post_dtec_screen_mean, post_dtec_screen_uncert, const, tec_outliers,
+                           ant_chunksize=ant_chunksize, interp_type='nearest_neighbour')
 
     if plot_results:
         logger.info("Plotting results.")
@@ -287,6 +489,36 @@ def add_args(parser):
                         type=str, required=True)
     parser.add_argument('--plot_results', help='Whether to plot results.',
                         default=True, type="bool", required=False)
+    parser.add_argument('--spatial_outliers', help='Whether to run a leave-one-out spatial outlier pass on the DTEC.',
+                        default=False, type="bool", required=False)
+    parser.add_argument('--marginalisation',
+                        help="How to marginalise the screen hyper-parameters, 'grid' (quadrature), 'nested_sampling', or 'optimise' (type-II ML point estimate).",
+                        default='nested_sampling', type=str, choices=['grid', 'nested_sampling', 'optimise'], required=False)
+    parser.add_argument('--adaptive_grid_tol',
+                        help='If given, build the hyper-parameter grid coarse-to-fine, refining where all but this much posterior mass lies.',
+                        default=None, type=float, required=False)
+    parser.add_argument('--laplace', help="With --marginalisation=optimise, use the MAP and a Laplace approximation around it.",
+                        default=False, type="bool", required=False)
+    parser.add_argument('--cache_log_prob', help="Whether to cache the screen log-prob tables in the working dir (up to 8 GiB), to speed up reruns.",
+                        default=False, type="bool", required=False)
+    parser.add_argument('--num_inducing',
+                        help='If given, predict the screen through this many inducing points, so that thousands of screen directions (--max_N) fit in memory.',
+                        default=None, type=int, required=False)
+    parser.add_argument('--time_lengthscale',
+                        help='If given (seconds), solve the screen jointly over each time block with a separable space x time kernel, for temporally coherent screens.',
+                        default=None, type=float, required=False)
+    parser.add_argument('--solver',
+                        help="Screen model, 'vanilla' (kernel on the sky) or 'tomographic' (thick ionosphere layer).",
+                        default='vanilla', type=str, choices=['vanilla', 'tomographic'], required=False)
+    parser.add_argument('--frame_update', help='With --solver=tomographic, minutes between updates of the direction geometry.',
+                        default=30., type=float, required=False)
+    parser.add_argument('--antenna_group_distance',
+                        help='If given (km), antennas linked within this distance share screen hyper-parameters, e.g. the core stations.',
+                        default=None, type=float, required=False)
+    parser.add_argument('--warm_start', help="With --marginalisation=grid, use each time block's posterior as the next block's prior.",
+                        default=False, type="bool", required=False)
+    parser.add_argument('--ant_chunksize', help='Number of antennas of the screen written to DDS6 at once.',
+                        default=8, type=int, required=False)
 
 
 if __name__ == '__main__':
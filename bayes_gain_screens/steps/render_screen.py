@@ -0,0 +1,188 @@
+import argparse
+import os
+import sys
+import numpy as np
+import logging
+from astropy import wcs
+from astropy.io import fits
+from jax import numpy as jnp
+
+from bayes_gain_screens.utils import link_overwrite, make_coord_array
+from bayes_gain_screens.screen_solvers import stream_gridded_screen
+
+from h5parm import DataPack
+
+from jaxns.gaussian_process.kernels import M32
+
+logger = logging.getLogger(__name__)
+
+
+def screen_grid(ref_image_fits, num_pixels):
+    """
+    A num_pixels x num_pixels grid covering the field of the reference image, with the same projection.
+
+    Returns:
+        celestial WCS of the grid, [num_pixels**2, 2] ra, dec in deg of every pixel (row-major, NaN outside the
+        projection)
+    """
+    with fits.open(ref_image_fits) as hdul:
+        header = hdul[0].header
+        w = wcs.WCS(header).celestial
+        scale = np.asarray([header['NAXIS1'], header['NAXIS2']]) / num_pixels
+    grid = w.deepcopy()
+    if grid.wcs.has_cd():
+        grid.wcs.cd = w.wcs.cd * scale[None, :]
+    else:
+        grid.wcs.cdelt = w.wcs.cdelt * scale
+    grid.wcs.crpix = (w.wcs.crpix - 0.5) / scale + 0.5
+    y, x = np.meshgrid(np.arange(num_pixels), np.arange(num_pixels), indexing='ij')
+    ra, dec = grid.wcs_pix2world(x.ravel(), y.ravel(), 0)
+    return grid, np.stack([ra, dec], axis=1)
+
+
+def create_fits_cube(fits_file, grid, num_pixels, times, Na, unit):
+    """
+    Create an empty float32 [time, antenna, dec, ra] FITS cube on disk without allocating it, to be filled through a
+    memory map.
+
+    Args:
+        grid: celestial WCS of the num_pixels x num_pixels image plane
+        times: [Nt] astropy Time, assumed regular
+    """
+    w = wcs.WCS(naxis=4)
+    w.wcs.ctype = list(grid.wcs.ctype) + ['ANTENNA', 'TIME']
+    w.wcs.crval = list(grid.wcs.crval) + [0., times[0].mjd * 86400.]
+    w.wcs.crpix = list(grid.wcs.crpix) + [1., 1.]
+    w.wcs.cdelt = list(grid.wcs.get_cdelt()) + [1., np.mean(np.diff(times.mjd)) * 86400. if len(times) > 1 else 1.]
+    w.wcs.cunit = list(grid.wcs.cunit) + ['', 's']
+    pc = np.eye(4)
+    pc[:2, :2] = grid.wcs.get_pc()
+    w.wcs.pc = pc
+    shape = (len(times), Na, num_pixels, num_pixels)
+    hdu = fits.PrimaryHDU(data=np.zeros((1, 1, 1, 1), dtype=np.float32), header=w.to_header())
+    header = hdu.header
+    header['BUNIT'] = unit
+    for i, size in enumerate(shape[::-1]):
+        header['NAXIS{}'.format(i + 1)] = size
+    header.tofile(fits_file, overwrite=True)
+    data_bytes = int(np.prod(shape)) * 4
+    with open(fits_file, 'rb+') as f:
+        # data padded to a whole number of 2880 byte FITS blocks
+        f.seek(len(header.tostring()) + data_bytes + (-data_bytes) % 2880 - 1)
+        f.write(b'\0')
+
+
+def main(data_dir, working_dir, obs_num, ref_image_fits, num_pixels, column_chunksize, pixel_chunksize,
+         num_lengthscale_bins):
+    """
+    Render the posterior DTEC screen of infer_screen, mean and uncertainty, for every antenna and timestep onto a
+    num_pixels x num_pixels grid over the reference image. The screen is re-predicted from the DDS5 calibrator DTEC
+    with the hyper-parameters infer_screen inferred, and streamed into memory-mapped FITS cubes, so memory use does
+    not depend on the size of the cubes.
+
+    The cubes are a plug-in estimate at the posterior-mean hyper-parameters of each (antenna, time), not the
+    average over hyper-parameter samples that infer_screen writes to DDS6, so they differ from DDS6 where the
+    posterior is broad. Screens solved jointly in time (infer_screen --time_lengthscale) can't be re-predicted
+    per timestep and are refused.
+    """
+    dds5_h5parm = os.path.join(data_dir, 'L{}_DDS5_full_merged.h5'.format(obs_num))
+    hyperparameters_file = os.path.join(data_dir, 'L{}_screen_hyperparameters.npz'.format(obs_num))
+    logger.info("Looking for {} and {}".format(dds5_h5parm, hyperparameters_file))
+    hyperparameters = np.load(hyperparameters_file)
+    if str(hyperparameters['solver']) != 'vanilla':
+        raise ValueError("Can only render screens of infer_screen --solver=vanilla, got {}.".format(
+            hyperparameters['solver']))
+    if 'time_lengthscale' in hyperparameters.files and np.isfinite(hyperparameters['time_lengthscale']):
+        raise ValueError("Can't render screens of infer_screen --time_lengthscale, which are solved jointly in time.")
+
+    with DataPack(dds5_h5parm, readonly=True) as h:
+        h.current_solset = 'sol000'
+        h.select(pol=slice(0, 1, 1))
+        tec_mean, axes = h.tec
+        tec_mean = tec_mean[0, ...]
+        tec_std, axes = h.weights_tec
+        tec_std = tec_std[0, ...]
+        _, times = h.get_times(axes['time'])
+        _, directions = h.get_directions(axes['dir'])
+    Nd, Na, Nt = tec_mean.shape
+    tec_std = np.where(hyperparameters['dtec_outliers'], np.inf, np.maximum(tec_std, 1e-6))
+
+    X = make_coord_array(jnp.stack([directions.ra.deg, directions.dec.deg], axis=1), flat=True)
+    grid, Xstar = screen_grid(ref_image_fits, num_pixels)
+    outside = np.any(~np.isfinite(Xstar), axis=1)
+    Xstar[outside] = np.asarray(X[0])
+    logger.info("Rendering {} antennas x {} times onto {}x{} pixels.".format(Na, Nt, num_pixels, num_pixels))
+
+    # one column per (time, antenna), matching the cube layout
+    dtec = tec_mean.transpose((2, 1, 0)).reshape((Nt * Na, Nd))
+    dtec_uncert = tec_std.transpose((2, 1, 0)).reshape((Nt * Na, Nd))
+    lengthscale = hyperparameters['lengthscale'].T.reshape((-1,))
+    sigma = hyperparameters['sigma'].T.reshape((-1,))
+    lengthscale_bins = jnp.linspace(lengthscale.min(), lengthscale.max() + 1e-6, num_lengthscale_bins)
+
+    cube_files = []
+    for name in ['dtec', 'dtec_uncert']:
+        fits_file = os.path.join(working_dir, 'L{}_screen_{}.fits'.format(obs_num, name))
+        create_fits_cube(fits_file, grid, num_pixels, times, Na, 'mTECU')
+        link_overwrite(fits_file, os.path.join(data_dir, os.path.basename(fits_file)))
+        cube_files.append(fits_file)
+
+    with fits.open(cube_files[0], mode='update', memmap=True) as mean_hdul, \
+            fits.open(cube_files[1], mode='update', memmap=True) as uncert_hdul:
+        mean_cube = mean_hdul[0].data.reshape((Nt * Na, -1))
+        uncert_cube = uncert_hdul[0].data.reshape((Nt * Na, -1))
+
+        def write(columns, pixel_slice, mean, var):
+            mask = outside[pixel_slice]
+            mean_cube[columns, pixel_slice] = np.where(mask, np.nan, mean)
+            uncert_cube[columns, pixel_slice] = np.where(mask, np.nan, np.sqrt(var))
+
+        stream_gridded_screen(M32(), X, jnp.asarray(Xstar), dtec, dtec_uncert, lengthscale, sigma, lengthscale_bins,
+                              write, column_chunksize=column_chunksize, pixel_chunksize=pixel_chunksize)
+
+
+def debug_main():
+    main(data_dir='/home/albert/data/gains_screen/data',
+         working_dir='/home/albert/data/gains_screen/working_dir/',
+         obs_num=342938,
+         ref_image_fits='/home/albert/data/gains_screen/data/lotss_archive_deep_image.app.restored.fits',
+         num_pixels=512,
+         column_chunksize=32,
+         pixel_chunksize=8192,
+         num_lengthscale_bins=120)
+
+
+def add_args(parser):
+    parser.register("type", "bool", lambda v: v.lower() == "true")
+    parser.add_argument('--obs_num', help='Obs number L*',
+                        default=None, type=int, required=True)
+    parser.add_argument('--data_dir', help='Where are the h5parm files are stored.',
+                        default=None, type=str, required=True)
+    parser.add_argument('--working_dir', help='Where to perform the work.',
+                        default=None, type=str, required=True)
+    parser.add_argument('--ref_image_fits', help='Image whose field and projection the screen is rendered on.',
+                        type=str, required=True)
+    parser.add_argument('--num_pixels', help='Number of pixels along each side of the rendered screen.',
+                        default=512, type=int, required=False)
+    parser.add_argument('--column_chunksize', help='Number of (antenna, time) screens predicted at once.',
+                        default=32, type=int, required=False)
+    parser.add_argument('--pixel_chunksize', help='Number of pixels predicted at once.',
+                        default=8192, type=int, required=False)
+    parser.add_argument('--num_lengthscale_bins',
+                        help='Number of lengthscale bins the kernel is formed at, over the range of inferred lengthscales.',
+                        default=120, type=int, required=False)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        debug_main()
+        exit(0)
+    parser = argparse.ArgumentParser(
+        description='Render the DTEC screen onto FITS cubes on a regular grid over the reference image.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_args(parser)
+    flags, unparsed = parser.parse_known_args()
+    logger.info("Running with:")
+    for option, value in vars(flags).items():
+        logger.info("    {} -> {}".format(option, value))
+    main(**vars(flags))
@@ -38,9 +38,11 @@ def train_neural_network(datapack: DataPack, batch_size, learning_rate, num_batc
     n_screen = 250
     kstar = random.uniform(random.PRNGKey(29428942),(n_screen,3), minval=jnp.min(k, axis=0), maxval=jnp.max(k, axis=0))
     kstar /= jnp.linalg.norm(kstar, axis=-1, keepdims=True)
-    X = jnp.asarray(make_coord_array(x,
-                                     jnp.concatenate([k,kstar], axis=0),
-                                     t[:,None]))
+    # lazy, so only the rows of each batch are materialised
+    X = make_coord_array(x,
+                         jnp.concatenate([k,kstar], axis=0),
+                         t[:,None],
+                         lazy=True)
     x0 = jnp.asarray(antennas.cartesian.xyz.to(au.km).value.T[0, :])
     ref_ant = x0
 
@@ -49,7 +51,8 @@ def train_neural_network(datapack: DataPack, batch_size, learning_rate, num_batc
 
     def loss(params, key):
         keys = random.split(key,5)
-        indices = random.permutation(keys[0], jnp.arange(X.shape[0]))[:batch_size]
+        # with replacement, so that only batch_size indices are drawn rather than all of X being shuffled
+        indices = random.randint(keys[0], (batch_size,), 0, X.shape[0])
         X_batch = X[indices, :]
 
         wind_velocity = random.uniform(keys[1], shape=(3,), minval=jnp.asarray([-200., -200., 0.]), maxval=jnp.asarray([200., 200., 0.]))/1000.
@@ -93,6 +93,66 @@ class TomographicKernel(Kernel):
         return smin, smax
 
 
+    def ray_quadrature(self, x, k, bottom, width):
+        """
+        Quadrature points and weights of the TEC ray integrals, with the same rule as __call__, so that the kernel
+        between two (differential) rays is the weighted sum of the FED kernel between their points. The points
+        don't depend on the FED kernel parameters, so can be computed once per layer and shared, e.g. those of the
+        reference antenna across all antennas. Frozen flow is not applied.
+
+        Args:
+            x: [N, 3] or [3] ray origins
+            k: [N, 3] ray directions
+            bottom: ionosphere layer bottom in km
+            width: ionosphere layer width in km
+
+        Returns:
+            points [N, S_marg + 1, 3] origin at centre of Earth, weights [N, S_marg + 1]
+        """
+        x, k = jnp.broadcast_arrays(x - self.earth_centre, k)
+        smin, smax = self.compute_integration_limits(x, k, bottom, width)
+        t = jnp.linspace(0., 1., self.S_marg + 1)
+        points = x[:, None, :] + k[:, None, :] * (smin[:, None, None] + (smax - smin)[:, None, None] * t[:, None])
+        weights = jnp.broadcast_to(((smax - smin) / self.S_marg)[:, None], points.shape[:2])
+        return points, weights
+
+    def quadrature_covariance(self, points1, weights1, points2, weights2, fed_sigma, fed_kernel_params,
+                              tile_size=1):
+        """
+        Kernel between rays given by their quadrature (see ray_quadrature), computed in tiles of `tile_size` rows
+        so that memory is O(tile_size P1 N2 P2) rather than O(N1 P1 N2 P2). A differential ray is the concatenation
+        of the points of both rays, with the reference weights negated.
+
+        Args:
+            points1: [N1, P1, 3]
+            weights1: [N1, P1]
+            points2: [N2, P2, 3]
+            weights2: [N2, P2]
+            fed_sigma: variation scaling in mTECU/km, or 10^10 electron/m^3
+            fed_kernel_params: dict of FED kernel parameters
+            tile_size: int, rows computed at once
+
+        Returns:
+            [N1, N2]
+        """
+        sigma = fed_kernel_params.get('sigma')
+        l = fed_kernel_params.get('l')
+        N1, P1, _ = points1.shape
+        N2, P2, _ = points2.shape
+        num_tiles = -(-N1 // tile_size)
+        pad = num_tiles * tile_size - N1
+        points1 = jnp.concatenate([points1, jnp.zeros((pad, P1, 3))], axis=0).reshape((num_tiles, tile_size * P1, 3))
+        weights1 = jnp.concatenate([weights1, jnp.zeros((pad, P1))], axis=0).reshape((num_tiles, tile_size, P1))
+        _points2 = points2.reshape((N2 * P2, 3))
+
+        def tile(points1, weights1):
+            K = self.fed_kernel(points1, _points2, l, sigma).reshape((tile_size, P1, N2, P2))
+            return jnp.einsum('ip,ipjq,jq->ij', weights1, K, weights2)
+
+        K = scan_vmap(tile)(points1, weights1)
+        return fed_sigma ** 2 * K.reshape((num_tiles * tile_size, N2))[:N1]
+
+
     def build_Kxy(self, bottom, width, fed_sigma, fed_kernel_params, wind_velocity=None):
         """
         Construct a callable that returns the TEC kernel function.
@@ -267,4 +327,22 @@ def test_frozen_flow_transform():
     x0 = jnp.asarray([0., 100., 6400.])
     bottom = 300.
     wind_velocity = jnp.asarray([-0.240, 0.030, 0.])
-    print(frozen_flow_transform(t, y, x0, bottom, wind_velocity=wind_velocity))
\ No newline at end of file
+    print(frozen_flow_transform(t, y, x0, bottom, wind_velocity=wind_velocity))
+
+def test_quadrature_covariance():
+    from jaxns.modules.gaussian_process.kernels import M32
+    earth_centre = jnp.asarray([0., 0., -6371.])
+    x0 = jnp.zeros(3)
+    kernel = TomographicKernel(x0, earth_centre, M32(), S_marg=8, compute_tec=False)
+    x = jnp.asarray([[5., 2., 0.]])
+    k = jnp.asarray([[0.1, 0.05, 1.], [-0.1, 0.02, 1.], [0.05, -0.1, 1.]])
+    k /= jnp.linalg.norm(k, axis=-1, keepdims=True)
+    bottom, width, fed_sigma, fed_kernel_params = 250., 50., 1.5, dict(l=5., sigma=1.)
+    X = GeodesicTuple(x=x, k=k, t=jnp.zeros((3, 1)), ref_x=x0)
+    expect = kernel(X, X, bottom, width, fed_sigma, fed_kernel_params)
+    points, weights = kernel.ray_quadrature(x, k, bottom, width)
+    ref_points, ref_weights = kernel.ray_quadrature(x0, k, bottom, width)
+    points = jnp.concatenate([points, ref_points], axis=1)
+    weights = jnp.concatenate([weights, -ref_weights], axis=1)
+    K = kernel.quadrature_covariance(points, weights, points, weights, fed_sigma, fed_kernel_params, tile_size=2)
+    assert jnp.allclose(K, expect)
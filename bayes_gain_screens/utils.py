@@ -1,5 +1,6 @@
 import os
 import time
+import hashlib
 
 from jax import tree_map, local_device_count, devices as get_devices, pmap, jit, device_get, tree_multimap
 from timeit import default_timer
@@ -11,7 +12,7 @@ import astropy.units as au
 from astropy import wcs
 from astropy.io import fits
 
-from jax import numpy as jnp, vmap, grad
+from jax import numpy as jnp, vmap, grad, custom_jvp
 from jax.scipy.ndimage import map_coordinates
 
 from jax.scipy.signal import convolve
@@ -28,13 +29,192 @@ logger = logging.getLogger(__name__)
 dist_type = au.km
 angle_type = au.rad
 
-def build_lookup_index(*arrays):
-    def linear_lookup(values, *coords):
+def build_lookup_index(*arrays, order=1):
+    """
+    Build a callable(values, *coords) that interpolates `values` tabulated on the grid spanned by `arrays`.
+
+    See RegularGridLookup.
+    """
+    return RegularGridLookup(*arrays, order=order)
+
+
+def _interp_weights(t, order):
+    """
+    Interpolation weights, and their derivatives w.r.t. t, for the taps around a cell with fractional offset t.
+
+    Args:
+        t: fractional offset in [0, 1] within the cell
+        order: 1 for linear (taps at 0, 1), 3 for Catmull-Rom cubic (taps at -1, 0, 1, 2)
+
+    Returns:
+        list of weights, list of d(weights)/dt
+    """
+    if order == 1:
+        return [1. - t, t], [-jnp.ones_like(t), jnp.ones_like(t)]
+    t2 = t * t
+    t3 = t2 * t
+    weights = [-0.5 * t3 + t2 - 0.5 * t,
+               1.5 * t3 - 2.5 * t2 + 1.,
+               -1.5 * t3 + 2. * t2 + 0.5 * t,
+               0.5 * t3 - 0.5 * t2]
+    dweights = [-1.5 * t2 + 2. * t - 0.5,
+                4.5 * t2 - 5. * t,
+                -4.5 * t2 + 4. * t + 0.5,
+                1.5 * t2 - t]
+    return weights, dweights
+
+
+class RegularGridLookup(object):
+    def __init__(self, *arrays, order=1):
+        """
+        Multilinear (or cubic) interpolator of values tabulated on the Cartesian product of 1D grids.
+
+        For uniformly spaced grids the fractional index is computed from a stored origin and spacing, rather than
+        searching the coordinate array. Non-uniform grids are detected and fall back to a searchsorted lookup.
+        Queries outside the grid are clamped to the edge, like `jnp.interp`.
+
+        Args:
+            *arrays: 1D increasing coordinate arrays, one per dimension of the table.
+            order: int, 1 for multilinear, 3 for Catmull-Rom cubic interpolation.
+        """
+        if order not in (1, 3):
+            raise ValueError(f"order should be 1 or 3, got {order}.")
+        self.order = order
+        self.arrays = [np.asarray(array) for array in arrays]
+        self.shape = tuple(array.size for array in self.arrays)
+        self.origin = []
+        self.inv_spacing = []
+        self.regular = []
+        for array in self.arrays:
+            if array.ndim != 1:
+                raise ValueError(f"Grid arrays should be 1D, got shape {array.shape}.")
+            if array.size == 1:
+                self.origin.append(array[0])
+                self.inv_spacing.append(0.)
+                self.regular.append(True)
+                continue
+            diff = np.diff(array)
+            if np.any(diff <= 0.):
+                raise ValueError("Grid arrays should be strictly increasing.")
+            spacing = (array[-1] - array[0]) / (array.size - 1)
+            self.origin.append(array[0])
+            self.inv_spacing.append(1. / spacing)
+            self.regular.append(bool(np.allclose(diff, spacing, rtol=1e-5, atol=0.)))
+        self._interp = self._build_interp()
+
+    def fractional_index(self, dim, coord):
+        """
+        Fractional index of `coord` along grid dimension `dim`, clamped to [0, n-1].
+        """
+        n = self.shape[dim]
+        if self.regular[dim]:
+            index = coord * self.inv_spacing[dim] - self.origin[dim] * self.inv_spacing[dim]
+        else:
+            array = jnp.asarray(self.arrays[dim])
+            i0 = jnp.clip(jnp.searchsorted(array, coord, side='right') - 1, 0, n - 2)
+            index = i0 + (coord - array[i0]) / (array[i0 + 1] - array[i0])
+        return jnp.clip(index, 0., n - 1.)
+
+    def _build_interp(self):
+        shape = self.shape
+        order = self.order
+        taps = [0, 1] if order == 1 else [-1, 0, 1, 2]
+
+        def cell(dim, index):
+            n = shape[dim]
+            i0 = jnp.clip(jnp.floor(index), 0, max(n - 2, 0))
+            t = index - i0
+            i0 = i0.astype(jnp.int32)
+            idx = [jnp.clip(i0 + tap, 0, n - 1) for tap in taps]
+            return idx, t
+
+        def contract(values, idx, weights):
+            # sum over all tap combinations of prod_d weights[d][tap_d] * values[idx[0][tap_0], ...]
+            result = 0.
+            for combo in np.ndindex(*([len(taps)] * len(shape))):
+                w = 1.
+                for d, tap in enumerate(combo):
+                    w = w * weights[d][tap]
+                result = result + w * values[tuple(idx[d][tap] for d, tap in enumerate(combo))]
+            return result
+
+        @custom_jvp
+        def interp(values, *index):
+            cells = [cell(d, i) for d, i in enumerate(index)]
+            weights = [_interp_weights(t, order)[0] for _, t in cells]
+            return contract(values, [idx for idx, _ in cells], weights)
+
+        @interp.defjvp
+        def interp_jvp(primals, tangents):
+            values, index = primals[0], primals[1:]
+            dvalues, dindex = tangents[0], tangents[1:]
+            cells = [cell(d, i) for d, i in enumerate(index)]
+            idx = [idx for idx, _ in cells]
+            weights, dweights = zip(*[_interp_weights(t, order) for _, t in cells])
+            out = contract(values, idx, weights)
+            # linear in values
+            dout = contract(dvalues, idx, weights)
+            for d in range(len(shape)):
+                _weights = list(weights)
+                _weights[d] = [dw * dindex[d] for dw in dweights[d]]
+                dout = dout + contract(values, idx, _weights)
+            return out, dout
+
+        return interp
+
+    def __call__(self, values, *coords):
+        """
+        Interpolate the table at coords.
+
+        Args:
+            values: array of shape self.shape
+            *coords: one (broadcastable) array per grid dimension
+
+        Returns:
+            interpolated values with the broadcast shape of coords
+        """
+        if len(coords) != len(self.shape):
+            raise ValueError(f"Expected {len(self.shape)} coordinates, got {len(coords)}.")
+        if values.shape != self.shape:
+            raise ValueError(f"Expected values of shape {self.shape}, got {values.shape}.")
+        coords = jnp.broadcast_arrays(*[jnp.asarray(coord) for coord in coords])
+        index = [self.fractional_index(d, coord) for d, coord in enumerate(coords)]
+        return self._interp(values, *index)
+
+
+def test_regular_grid_lookup():
+    x = np.linspace(0., 1., 11)
+    y = np.linspace(-2., 3., 7)
+    values = np.random.normal(size=(11, 7))
+
+    def reference(values, *coords):
         fractional_coordinates = jnp.asarray([jnp.interp(coord, array, jnp.arange(array.size))
-                                              for array, coord in zip(arrays, coords)])
+                                              for array, coord in zip([x, y], coords)])
         return map_coordinates(values, fractional_coordinates, order=1)
 
-    return linear_lookup
+    lookup = RegularGridLookup(x, y)
+    assert all(lookup.regular)
+    xq = np.random.uniform(-0.1, 1.1, size=100)
+    yq = np.random.uniform(-2.1, 3.1, size=100)
+    assert jnp.allclose(lookup(values, xq, yq), reference(values, xq, yq))
+    assert jnp.allclose(lookup(values, 0.35, 1.2), reference(values, 0.35, 1.2))
+    # gradients match the piecewise linear derivative
+    g = grad(lambda x: lookup(values, x, 0.3))(0.42)
+    assert jnp.isclose(g, (lookup(values, 0.42 + 1e-4, 0.3) - lookup(values, 0.42 - 1e-4, 0.3)) / 2e-4, atol=1e-4)
+    # non-uniform grid falls back to searchsorted
+    x_nu = x ** 2
+    lookup = RegularGridLookup(x_nu, y)
+    assert not lookup.regular[0]
+    fx = jnp.interp(xq, x_nu, jnp.arange(x_nu.size))
+    fy = jnp.interp(yq, y, jnp.arange(y.size))
+    assert jnp.allclose(lookup(values, xq, yq), map_coordinates(values, jnp.asarray([fx, fy]), order=1))
+    # cubic reproduces a quadratic away from the edges
+    values = (x[:, None] ** 2) * np.ones((1, 7))
+    lookup = RegularGridLookup(x, y, order=3)
+    xq = np.random.uniform(0.1, 0.9, size=100)
+    assert jnp.allclose(lookup(values, xq, 0.), xq ** 2)
+    g = grad(lambda x: lookup(values, x, 0.))(0.43)
+    assert jnp.isclose(g, 2. * 0.43, atol=1e-6)
 
 def voronoi_finite_polygons_2d(vor, radius):
     """
@@ -121,43 +301,113 @@ def voronoi_finite_polygons_2d(vor, radius):
     return new_regions, np.asarray(new_vertices)
 
 
+def _pad_window(a, w, mode):
+    """
+    Pad the leading axis of `a` so that a 'valid' window of length `w` yields an output of the original length.
+    """
+    _w1 = (w - 1) // 2
+    _w2 = _w1 if (w % 2 == 1) else _w1 + 1
+    pad_width = [(_w1, _w2)] + [(0, 0)] * (len(a.shape) - 1)
+    return jnp.pad(a, pad_width=pad_width, mode=mode)
+
+
+def _finite_mean(a, axis=0):
+    """
+    Mean over the finite entries of `a` along `axis` (kept), zero where there are none.
+    """
+    finite = jnp.isfinite(a)
+    count = jnp.sum(finite, axis=axis, keepdims=True)
+    return jnp.sum(jnp.where(finite, a, 0.), axis=axis, keepdims=True) / jnp.maximum(count, 1)
+
+
+def _windowed_cumsum(a, w, mode):
+    """
+    Sum over a sliding window along the leading axis with a single cumulative sum, i.e. O(N) rather than O(N*w).
+    Floating point series are centred first so that the difference of cumulative sums doesn't lose precision on
+    long series. Non-finite samples are left out of the cumulative sum and only poison their own windows, with the
+    nan/inf a direct sum over the window would give.
+    """
+    N = a.shape[0]
+    if jnp.issubdtype(a.dtype, jnp.integer):
+        offset = jnp.zeros_like(a[:1])
+    else:
+        offset = _finite_mean(a, axis=0)
+
+    def _cumsum_window(a):
+        a = _pad_window(a, w, mode)
+        cumsum = jnp.cumsum(a, axis=0)
+        cumsum = jnp.concatenate([jnp.zeros_like(cumsum[:1]), cumsum], axis=0)
+        return cumsum[w:w + N] - cumsum[:N]
+
+    if jnp.issubdtype(a.dtype, jnp.integer):
+        return _cumsum_window(a)
+    finite = jnp.isfinite(a)
+    result = _cumsum_window(jnp.where(finite, a - offset, 0.)) + w * offset
+    # integer counts, so exact
+    num_nan = _cumsum_window(jnp.isnan(a).astype(jnp.int32))
+    num_posinf = _cumsum_window(jnp.isposinf(a).astype(jnp.int32))
+    num_neginf = _cumsum_window(jnp.isneginf(a).astype(jnp.int32))
+    result = jnp.where(num_posinf > 0, jnp.inf, result)
+    result = jnp.where(num_neginf > 0, -jnp.inf, result)
+    return jnp.where((num_nan > 0) | ((num_posinf > 0) & (num_neginf > 0)), jnp.nan, result)
+
+
 def windowed_nanmean(a, w, mode='reflect', axis=0):
+    """
+    Perform rolling window average (smoothing), ignoring nan's.
+
+    Args:
+        a: array
+        w: window length
+        mode: see jnp.pad
+        axis: axis to smooth down
+
+    Returns: Array the same size as `a`, with zero where the window contains only nan's.
+    """
     if w is None:
         return jnp.broadcast_to(jnp.nanmean(a, axis=axis, keepdims=True), a.shape)
-    count = windowed_sum(jnp.where(jnp.isnan(a), 0., 1.), w, mode, axis)
-    return jnp.where(count == 0., 0., windowed_sum(jnp.where(jnp.isnan(a), 0., a), w, mode, axis) / count)
+    isnan = jnp.isnan(a)
+    # count is integer valued so the cumulative sum is exact
+    count = windowed_sum(jnp.where(isnan, 0, 1), w, mode, axis)
+    return jnp.where(count == 0, 0., windowed_sum(jnp.where(isnan, 0., a), w, mode, axis) / jnp.maximum(count, 1))
 
 
 def test_windowed_nanmean():
     a = jnp.array([0., 1., 2., jnp.nan])
     assert jnp.allclose(windowed_nanmean(a, 3), jnp.array([0.6666667, 1., 1.5, 2.]))
+    a = jnp.array([jnp.nan, jnp.nan, jnp.nan, 1.])
+    assert jnp.allclose(windowed_nanmean(a, 3), jnp.array([0., 0., 1., 1.]))
 
 def windowed_sum(a, w, mode='reflect', axis=0):
     """
-    Perform rolling window average (smoothing).
+    Perform rolling window sum, using cumulative sums so that the cost is independent of window size.
 
     Args:
-        a: array
+        a: array, any leading/trailing batch dimensions
         w: window length
-        mode: see jnp.pad
-        axis: axis to smooth down
+        mode: see jnp.pad, e.g. 'reflect' or 'edge'
+        axis: axis to sum down
 
     Returns: Array the same size as `a`
     """
     if axis != 0:
         a = jnp.moveaxis(a, axis, 0)
-    dims = len(a.shape)
-    a = a
-    kernel = jnp.reshape(jnp.ones(w), [w] + [1] * (dims - 1))
-    _w1 = (w - 1) // 2
-    _w2 = _w1 if (w % 2 == 1) else _w1 + 1
-    pad_width = [(_w1, _w2)] + [(0, 0)] * (dims - 1)
-    a = jnp.pad(a, pad_width=pad_width, mode=mode)
-    result = convolve(a, kernel, mode='valid', precision=None)
+    result = _windowed_cumsum(a, w, mode)
     if axis != 0:
         result = jnp.moveaxis(result, 0, axis)
     return result
 
+def test_windowed_sum():
+    a = np.random.normal(size=(3, 20, 4))
+    for w in [1, 2, 3, 4, 7]:
+        for mode in ['reflect', 'edge']:
+            _w1 = (w - 1) // 2
+            _w2 = _w1 if (w % 2 == 1) else _w1 + 1
+            padded = np.pad(a, [(0, 0), (_w1, _w2), (0, 0)], mode=mode)
+            expect = convolve(padded, np.ones((1, w, 1)), mode='valid')
+            assert jnp.allclose(windowed_sum(a, w, mode=mode, axis=1), expect, atol=1e-5)
+            assert jnp.allclose(windowed_sum(a, w, mode=mode, axis=-2), expect, atol=1e-5)
+
 def windowed_mean(a, w, mode='reflect', axis=0):
     """
     Perform rolling window average (smoothing).
@@ -177,6 +427,126 @@ def windowed_mean(a, w, mode='reflect', axis=0):
 def test_windowed_mean():
     a = jnp.array([0., 1., 2., 2.])
     assert jnp.allclose(windowed_nanmean(a, 3), jnp.array([2/3., 1., 5/3., 2.]))
+    assert jnp.allclose(windowed_mean(a, 3), jnp.array([2/3., 1., 5/3., 2.]))
+
+def windowed_var(a, w, mode='reflect', axis=0):
+    """
+    Perform rolling window (biased) variance.
+
+    Args:
+        a: array
+        w: window length
+        mode: see jnp.pad
+        axis: axis to compute variance down
+
+    Returns: Array the same size as `a`
+    """
+    if w is None:
+        return jnp.broadcast_to(jnp.var(a, axis=axis, keepdims=True), a.shape)
+    # centred, so that E[a^2] - E[a]^2 doesn't cancel catastrophically when the mean is large compared to the spread
+    a = a - _finite_mean(a, axis=axis)
+    mean = windowed_mean(a, w, mode, axis)
+    mean2 = windowed_mean(a ** 2, w, mode, axis)
+    return jnp.maximum(mean2 - mean ** 2, 0.)
+
+def test_windowed_var():
+    a = np.random.normal(size=(30,))
+    var = windowed_var(a, 5)
+    padded = np.pad(a, (2, 2), mode='reflect')
+    expect = np.asarray([np.var(padded[i:i + 5]) for i in range(30)])
+    assert jnp.allclose(var, expect, atol=1e-5)
+    # large mean compared to the spread
+    var = windowed_var(1e6 + a, 5)
+    assert jnp.allclose(var, expect, rtol=1e-3)
+
+def test_windowed_sum_non_finite():
+    a = np.arange(20.)
+    a[15] = np.nan
+    a[5] = np.inf
+    a[8] = -np.inf
+    for w in [1, 3, 4]:
+        _w1 = (w - 1) // 2
+        _w2 = _w1 if (w % 2 == 1) else _w1 + 1
+        padded = np.pad(a, (_w1, _w2), mode='reflect')
+        with np.errstate(invalid='ignore'):
+            expect = np.asarray([np.sum(padded[i:i + w]) for i in range(20)])
+        assert np.allclose(windowed_sum(a, w), expect, equal_nan=True)
+        assert np.allclose(windowed_mean(a, w), expect / w, equal_nan=True)
+    # bad samples only affect their own windows
+    assert np.all(np.isfinite(windowed_mean(a, 3)[:4]))
+
+def rolling_median(a, w, mode='reflect'):
+    """
+    Rolling median along the last axis of a batch of series, ignoring nan's.
+
+    Keeps a sorted copy of every window and slides it along by deleting the outgoing sample and inserting the incoming
+    one at its rank, so each step is O(w) and vectorised across the series, rather than the O(w log w) of re-sorting.
+    Nan's are stored as +inf so they sort to the end of the window, and the median is taken over the finite part.
+
+    Args:
+        a: [..., N] series
+        w: int, window length
+        mode: see np.pad
+
+    Returns:
+        [..., N] rolling median, nan where the window contains only nan's.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    shape = a.shape
+    a = a.reshape((-1, shape[-1]))
+    B, N = a.shape
+    _w1 = (w - 1) // 2
+    _w2 = _w1 if (w % 2 == 1) else _w1 + 1
+    a = np.pad(a, [(0, 0), (_w1, _w2)], mode=mode)
+    a = np.where(np.isnan(a), np.inf, a)
+    rows = np.arange(B)
+    slots = np.arange(w)
+    window = np.sort(a[:, :w], axis=1)
+    output = np.empty((B, N))
+    for i in range(N):
+        count = np.sum(np.isfinite(window), axis=1)
+        lower = window[rows, np.maximum(count - 1, 0) // 2]
+        upper = window[rows, np.minimum(count // 2, w - 1)]
+        output[:, i] = np.where(count > 0, 0.5 * (lower + upper), np.nan)
+        if i == N - 1:
+            break
+        # delete the outgoing sample (the first slot with its value) and insert the incoming one at its rank
+        outgoing = np.argmax(window == a[:, i:i + 1], axis=1)
+        incoming = a[:, i + w]
+        rank = np.sum(window < incoming[:, None], axis=1)
+        rank = rank - (rank > outgoing)
+        src = slots[None, :] - (slots[None, :] > rank[:, None])
+        src = src + (src >= outgoing[:, None])
+        window = np.where(slots[None, :] == rank[:, None], incoming[:, None],
+                          window[rows[:, None], np.minimum(src, w - 1)])
+    return output.reshape(shape)
+
+
+def test_rolling_median():
+    import warnings
+    from numpy.lib.stride_tricks import sliding_window_view
+    a = np.random.normal(size=(3, 4, 100))
+    a[..., ::7] = np.nan
+    a[0, 0, 10:30] = np.nan
+    a[1, 1, 50:55] = 3.
+    for w in [1, 2, 5, 15]:
+        _w1 = (w - 1) // 2
+        _w2 = _w1 if (w % 2 == 1) else _w1 + 1
+        _a = np.pad(a, [(0, 0), (0, 0), (_w1, _w2)], mode='reflect')
+        with warnings.catch_warnings():
+            # all-nan windows
+            warnings.simplefilter('ignore')
+            expect = np.nanmedian(sliding_window_view(_a, w, axis=-1), axis=-1)
+        assert np.allclose(rolling_median(a, w), expect, equal_nan=True)
+
+
+def test_rolling_median_benchmark():
+    _skip_unless_benchmarking()
+    a = np.random.normal(size=(2000, 3600))
+    t0 = default_timer()
+    rolling_median(a, 15)
+    logger.info("Rolling median of 2000 series of length 3600 in {} seconds".format(default_timer() - t0))
+
 
 def get_coordinates(datapack: DataPack, ref_ant=0, ref_dir=0):
     tmp_selection = datapack._selection
@@ -190,31 +560,153 @@ def get_coordinates(datapack: DataPack, ref_ant=0, ref_dir=0):
     _, _antennas = datapack.get_antennas(axes['ant'])
     _, _directions = datapack.get_directions(axes['dir'])
     _, times = datapack.get_times(axes['time'])
+    return compute_enu_coordinates(_antennas, _directions, times, _ref_ant, _ref_dir)
+
+def compute_enu_coordinates(antennas, directions, times, ref_ant, ref_dir):
+    """
+    Compute antenna positions and directions in the ENU frame of the reference antenna, at all times at once.
+
+    A single batched astropy transform is done over the (time, object) grid, rather than one per time.
+
+    Args:
+        antennas: ITRS-like antenna locations [Na]
+        directions: ICRS-like directions [Nd]
+        times: astropy Time [Nt]
+        ref_ant: ITRS-like reference antenna [1]
+        ref_dir: ICRS-like reference direction [1]
+
+    Returns:
+        X [Nt, Nd, Na, 6] directions and antenna positions (km) coordinate array
+        ref_ant [Nt, 3] in km
+        ref_dir [Nt, 3]
+    """
     Nt = len(times)
+    obstime = times.reshape((Nt, 1))
+    ref_location = ac.ITRS(x=ref_ant.x, y=ref_ant.y, z=ref_ant.z)
+    enu = ENU(location=ref_location, obstime=obstime)
+
+    def _to_enu(coords):
+        # [Nt, N, 3]
+        return np.moveaxis(coords.transform_to(enu).cartesian.xyz, 0, -1)
+
+    def _itrs(x):
+        # broadcast over time
+        return ac.ITRS(x=x.x.reshape((1, -1)), y=x.y.reshape((1, -1)), z=x.z.reshape((1, -1)), obstime=obstime)
+
+    def _icrs(x):
+        return ac.ICRS(ra=x.ra.reshape((1, -1)), dec=x.dec.reshape((1, -1)))
+
+    _ref_ant = _to_enu(_itrs(ref_ant)).to(dist_type).value[:, 0, :]
+    _ref_dir = _to_enu(_icrs(ref_dir)).value[:, 0, :]
+    _antennas = _to_enu(_itrs(antennas)).to(dist_type).value
+    _directions = _to_enu(_icrs(directions)).value
+    Nd = _directions.shape[1]
+    Na = _antennas.shape[1]
+    # Nt, Nd, Na, 6
+    X = np.concatenate([np.broadcast_to(_directions[:, :, None, :], (Nt, Nd, Na, 3)),
+                        np.broadcast_to(_antennas[:, None, :, :], (Nt, Nd, Na, 3))], axis=-1)
+    return X, _ref_ant, _ref_dir
 
+def _looped_enu_coordinates(antennas, directions, times, ref_ant, ref_dir):
+    # one transform per time, kept as a reference for compute_enu_coordinates
     X_out = []
     ref_ant_out = []
     ref_dir_out = []
-    for t in range(Nt):
-        obstime = times[t]
-        ref_location = ac.ITRS(x=_ref_ant.x, y=_ref_ant.y, z=_ref_ant.z)
-        ref_ant = ac.ITRS(x=_ref_ant.x, y=_ref_ant.y, z=_ref_ant.z, obstime=obstime)
-        ref_dir = ac.ICRS(ra=_ref_dir.ra, dec=_ref_dir.dec)
+    for obstime in times:
+        ref_location = ac.ITRS(x=ref_ant.x, y=ref_ant.y, z=ref_ant.z)
+        _ref_ant = ac.ITRS(x=ref_ant.x, y=ref_ant.y, z=ref_ant.z, obstime=obstime)
+        _ref_dir = ac.ICRS(ra=ref_dir.ra, dec=ref_dir.dec)
         enu = ENU(location=ref_location, obstime=obstime)
-        ref_ant = ref_ant.transform_to(enu).cartesian.xyz.to(dist_type).value.T
-        ref_dir = ref_dir.transform_to(enu).cartesian.xyz.value.T
-        antennas = ac.ITRS(x=_antennas.x, y=_antennas.y, z=_antennas.z, obstime=obstime)
-        antennas = antennas.transform_to(enu).cartesian.xyz.to(dist_type).value.T
-        directions = ac.ICRS(ra=_directions.ra, dec=_directions.dec)
-        directions = directions.transform_to(enu).cartesian.xyz.value.T
-        X_out.append(make_coord_array(directions, antennas, flat=False))
-        ref_ant_out.append(ref_ant)
-        ref_dir_out.append(ref_dir)
-    # Nt, Nd, Na, 6
-    X = np.stack(X_out, axis=0)
-    ref_ant = np.concatenate(ref_ant_out, axis=0)
-    ref_dir = np.concatenate(ref_dir_out, axis=0)
-    return X, ref_ant, ref_dir
+        ref_ant_out.append(_ref_ant.transform_to(enu).cartesian.xyz.to(dist_type).value.T)
+        ref_dir_out.append(_ref_dir.transform_to(enu).cartesian.xyz.value.T)
+        _antennas = ac.ITRS(x=antennas.x, y=antennas.y, z=antennas.z, obstime=obstime)
+        _antennas = _antennas.transform_to(enu).cartesian.xyz.to(dist_type).value.T
+        _directions = ac.ICRS(ra=directions.ra, dec=directions.dec)
+        _directions = _directions.transform_to(enu).cartesian.xyz.value.T
+        X_out.append(make_coord_array(_directions, _antennas, flat=False))
+    return np.stack(X_out, axis=0), np.concatenate(ref_ant_out, axis=0), np.concatenate(ref_dir_out, axis=0)
+
+def _example_enu_inputs(Nt, Nd=5, Na=4):
+    from astropy import time as at
+    x0 = np.array([3826577.462, 461022.624, 5064892.526])
+    antennas = x0 + np.random.normal(scale=5000., size=(Na, 3))
+    antennas = ac.ITRS(x=antennas[:, 0] * au.m, y=antennas[:, 1] * au.m, z=antennas[:, 2] * au.m)
+    directions = ac.ICRS(ra=np.random.uniform(120., 130., size=Nd) * au.deg,
+                         dec=np.random.uniform(60., 70., size=Nd) * au.deg)
+    times = at.Time("2019-01-01T00:00:00.000", format='isot') + np.arange(Nt) * 30. * au.s
+    return antennas, directions, times, antennas[0:1], directions[0:1]
+
+def test_compute_enu_coordinates():
+    antennas, directions, times, ref_ant, ref_dir = _example_enu_inputs(3)
+    X, _ref_ant, _ref_dir = compute_enu_coordinates(antennas, directions, times, ref_ant, ref_dir)
+    X_loop, _ref_ant_loop, _ref_dir_loop = _looped_enu_coordinates(antennas, directions, times, ref_ant, ref_dir)
+    assert X.shape == (3, 5, 4, 6)
+    assert _ref_ant.shape == (3, 3)
+    assert _ref_dir.shape == (3, 3)
+    assert np.allclose(X[..., :3], X_loop[..., :3], atol=1e-9)
+    assert np.allclose(X[..., 3:], X_loop[..., 3:], atol=1e-6)#km
+    assert np.allclose(_ref_ant, _ref_ant_loop, atol=1e-6)
+    assert np.allclose(_ref_dir, _ref_dir_loop, atol=1e-9)
+
+def _skip_unless_benchmarking():
+    """
+    Heavy timing tests only run with BAYES_GAIN_SCREENS_BENCHMARKS=1, to keep them out of the default test run.
+    """
+    if os.environ.get('BAYES_GAIN_SCREENS_BENCHMARKS', '0') != '1':
+        import pytest
+        pytest.skip("benchmark, set BAYES_GAIN_SCREENS_BENCHMARKS=1 to run")
+
+def test_compute_enu_coordinates_benchmark():
+    _skip_unless_benchmarking()
+    Nt = 1000
+    antennas, directions, times, ref_ant, ref_dir = _example_enu_inputs(Nt, Nd=45, Na=62)
+    t0 = default_timer()
+    X, _, _ = compute_enu_coordinates(antennas, directions, times, ref_ant, ref_dir)
+    dt_vectorised = default_timer() - t0
+    t0 = default_timer()
+    _looped_enu_coordinates(antennas, directions, times[:10], ref_ant, ref_dir)
+    dt_looped = (default_timer() - t0) * Nt / 10.
+    logger.info(f"ENU coordinates for Nt={Nt}: vectorised {dt_vectorised} s, looped (extrapolated) {dt_looped} s.")
+    assert X.shape == (Nt, 45, 62, 6)
+
+def cluster_antennas(positions, max_distance):
+    """
+    Group antennas by single linkage, i.e. two antennas are in the same group if they are connected by a chain of
+    antennas no more than `max_distance` apart.
+
+    Args:
+        positions: [Na, 3] antenna positions
+        max_distance: linking distance, same units as positions
+
+    Returns:
+        [Na] int group labels 0..G-1, numbered in order of first appearance
+    """
+    positions = np.asarray(positions)
+    Na = positions.shape[0]
+    linked = np.linalg.norm(positions[:, None, :] - positions[None, :, :], axis=-1) <= max_distance
+    labels = np.full(Na, -1)
+    num_groups = 0
+    for i in range(Na):
+        if labels[i] >= 0:
+            continue
+        # flood fill
+        labels[i] = num_groups
+        front = [i]
+        while front:
+            j = front.pop()
+            for k in np.where(linked[j] & (labels < 0))[0]:
+                labels[k] = num_groups
+                front.append(k)
+        num_groups += 1
+    return labels
+
+
+def test_cluster_antennas():
+    positions = np.asarray([[0., 0., 0.], [1., 0., 0.], [2., 0., 0.], [10., 0., 0.], [0., 30., 0.], [0., 30.5, 0.]])
+    assert np.all(cluster_antennas(positions, 1.5) == [0, 0, 0, 1, 2, 2])
+    assert np.all(cluster_antennas(positions, 0.1) == np.arange(6))
+    assert np.all(cluster_antennas(positions, 100.) == 0)
+
 
 def great_circle_sep(ra1, dec1, ra2, dec2):
     """
@@ -234,7 +726,7 @@ def great_circle_sep(ra1, dec1, ra2, dec2):
     den = jnp.sin(dec1) * jnp.sin(dec2) + jnp.cos(dec1) * jnp.cos(dec2) * jnp.cos(dra)
     return jnp.arctan2(jnp.sqrt(num2), den)
 
-def make_coord_array(*X, flat=True, coord_map=None):
+def make_coord_array(*X, flat=True, coord_map=None, lazy=False):
     """
     Create the design matrix from a list of coordinates
     :param X: list of length p of float, array [Ni, D]
@@ -243,6 +735,8 @@ def make_coord_array(*X, flat=True, coord_map=None):
         Whether to return a flattened representation
     :param coord_map: callable(coordinates), optional
             If not None then get mapped over the coordinates
+    :param lazy: bool
+        If True return a CoordProduct which only materialises the rows that are asked for. Requires flat=True.
     :return: float, array [N0,...,Np, D] if flat=False else [N0*...*Np, D]
         The coordinate design matrix
     """
@@ -250,6 +744,11 @@ def make_coord_array(*X, flat=True, coord_map=None):
     if coord_map is not None:
         X = [coord_map(x) for x in X]
 
+    if lazy:
+        if not flat:
+            raise ValueError("lazy=True only supports the flat design matrix, set flat=True.")
+        return CoordProduct(*X)
+
     def add_dims(x, where, sizes):
         shape = []
         tiles = []
@@ -273,6 +772,123 @@ def make_coord_array(*X, flat=True, coord_map=None):
         return X
     return jnp.reshape(X, (-1, X.shape[-1]))
 
+
+class CoordProduct(object):
+    def __init__(self, *X):
+        """
+        Lazy representation of the flat design matrix of make_coord_array. Only the factor arrays are stored, and
+        rows of the Cartesian product are gathered on demand, in C-order over the factors.
+
+        Args:
+            *X: list of length p of arrays [Ni, Di]
+        """
+        self.factors = [jnp.asarray(x) for x in X]
+        self.sizes = tuple(x.shape[0] for x in self.factors)
+        self.dims = tuple(x.shape[1] for x in self.factors)
+        self.shape = (int(np.prod(self.sizes)), sum(self.dims))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def unravel(self, indices):
+        """
+        Per-factor row indices of flat product row indices.
+        """
+        return jnp.unravel_index(indices, self.sizes)
+
+    def gather(self, indices):
+        """
+        Rows of the design matrix at flat indices.
+
+        Args:
+            indices: int array [...]
+
+        Returns:
+            [..., D]
+        """
+        indices = jnp.asarray(indices)
+        return jnp.concatenate([jnp.take(x, i, axis=0) for x, i in zip(self.factors, self.unravel(indices))],
+                               axis=-1)
+
+    def block(self, start, stop):
+        """
+        Contiguous rows [start, stop) of the design matrix.
+        """
+        stop = min(stop, self.shape[0])
+        return self.gather(jnp.arange(start, stop))
+
+    def blocks(self, block_size):
+        """
+        Iterate over contiguous row blocks of at most `block_size` rows.
+
+        Yields:
+            start row, [block_size, D]
+        """
+        for start in range(0, self.shape[0], block_size):
+            yield start, self.block(start, start + block_size)
+
+    def materialize(self, flat=True):
+        """
+        The full design matrix, same as make_coord_array.
+        """
+        return make_coord_array(*self.factors, flat=flat)
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            rows, cols = item[0], item[1:]
+        else:
+            rows, cols = item, ()
+        if isinstance(rows, slice):
+            X = self.gather(jnp.arange(*rows.indices(self.shape[0])))
+        else:
+            X = self.gather(rows)
+        if len(cols) > 0:
+            X = X[(Ellipsis,) + cols]
+        return X
+
+
+def map_row_blocks(fn, X, block_size):
+    """
+    Apply `fn` to contiguous row blocks of a design matrix and concatenate the results, so that e.g. a kernel against
+    a large Cartesian product is formed without materialising the product.
+
+    Args:
+        fn: callable([block_size, D]) -> [block_size, ...]
+        X: [N, D] array, or CoordProduct, whose rows are only gathered block by block
+        block_size: int, rows per block
+
+    Returns:
+        [N, ...]
+    """
+    if isinstance(X, CoordProduct):
+        blocks = (block for _, block in X.blocks(block_size))
+    else:
+        blocks = (X[start:start + block_size] for start in range(0, X.shape[0], block_size))
+    return jnp.concatenate([fn(block) for block in blocks], axis=0)
+
+
+def test_coord_product():
+    a = np.random.normal(size=(4, 3))
+    b = np.random.normal(size=(5, 3))
+    c = np.random.normal(size=(2, 1))
+    X = make_coord_array(a, b, c, flat=True)
+    lazy = make_coord_array(a, b, c, lazy=True)
+    assert lazy.shape == X.shape
+    assert jnp.allclose(lazy.materialize(), X)
+    indices = np.random.randint(0, X.shape[0], size=(6, 2))
+    assert jnp.allclose(lazy.gather(indices), X[indices])
+    assert jnp.allclose(lazy[indices[:, 0], 3:6], X[indices[:, 0], 3:6])
+    assert jnp.allclose(lazy[7:19], X[7:19])
+    assert jnp.allclose(jnp.concatenate([block for _, block in lazy.blocks(7)], axis=0), X)
+    # a kernel against the product, block by block
+    Y = np.random.normal(size=(3, 7))
+    kernel = lambda X1, X2: jnp.exp(-0.5 * jnp.sum((X1[:, None, :] - X2[None, :, :]) ** 2, axis=-1))
+    assert jnp.allclose(map_row_blocks(lambda X: kernel(X, Y), lazy, 7), kernel(X, Y))
+    assert jnp.allclose(map_row_blocks(lambda X: kernel(X, Y), X, 7), kernel(X, Y))
+    import pytest
+    with pytest.raises(ValueError):
+        make_coord_array(a, b, c, flat=False, lazy=True)
+
 def test_disable_jit_and_scan():
     from jax import disable_jit
     from jax.lax import scan
@@ -282,12 +898,59 @@ def test_disable_jit_and_scan():
     with disable_jit():
         print(scan(body, (jnp.array(0),), (), length=5))
 
+class SkyHashGrid(object):
+    def __init__(self, min_separation_deg):
+        """
+        Incrementally built spatial hash of directions on the sphere, for fast minimum-separation queries.
+
+        Directions are hashed as unit vectors onto a 3D grid with cells the size of the chord of the minimum
+        separation, so any direction closer than that lies in one of the 27 neighbouring cells.
+
+        Args:
+            min_separation_deg: separation in degrees below which directions are neighbours.
+        """
+        self.min_separation = np.deg2rad(min_separation_deg)
+        self.cell_size = max(2. * np.sin(0.5 * min(self.min_separation, np.pi)), 1e-12)
+        self.cells = dict()
+        self._offsets = [(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]
+
+    def _cell(self, ra, dec):
+        xyz = np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+        return tuple(np.floor(xyz / self.cell_size).astype(np.int64))
+
+    def add(self, ra, dec):
+        """
+        Add a direction, in radians.
+        """
+        self.cells.setdefault(self._cell(ra, dec), []).append((ra, dec))
+
+    def is_separated(self, ra, dec):
+        """
+        Whether direction (radians) is further than the minimum separation from all added directions.
+        """
+        i, j, k = self._cell(ra, dec)
+        neighbours = []
+        for di, dj, dk in self._offsets:
+            neighbours.extend(self.cells.get((i + di, j + dj, k + dk), ()))
+        if len(neighbours) == 0:
+            return True
+        ra1, dec1 = np.asarray(neighbours).T
+        dra = np.abs(ra1 - ra)
+        num2 = (np.cos(dec) * np.sin(dra)) ** 2 + (
+                np.cos(dec1) * np.sin(dec) - np.sin(dec1) * np.cos(dec) * np.cos(dra)) ** 2
+        den = np.sin(dec1) * np.sin(dec) + np.cos(dec1) * np.cos(dec) * np.cos(dra)
+        return bool(np.all(np.arctan2(np.sqrt(num2), den) > self.min_separation))
+
+
 def get_screen_directions_from_image(image_fits, flux_limit=0.1, max_N=None, min_spacing_arcmin=1., plot=False,
                                      seed_directions=None, fill_in_distance=None,
                                      fill_in_flux_limit=0.):
     """
     Find directions in an apparent flux image satifying a set of selection criteria.
 
+    Candidate pixels are converted to world coordinates in a single call, and spacing is tested against a
+    SkyHashGrid of the accepted directions.
+
     Args:
         image_fits: FITS image of apparent flux
         flux_limit: float, Selection limit above which to select primary sources.
@@ -307,13 +970,19 @@ def get_screen_directions_from_image(image_fits, flux_limit=0.1, max_N=None, min
     logger.info(f"Getting {max_N} screen directions from image {image_fits} with flux above {flux_limit} "
                 f"separated by at least {min_spacing_arcmin}.")
 
+    def candidates(where_limit):
+        # brightest first, world coordinates in radians of all candidates in one call
+        flux = data[where_limit]
+        arg_sort = np.argsort(flux)[::-1]
+        pix = np.stack([where_limit[3], where_limit[2], where_limit[1], where_limit[0]], axis=1)[arg_sort]
+        coords = w.wcs_pix2world(pix, 1)  # degrees
+        return arg_sort, coords[:, 0] * np.pi / 180., coords[:, 1] * np.pi / 180., flux[arg_sort]
+
     with fits.open(image_fits) as hdul:
         # ra,dec, _, freq
         data = hdul[0].data
         w = wcs.WCS(hdul[0].header)
-        #         Nra, Ndec,_,_ = data.shape
-        where_limit = np.where(data >= flux_limit)
-        arg_sort = np.argsort(data[where_limit])[::-1]
+        arg_sort, cand_ra, cand_dec, cand_f = candidates(np.where(data >= flux_limit))
 
         ra = []
         dec = []
@@ -323,32 +992,29 @@ def get_screen_directions_from_image(image_fits, flux_limit=0.1, max_N=None, min
             dec = list(seed_directions[:, 1])
             f = list(flux_limit * np.ones(len(ra)))
             logger.info("Using {} seed directions.".format(len(f)))
+        index = SkyHashGrid(min_spacing_arcmin / 60.)
+        for ra_, dec_ in zip(ra, dec):
+            index.add(ra_, dec_)
         idx = []
-        for i in arg_sort:
+        for i, ra_, dec_, f_ in zip(arg_sort, cand_ra, cand_dec, cand_f):
             if max_N is not None:
                 if len(ra) >= max_N:
                     break
-            pix = [where_limit[3][i], where_limit[2][i], where_limit[1][i], where_limit[0][i]]
-            #             logger.info("{} -> {}".format(i, pix))
-            #             pix = np.reshape(np.array(np.unravel_index(i, [Nra, Ndec, 1, 1])), (1, 4))
-            coords = w.wcs_pix2world([pix], 1)  # degrees
-            ra_ = coords[0, 0] * np.pi / 180.
-            dec_ = coords[0, 1] * np.pi / 180.
-
             if len(ra) == 0:
                 ra.append(ra_)
                 dec.append(dec_)
-                f.append(data[pix[3], pix[2], pix[1], pix[0]])
+                f.append(f_)
+                index.add(ra_, dec_)
                 logger.info(
                     "Auto-append first: Found {} at {} {}".format(f[-1], ra[-1] * 180. / np.pi,
                                                                   dec[-1] * 180. / np.pi))
                 idx.append(i)
                 continue
-            dist = great_circle_sep(np.array(ra), np.array(dec), ra_, dec_) * 180. / np.pi
-            if np.all(dist > min_spacing_arcmin / 60.):
+            if index.is_separated(ra_, dec_):
                 ra.append(ra_)
                 dec.append(dec_)
-                f.append(data[pix[3], pix[2], pix[1], pix[0]])
+                f.append(f_)
+                index.add(ra_, dec_)
                 logger.info(
                     "Found source of flux {} at {} {}".format(f[-1], ra[-1] * 180. / np.pi, dec[-1] * 180. / np.pi))
                 idx.append(i)
@@ -358,25 +1024,21 @@ def get_screen_directions_from_image(image_fits, flux_limit=0.1, max_N=None, min
         if fill_in_distance is not None:
             logger.info(f"Applying secondary selection criteria. Flux limit {fill_in_flux_limit} and minimum "
                         f"separation {fill_in_distance}.")
-            where_limit = np.where(np.logical_and(data < np.min(f), data >= fill_in_flux_limit))
-            arg_sort = np.argsort(data[where_limit])[::-1]
+            arg_sort, cand_ra, cand_dec, cand_f = candidates(
+                np.where(np.logical_and(data < np.min(f), data >= fill_in_flux_limit)))
+            index = SkyHashGrid(fill_in_distance / 60.)
+            for ra_, dec_ in zip(ra, dec):
+                index.add(ra_, dec_)
             # use remaining brightest sources to get fillers
-            for i in arg_sort:
+            for i, ra_, dec_, f_ in zip(arg_sort, cand_ra, cand_dec, cand_f):
                 if max_N is not None:
                     if len(ra) >= max_N:
                         break
-                pix = [where_limit[3][i], where_limit[2][i], where_limit[1][i], where_limit[0][i]]
-                #                 logger.info("{} -> {}".format(i, pix))
-                coords = w.wcs_pix2world([pix], 1)  # degrees
-
-                ra_ = coords[0, 0] * np.pi / 180.
-                dec_ = coords[0, 1] * np.pi / 180.
-
-                dist = great_circle_sep(np.array(ra), np.array(dec), ra_, dec_) * 180. / np.pi
-                if np.all(dist > fill_in_distance / 60.):
+                if index.is_separated(ra_, dec_):
                     ra.append(ra_)
                     dec.append(dec_)
-                    f.append(data[pix[3], pix[2], pix[1], pix[0]])
+                    f.append(f_)
+                    index.add(ra_, dec_)
                     logger.info(
                         "Found filler {} at {} {}".format(f[-1], ra[-1] * 180. / np.pi, dec[-1] * 180. / np.pi))
                     idx.append(i)
@@ -397,6 +1059,53 @@ def get_screen_directions_from_image(image_fits, flux_limit=0.1, max_N=None, min
 
     return ac.ICRS(ra=ra * au.rad, dec=dec * au.rad), sizes
 
+
+def _make_example_image_fits(fits_file, N=2048, num_sources=20000, cdelt_arcsec=1.5):
+    w = wcs.WCS(naxis=4)
+    w.wcs.crpix = [N / 2, N / 2, 1, 1]
+    w.wcs.cdelt = [-cdelt_arcsec / 3600., cdelt_arcsec / 3600., 1., 1.]
+    w.wcs.crval = [120., 65., 1., 144e6]
+    w.wcs.ctype = ["RA---SIN", "DEC--SIN", "STOKES", "FREQ"]
+    data = np.abs(np.random.normal(scale=1e-4, size=(1, 1, N, N)))
+    i, j = np.random.randint(0, N, size=(2, num_sources))
+    data[0, 0, i, j] = np.random.exponential(0.05, size=num_sources)
+    fits.PrimaryHDU(data=data, header=w.to_header()).writeto(fits_file, overwrite=True)
+    return data, w
+
+
+def test_get_screen_directions_from_image(tmp_path):
+    fits_file = str(tmp_path / 'image.fits')
+    data, w = _make_example_image_fits(fits_file, N=256, num_sources=500)
+    directions, sizes = get_screen_directions_from_image(fits_file, flux_limit=0.01, max_N=None,
+                                                         min_spacing_arcmin=4.)
+    # brute force greedy selection
+    where_limit = np.where(data >= 0.01)
+    arg_sort = np.argsort(data[where_limit])[::-1]
+    pix = np.stack([where_limit[3], where_limit[2], where_limit[1], where_limit[0]], axis=1)[arg_sort]
+    coords = np.deg2rad(w.wcs_pix2world(pix, 1))
+    ra, dec = [], []
+    for ra_, dec_ in coords[:, :2]:
+        if len(ra) == 0 or np.all(np.rad2deg(great_circle_sep(np.array(ra), np.array(dec), ra_, dec_)) > 4. / 60.):
+            ra.append(ra_)
+            dec.append(dec_)
+    assert np.allclose(directions.ra.rad, ra)
+    assert np.allclose(directions.dec.rad, dec)
+
+
+def test_get_screen_directions_from_image_benchmark(tmp_path):
+    _skip_unless_benchmarking()
+    fits_file = str(tmp_path / 'image.fits')
+    _make_example_image_fits(fits_file, N=4096, num_sources=200000, cdelt_arcsec=1.5)
+    t0 = default_timer()
+    directions, _ = get_screen_directions_from_image(fits_file, flux_limit=0.001, max_N=None, min_spacing_arcmin=1.,
+                                                     fill_in_distance=2., fill_in_flux_limit=0.0005)
+    logger.info(f"Selected {len(directions)} screen directions from 200000 candidates in {default_timer() - t0} s.")
+    assert len(directions) > 1
+    # every direction keeps the minimum spacing to its nearest neighbour
+    _, sep, _ = ac.SkyCoord(directions).match_to_catalog_sky(ac.SkyCoord(directions), nthneighbor=2)
+    assert np.all(sep.arcmin > 1. - 1e-6)
+
+
 def inverse_update(C, m, return_drop=False):
     """
     Compute the inverse of a matrix with the m-th row and column dropped given knowledge of the inverse of the original
@@ -541,6 +1250,139 @@ def link_overwrite(src, dst):
         os.symlink(src, dst)
 
 
+class ArrayCache(object):
+    # bump when the on-disk entry format changes, so old entries are never read back
+    FORMAT_VERSION = 1
+
+    def __init__(self, cache_dir, max_bytes=8 * 1024 ** 3, compress=False):
+        """
+        On-disk cache of expensive arrays, keyed by a hash of everything they depend on.
+
+        Entries are .npy files, so hits are returned memory-mapped and nothing is read until used, or compressed .npz
+        files (read in full) if `compress`. When the cache holds more than `max_bytes` the least recently used entries
+        are evicted. Hits, misses and evictions are logged.
+
+        Args:
+            cache_dir: str, directory to store entries in, created if needed.
+            max_bytes: int, size limit of the cache directory.
+            compress: bool, whether to store new entries compressed (not memory-mappable).
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.compress = compress
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*arrays, **metadata):
+        """
+        Hash of arrays (values, shapes and dtypes) and metadata (e.g. kernel type) that determine an entry. Callers
+        should include a version of the code computing the entry in the metadata, so changing it invalidates old
+        entries.
+        """
+        h = hashlib.sha256()
+        h.update(f"format={ArrayCache.FORMAT_VERSION}".encode())
+        for array in arrays:
+            array = np.ascontiguousarray(np.asarray(array))
+            h.update(str((array.shape, array.dtype.str)).encode())
+            h.update(array.tobytes())
+        for name in sorted(metadata.keys()):
+            h.update(f"{name}={metadata[name]}".encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        for ext in ('.npy', '.npz'):
+            path = os.path.join(self.cache_dir, key + ext)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def get(self, key):
+        """
+        Returns:
+            the cached array (memory-mapped if stored uncompressed), or None on a miss.
+        """
+        path = self._path(key)
+        if path is None:
+            logger.info(f"Cache miss {key[:12]} in {self.cache_dir}")
+            return None
+        logger.info(f"Cache hit {key[:12]} in {self.cache_dir}")
+        # mark as recently used for eviction
+        os.utime(path)
+        if path.endswith('.npz'):
+            with np.load(path) as f:
+                return f['array']
+        return np.load(path, mmap_mode='r')
+
+    def put(self, key, array):
+        array = np.asarray(array)
+        ext = '.npz' if self.compress else '.npy'
+        path = os.path.join(self.cache_dir, key + ext)
+        # write-then-rename so a crashed run never leaves a partial entry
+        tmp_path = os.path.join(self.cache_dir, f".{key}.{os.getpid()}.tmp{ext}")
+        if self.compress:
+            np.savez_compressed(tmp_path, array=array)
+        else:
+            np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def get_or_compute(self, key, compute_fn):
+        array = self.get(key)
+        if array is None:
+            array = compute_fn()
+            self.put(key, array)
+        return array
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache is within `max_bytes`, never removing `keep`.
+        """
+        entries = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+                   if f.endswith(('.npy', '.npz')) and not f.startswith('.')]
+        entries = sorted(entries, key=os.path.getmtime)
+        total_bytes = sum(os.path.getsize(path) for path in entries)
+        for path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+                continue
+            total_bytes -= os.path.getsize(path)
+            os.remove(path)
+            logger.info(f"Cache evicted {os.path.basename(path)} from {self.cache_dir}")
+
+
+def test_array_cache(tmp_path):
+    cache = ArrayCache(str(tmp_path), max_bytes=2 * (8 * 100 + 128))
+    a = np.random.normal(size=100)
+    key = cache.key(a, np.arange(3), kernel='M32')
+    assert key == cache.key(a.copy(), np.arange(3), kernel='M32')
+    assert key != cache.key(a, np.arange(3), kernel='M52')
+    assert key != cache.key(a, np.arange(3.), kernel='M32')
+    assert cache.key(a, kernel='M32', version=1) != cache.key(a, kernel='M32', version=2)
+    assert cache.get(key) is None
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return a
+
+    assert np.all(cache.get_or_compute(key, compute) == a)
+    b = cache.get_or_compute(key, compute)
+    assert isinstance(b, np.memmap) and np.all(b == a)
+    assert len(calls) == 1
+    # filling the cache evicts the least recently used entry
+    keys = [key]
+    for i in range(3):
+        keys.append(cache.key(a, i=i))
+        time.sleep(0.01)
+        cache.put(keys[-1], a + i)
+    assert cache.get(keys[0]) is None and cache.get(keys[1]) is None
+    assert np.all(cache.get(keys[-1]) == a + 2)
+    compressed = ArrayCache(str(tmp_path / 'compressed'), compress=True)
+    compressed.put(key, np.zeros(1000))
+    assert np.all(compressed.get(key) == 0.)
+
+
 def curv(Y, times, i):
     """
     Computes the curvature at index i, using a deg=2 polynomial fit to the point and neighbours.
@@ -131,9 +131,14 @@ def main(archive_dir, script_dir, root_working_dir, obs_num, region_file, ncpu,
              script_name='slow_solve_on_subtracted.py', exec_env=lofar_sksp_env),
         Step('tec_inference_and_smooth', ['solve_dds4','neural_gain_flagger'], script_dir=script_dir,
              script_name='tec_inference_and_smooth.py', exec_env=bayes_gain_screens_env),
-        Step('infer_screen', ['tec_inference_and_smooth'], script_dir=script_dir,
+        Step('dphase_outliers', ['tec_inference_and_smooth'], script_dir=script_dir,
+             script_name='dphase_outliers.py', exec_env=bayes_gain_screens_env),
+        # dphase_outliers reads the DDS5 phases before infer_screen replaces the tec outliers in them
+        Step('infer_screen', ['tec_inference_and_smooth', 'dphase_outliers'], script_dir=script_dir,
              script_name='infer_screen.py',
              exec_env=bayes_gain_screens_env),
+        Step('render_screen', ['infer_screen'], script_dir=script_dir,
+             script_name='render_screen.py', exec_env=bayes_gain_screens_env),
         Step('merge_slow', ['slow_solve_dds4', 'infer_screen', 'tec_inference_and_smooth'],
              script_dir=script_dir,
              script_name='merge_slow.py', exec_env=bayes_gain_screens_env),
@@ -234,6 +239,10 @@ def main(archive_dir, script_dir, root_working_dir, obs_num, region_file, ncpu,
         .add_cmd_arg('data_dir', data_dir) \
         .add_cmd_arg('plot_results', True)
 
+    steps['dphase_outliers'] \
+        .add_cmd_arg('obs_num', obs_num) \
+        .add_cmd_arg('data_dir', data_dir)
+
     steps['slow_solve_dds4'] \
         .add_cmd_arg('ncpu', ncpu) \
         .add_cmd_arg('obs_num', obs_num) \
@@ -247,6 +256,11 @@ def main(archive_dir, script_dir, root_working_dir, obs_num, region_file, ncpu,
         .add_cmd_arg('ncpu', ncpu) \
         .add_cmd_arg('plot_results', True)
 
+    steps['render_screen'] \
+        .add_cmd_arg('obs_num', obs_num) \
+        .add_cmd_arg('data_dir', data_dir) \
+        .add_cmd_arg('ref_image_fits', ref_image_fits)
+
     steps['merge_slow'] \
         .add_cmd_arg('obs_num', obs_num) \
         .add_cmd_arg('data_dir', data_dir)
@@ -434,10 +448,12 @@ def debug_main():
          do_solve_dds4=0,
          do_neural_gain_flagger=0,
          do_tec_inference_and_smooth=1,
+         do_dphase_outliers=0,
          do_slow_solve_dds4=1,
          do_merge_slow=1,
          do_flag_visibilities=1,
          do_infer_screen=1,
+         do_render_screen=0,
          do_image_dds4=0,
          do_image_subtract_dds4=0,
          do_image_smooth=0,
@@ -458,7 +474,9 @@ STEPS = [
     "neural_gain_flagger",
     "slow_solve_dds4",
     "tec_inference_and_smooth",
+    "dphase_outliers",
     "infer_screen",
+    "render_screen",
     "merge_slow",
     "flag_visibilities",
     "image_subtract_dirty",
@@ -221,12 +221,13 @@ class Simulation(object):
             ref_ant_x = ac.ITRS(*ref_ant.cartesian.xyz, obstime=time).transform_to(ref_frame).cartesian.xyz.to(
                 au.km).value
 
-            X = make_coord_array(x, k, t[i:i+1, None], ref_ant_x[None,:], flat=True)
-
-            X1.x.append(X[:, 0:3])
-            X1.k.append(X[:, 3:6])
-            X1.t.append(X[:, 6:7])
-            X1.ref_x.append(X[:, 7:8])
+            # gathered block by block rather than tiled in full
+            X = make_coord_array(x, k, t[i:i+1, None], ref_ant_x[None,:], flat=True, lazy=True)
+            for _, block in X.blocks(block_size=Nd):
+                X1.x.append(block[:, 0:3])
+                X1.k.append(block[:, 3:6])
+                X1.t.append(block[:, 6:7])
+                X1.ref_x.append(block[:, 7:10])
 
         X1 = X1._replace(x=jnp.concatenate(X1.x, axis=0),
                          k=jnp.concatenate(X1.k, axis=0),